@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark the creation of archives of many small files as done on restore.
+
+Create a tree with many small files and compare the time to archive it
+using `archiver.archive` with the previous implementation based on
+os.walk(), islink(), isfile(), isdir() and the writers of the standard
+library, each calling stat() again. When strace is available, also count
+the system calls of both implementations.
+
+Usage: python bench_archive.py [--files 50000] [--kind tar] [--repeat 3]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from itertools import chain
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import timeit
+import zipfile
+
+from rdiffweb.archiver import archive
+
+
+def create_tree(root, count):
+    """
+    Create a tree with `count` small files in directories of 100 files.
+    """
+    path = os.path.join(root, b'data')
+    for i in range(count):
+        dirname = os.path.join(path, b'dir%04d' % (i // 100))
+        if i % 100 == 0:
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, b'file%06d' % i), 'wb') as f:
+            f.write(b'data %d\n' % i * (i % 50))
+    return path
+
+
+def legacy_archive(path, kind):
+    """
+    Reproduce the previous implementation of archive(): os.walk() then
+    islink(), isfile() and isdir() before calling the writer.
+    """
+    with open(os.devnull, 'wb') as dest:
+        if kind == 'zip':
+            z = zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            z = tarfile.open(fileobj=dest, mode='w|')
+        for root, dirs, files in os.walk(path):
+            for name in chain(dirs, files):
+                filename = os.path.join(root, name)
+                arcname = filename[len(path) + 1:].decode('utf-8')
+                filename = filename.decode('utf-8')
+                if kind == 'zip':
+                    if os.path.islink(filename) or not (os.path.isfile(filename) or os.path.isdir(filename)):
+                        continue
+                    z.write(filename, arcname)
+                else:
+                    z.add(filename, arcname, recursive=False)
+        z.close()
+
+
+def scandir_archive(path, kind):
+    """
+    Create the archive with archive().
+    """
+    with open(os.devnull, 'wb') as dest:
+        archive(path, dest, encoding='utf-8', kind=kind)
+
+
+def count_syscalls(func, path, kind):
+    """
+    Use strace to count the system calls made by the given function. Return
+    None if strace is not available.
+    """
+    code = (
+        'import sys; sys.path[:0] = %r; '
+        'from bench_archive import *; %s(%r, %r)' % (
+            sys.path, func, path, kind))
+    try:
+        output = subprocess.check_output(
+            ['strace', '-f', '-c', '-e', 'trace=stat,lstat,fstat,newfstatat,statx,getdents,getdents64,openat,read',
+             sys.executable, '-c', code],
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if line.strip().endswith('total'):
+            return int(line.split()[-2])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=50000, help='number of files to create')
+    parser.add_argument('--kind', default='tar', choices=['tar', 'zip'], help='kind of archive')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repetition')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='rdiffweb_bench_').encode('utf-8')
+    try:
+        print('creating %d files...' % args.files)
+        path = create_tree(root, args.files)
+
+        legacy = min(timeit.repeat(lambda: legacy_archive(path, args.kind), number=1, repeat=args.repeat))
+        scan = min(timeit.repeat(lambda: scandir_archive(path, args.kind), number=1, repeat=args.repeat))
+        print('os.walk + stat per writer: %.3fs' % legacy)
+        print('archive (scandir):         %.3fs' % scan)
+
+        legacy_calls = count_syscalls('legacy_archive', path, args.kind)
+        scan_calls = count_syscalls('scandir_archive', path, args.kind)
+        if legacy_calls and scan_calls:
+            print('stat/getdents/open/read syscalls: %d vs %d' % (legacy_calls, scan_calls))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
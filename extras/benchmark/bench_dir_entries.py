@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark the listing of a directory as done by the browse page.
+
+Create a fake repository with many files and compare the time to list it
+using `DirEntry.dir_entries` with the previous implementation based on
+listdir(), isdir() and lstat(). When strace is available, also count the
+system calls of both implementations, without the ones of the interpreter
+startup.
+
+Usage: python bench_dir_entries.py [--files 100000] [--repeat 3]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from rdiffweb.librdiff import RdiffRepo
+
+
+def create_repo(root, count):
+    """
+    Create a fake repository with `count` files and directories.
+    """
+    repo = os.path.join(root, b'repo')
+    os.makedirs(os.path.join(repo, b'rdiff-backup-data', b'increments'))
+    for i in range(count):
+        name = os.path.join(repo, b'file%06d' % i)
+        if i % 10 == 0:
+            os.mkdir(name)
+        else:
+            with open(name, 'wb') as f:
+                f.write(b'x' * (i % 100))
+    return repo
+
+
+def legacy_listing(root):
+    """
+    Reproduce the previous implementation of dir_entries(), without using
+    DirEntry: listdir() of the increments and of the directory, then for
+    every entry normpath(), isdir() and lstat() if it's a file.
+    """
+    repo = RdiffRepo(root, b'repo')
+    full_path = repo.full_path
+    increments = os.path.join(full_path, b'rdiff-backup-data', b'increments')
+    if os.access(increments, os.F_OK):
+        os.listdir(increments)
+    names = []
+    if os.path.isdir(full_path) and os.access(full_path, os.F_OK):
+        names = os.listdir(full_path)
+        names.remove(b'rdiff-backup-data')
+    result = []
+    for name in names:
+        path = os.path.normpath(os.path.join(full_path, name))
+        isdir = os.path.isdir(path)
+        result.append((name, isdir, 0 if isdir else os.lstat(path).st_size))
+    return result
+
+
+def scandir_listing(root):
+    """
+    List the directory with dir_entries().
+    """
+    repo = RdiffRepo(root, b'repo')
+    return [
+        (e.path, e.isdir, 0 if e.isdir else e.file_size)
+        for e in repo.get_path(b'').dir_entries]
+
+
+def startup(root):
+    """
+    Only open the repository. Used to count the system calls of the
+    interpreter startup.
+    """
+    RdiffRepo(root, b'repo')
+
+
+def count_syscalls(func, root):
+    """
+    Use strace to count the system calls made by the given function. Return
+    None if strace is not available.
+    """
+    code = (
+        'import sys; sys.path[:0] = %r; '
+        'from bench_dir_entries import *; %s(%r)' % (
+            sys.path, func, root))
+    try:
+        output = subprocess.check_output(
+            ['strace', '-f', '-c', '-e', 'trace=stat,lstat,newfstatat,statx,getdents,getdents64',
+             sys.executable, '-c', code],
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if line.strip().endswith('total'):
+            return int(line.split()[-2])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000, help='number of files to create')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repetition')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='rdiffweb_bench_').encode('utf-8')
+    try:
+        print('creating %d files...' % args.files)
+        create_repo(root, args.files)
+        assert sorted(legacy_listing(root)) == sorted(scandir_listing(root))
+
+        legacy = min(timeit.repeat(lambda: legacy_listing(root), number=1, repeat=args.repeat))
+        scan = min(timeit.repeat(lambda: scandir_listing(root), number=1, repeat=args.repeat))
+        print('listdir + isdir + lstat: %.3fs' % legacy)
+        print('dir_entries (scandir):   %.3fs' % scan)
+
+        startup_calls = count_syscalls('startup', root)
+        legacy_calls = count_syscalls('legacy_listing', root)
+        scan_calls = count_syscalls('scandir_listing', root)
+        if startup_calls and legacy_calls and scan_calls:
+            print('stat/getdents syscalls: %d vs %d' % (
+                legacy_calls - startup_calls, scan_calls - startup_calls))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,18 +23,32 @@ is greatly inspired from Mercurial archival module.
 from __future__ import unicode_literals
 
 import codecs
+from collections import deque
 from future.builtins import bytes
 from future.builtins import str
 from itertools import chain
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import stat
 import struct
 import sys
 import tarfile
+import tempfile
+import threading
 import time
-from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP64_LIMIT, crc32, zlib, \
-    ZIP_DEFLATED
+from zipfile import ZipInfo, ZIP_STORED, ZIP64_LIMIT, crc32, zlib, \
+    ZIP_DEFLATED, structCentralDir, stringCentralDir, \
+    structEndArchive, stringEndArchive, structEndArchive64, \
+    stringEndArchive64, structEndArchive64Locator, stringEndArchive64Locator
+
+from rdiffweb.rdw_helpers import scandir
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
 
 
 logger = logging.getLogger(__name__)
@@ -45,30 +59,391 @@ PY3 = sys.version_info[0] == 3
 # Increase the chunk size to improve performance.
 CHUNK_SIZE = 4096 * 10
 
+# Size of the buffer used to read the files added to an archive.
+BUFFER_SIZE = 1024 * 1024
+
+# Size of the blocks compressed in parallel.
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# Smaller blocks are compressed by the calling thread.
+INLINE_SIZE = 64 * 1024
+
+# Size of the deflate window used to prime the next block.
+DEFLATE_WINDOW = 32 * 1024
+
+# Size of the central directory kept in memory before using a file.
+SPOOL_SIZE = 1024 * 1024
+
+# Version needed to extract zip64 entries.
+ZIP64_VERSION = 45
+
+# Extensions of files already compressed, stored without compression.
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.7z', '.aac', '.apk', '.avi', '.bz2', '.cab', '.deb', '.docx', '.flac',
+    '.flv', '.gif', '.gpg', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz',
+    '.lz4', '.lzma', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.mpeg',
+    '.mpg', '.odp', '.ods', '.odt', '.ogg', '.opus', '.png', '.pptx', '.rar',
+    '.rpm', '.tbz2', '.tgz', '.txz', '.webm', '.webp', '.wma', '.wmv',
+    '.xlsx', '.xz', '.zip', '.zst'])
+
+# Data is stored when the compressed sample is bigger than this ratio.
+STORE_THRESHOLD = 0.95
+
+# Size of the sample compressed to decide if data is compressible.
+PROBE_SIZE = 64 * 1024
+
+# Smaller samples are always compressed.
+PROBE_MIN_SIZE = 4096
+
+# Thread pools shared by every archive, by number of threads.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(threads):
+    """Return the shared thread pool with the given number of threads."""
+    with _pools_lock:
+        pool = _pools.get(threads)
+        if pool is None:
+            pool = _pools[threads] = ThreadPool(threads)
+        return pool
+
+
+def _probe(data, threshold):
+    """
+    Return True if the given sample compress below `threshold` of its size.
+    """
+    if len(data) < PROBE_MIN_SIZE:
+        return True
+    return len(zlib.compress(data, 1)) < len(data) * threshold
+
+
+def _deflate(data, level, last, zdict=None, threshold=None):
+    """
+    Compress a block of data as raw deflate. Unless it's the `last` block,
+    the output ends on a byte boundary to be followed by the next block.
+    `zdict` is the end of the previous block used to improve compression.
+    If defined, the block is stored when samples of the data doesn't
+    compress below `threshold`.
+    """
+    if threshold and level != 0 and len(data) > PROBE_SIZE:
+        # A block may contains many files, sample the start, middle and end.
+        n = PROBE_SIZE // 3
+        middle = len(data) // 2
+        if not _probe(data[:n] + data[middle:middle + n] + data[-n:], threshold):
+            level = 0
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _ParallelWriter(object):
+    """
+    Write data to `fp` in order while blocks are compressed by a pool of
+    `threads` threads. At most two blocks per thread are compressed at the
+    same time and about as much uncompressed data is kept waiting.
+    """
+
+    def __init__(self, fp, threads, level=None):
+        self.fp = fp
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        self._pool = _get_pool(threads)
+        self._max_pending = threads * 2
+        self._pending = 0
+        self._queued_size = 0
+        self._queue = deque()
+
+    def write(self, data, callback=None):
+        """
+        Queue data to be written. `data` may be a function returning the
+        data, called when written.
+        """
+        if not self._queue:
+            # Nothing is waiting, write immediately.
+            if callable(data):
+                data = data()
+            self.fp.write(data)
+            if callback:
+                callback(len(data))
+            return
+        self._queue.append((data, callback))
+        if not callable(data):
+            self._queued_size += len(data)
+        if not self._pending or self._queued_size > self._max_pending * COMPRESS_BLOCK_SIZE:
+            self._drain(0)
+
+    def compress(self, data, last, zdict=None, callback=None, threshold=None):
+        """
+        Queue a block to be compressed and written. `callback` is called
+        with the length of the compressed data. If defined, the block is
+        stored when it doesn't compress below `threshold`.
+        """
+        # Support python2 without zdict.
+        if not PY3:
+            zdict = None
+        # Small blocks are compressed faster than sent to another thread.
+        if len(data) < INLINE_SIZE:
+            self.write(_deflate(data, self.level, last, zdict, threshold), callback)
+            return
+        result = self._pool.apply_async(_deflate, (data, self.level, last, zdict, threshold))
+        self._queue.append((result, callback))
+        self._pending += 1
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending):
+        """Write the queued data until `max_pending` blocks are pending."""
+        while self._queue and (self._pending > max_pending or not hasattr(self._queue[0][0], 'get')):
+            data, callback = self._queue.popleft()
+            if hasattr(data, 'get'):
+                self._pending -= 1
+                data = data.get()
+            elif callable(data):
+                data = data()
+            else:
+                self._queued_size -= len(data)
+            self.fp.write(data)
+            if callback:
+                callback(len(data))
+
+    def flush(self):
+        """Write everything queued."""
+        self._drain(0)
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only file object compressing data as a gzip stream using a pool
+    of `threads` threads. Like pigz, the data is split in blocks compressed
+    independently and concatenated into a single deflate stream. If defined,
+    blocks not compressing below `threshold` are stored.
+    """
+
+    def __init__(self, fileobj, threads=1, level=None, block_size=COMPRESS_BLOCK_SIZE, threshold=None):
+        self.fileobj = fileobj
+        self._threshold = threshold
+        self._writer = _ParallelWriter(fileobj, threads, level)
+        self._block_size = block_size
+        self._buf = []
+        self._buf_size = 0
+        self._zdict = None
+        self._crc = 0
+        self._size = 0
+        # Header without file name, OS unknown.
+        self._writer.write(b'\x1f\x8b\x08\x00' + struct.pack(b'<L', int(time.time())) + b'\x00\xff')
+
+    def write(self, data):
+        if not data:
+            return
+        self._crc = crc32(data, self._crc) & 0xffffffff
+        self._size += len(data)
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self._block_size:
+            self._compress(last=False)
+
+    def _compress(self, last):
+        data = b''.join(self._buf)
+        self._buf = []
+        self._buf_size = 0
+        self._writer.compress(data, last, self._zdict, threshold=self._threshold)
+        self._zdict = data[-DEFLATE_WINDOW:]
+
+    def close(self):
+        """Write the remaining data. The file object is not closed."""
+        if self._writer is None:
+            return
+        self._compress(last=True)
+        self._writer.write(struct.pack(b'<LL', self._crc, self._size & 0xffffffff))
+        self._writer.flush()
+        self._writer = None
+
+
+class _Hole(object):
+    """
+    Placeholder for `size` bytes of data. Written instead of the content of
+    the files when computing the size of an archive.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class _SizeCounter(object):
+    """
+    Destination counting the bytes written to compute the size of an
+    archive.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamTarFile(tarfile.TarFile):
+    """
+    TarFile not keeping track of the members added to use a constant memory
+    whatever the number of files. Only usable to write an archive.
+    """
+
+    def addfile(self, tarinfo, fileobj=None, bufsize=BUFFER_SIZE):
+        """
+        Write the header of `tarinfo` and the content of `fileobj` read by
+        blocks of `bufsize`.
+        """
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        if fileobj is not None:
+            remaining = tarinfo.size
+            while remaining > 0:
+                buf = fileobj.read(min(bufsize, remaining))
+                if not buf:
+                    raise IOError("unexpected end of data")
+                self.fileobj.write(buf)
+                remaining -= len(buf)
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            self.offset += blocks * tarfile.BLOCKSIZE
+
 
 class TarArchiver(object):
     """
     Archiver to create tar archive (with compression).
     """
 
-    def __init__(self, dest, compression=''):
+    def __init__(self, dest, compression='', threads=1, level=None, threshold=None, bufsize=BUFFER_SIZE,
+                 size_only=False):
         assert compression in ['', 'gz', 'bz2']
+        assert not size_only or compression == ''
         mode = "w|" + compression
+        self.bufsize = bufsize
+        self.size_only = size_only
+        # Cache of user and group names.
+        self._unames = {}
+        self._gnames = {}
 
+        # Compress gzip ourself to use many threads, a specific level or to
+        # store incompressible data.
+        self.gzipfile = None
+        if size_only:
+            # Write directly to the counter, without the buffer of a stream.
+            self.z = StreamTarFile(fileobj=dest, mode="w")
+            self.fileobj = dest
+        elif compression == 'gz' and (threads > 1 or level is not None or threshold):
+            if isinstance(dest, str):
+                dest = open(dest, 'wb')
+            self.gzipfile = ParallelGzipFile(dest, threads=threads, level=level, threshold=threshold)
+            self.z = StreamTarFile.open(fileobj=self.gzipfile, mode="w|")
+            self.fileobj = dest
         # Open the tar archive with the right method.
-        if isinstance(dest, str):
-            self.z = tarfile.open(name=dest, mode=mode)
+        elif isinstance(dest, str):
+            self.z = StreamTarFile.open(name=dest, mode=mode)
             self.fileobj = None
         else:
-            self.z = tarfile.open(fileobj=dest, mode=mode)
+            self.z = StreamTarFile.open(fileobj=dest, mode=mode)
             self.fileobj = dest
 
-    def addfile(self, filename, arcname):
-        self.z.add(filename, arcname, recursive=False)
+    def _name(self, cache, func, key):
+        if key not in cache:
+            try:
+                cache[key] = func(key)[0]
+            except KeyError:
+                cache[key] = ''
+        return cache[key]
+
+    def _tarinfo(self, filename, arcname, st):
+        """
+        Create a TarInfo from the given stat. Same as TarFile.gettarinfo()
+        without calling lstat() again. Only the files with many links are
+        kept to detect hard links.
+        """
+        tarinfo = self.z.tarinfo()
+        tarinfo.tarfile = self.z
+        arcname = arcname.replace(os.sep, "/").lstrip("/")
+        stmd = st.st_mode
+        linkname = ""
+        if stat.S_ISREG(stmd):
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and self.z.inodes.get(inode, arcname) != arcname:
+                # Is it a hardlink to an already archived file?
+                type = tarfile.LNKTYPE
+                linkname = self.z.inodes[inode]
+            else:
+                type = tarfile.REGTYPE
+                if st.st_nlink > 1 and inode[0]:
+                    self.z.inodes[inode] = arcname
+        elif stat.S_ISDIR(stmd):
+            type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(stmd):
+            type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(stmd):
+            type = tarfile.SYMTYPE
+            linkname = os.readlink(filename)
+        elif stat.S_ISCHR(stmd):
+            type = tarfile.CHRTYPE
+        elif stat.S_ISBLK(stmd):
+            type = tarfile.BLKTYPE
+        else:
+            # Unsupported file type, e.g.: socket.
+            return None
+        tarinfo.name = arcname
+        tarinfo.mode = stmd
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.size = st.st_size if type == tarfile.REGTYPE else 0
+        tarinfo.mtime = st.st_mtime
+        tarinfo.type = type
+        tarinfo.linkname = linkname
+        if pwd:
+            tarinfo.uname = self._name(self._unames, pwd.getpwuid, st.st_uid)
+        if grp:
+            tarinfo.gname = self._name(self._gnames, grp.getgrgid, st.st_gid)
+        if type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            tarinfo.devmajor = os.major(st.st_rdev)
+            tarinfo.devminor = os.minor(st.st_rdev)
+        return tarinfo
+
+    def addfile(self, filename, arcname, st=None):
+        if st is None:
+            st = os.lstat(filename)
+        tarinfo = self._tarinfo(filename, arcname, st)
+        if tarinfo is None:
+            logger.debug("skip unsupported file [%r]", filename)
+        elif tarinfo.isreg() and self.size_only:
+            # Count the data, padded to a block, without reading it.
+            self.z.addfile(tarinfo)
+            size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.z.fileobj.write(_Hole(size))
+            self.z.offset += size
+        elif tarinfo.isreg():
+            with open(filename, 'rb') as f:
+                self.z.addfile(tarinfo, f, self.bufsize)
+        else:
+            self.z.addfile(tarinfo)
 
     def close(self):
         # Close tar archive
         self.z.close()
+        if self.gzipfile:
+            self.gzipfile.close()
         # Also close file object.
         if self.fileobj:
             self.fileobj.close()
@@ -76,8 +451,8 @@ class TarArchiver(object):
 
 class _Tellable(object):
     """
-    Provide tell method for zipfile.ZipFile when writing to HTTP
-    response file object.
+    Provide tell method when writing a zip file to HTTP response file
+    object. The offset is relative to the beginning of the archive.
 
     This is a workaround to bug #23252
     """
@@ -97,32 +472,142 @@ class _Tellable(object):
         return self.offset
 
 
-class NonSeekZipFile(ZipFile):
+def _central_directory(zinfo):
     """
-    Fix to support non seek-able stream. Modification taken from python 3.5.
-    This is a workaround to bug #23252
+    Return the central directory record of the given ZipInfo.
     """
+    dt = zinfo.date_time
+    dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+    dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+    extra = []
+    if zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT:
+        extra.extend([zinfo.file_size, zinfo.compress_size])
+        file_size = compress_size = 0xffffffff
+    else:
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+    if zinfo.header_offset > ZIP64_LIMIT:
+        extra.append(zinfo.header_offset)
+        header_offset = 0xffffffff
+    else:
+        header_offset = zinfo.header_offset
+    extra_data = zinfo.extra
+    min_version = 0
+    if extra:
+        extra_data = struct.pack(b'<HH' + b'Q' * len(extra), 1, 8 * len(extra), *extra) + extra_data
+        min_version = ZIP64_VERSION
+    filename, flag_bits = zinfo._encodeFilenameFlags()
+    centdir = struct.pack(
+        structCentralDir, stringCentralDir,
+        max(min_version, zinfo.create_version), zinfo.create_system,
+        max(min_version, zinfo.extract_version), zinfo.reserved, flag_bits,
+        zinfo.compress_type, dostime, dosdate, zinfo.CRC, compress_size,
+        file_size, len(filename), len(extra_data), len(zinfo.comment), 0,
+        zinfo.internal_attr, zinfo.external_attr, header_offset)
+    return centdir + filename + extra_data + zinfo.comment
 
-    dereference = False  # If true, add content of linked file to the  tar file, else the link.
 
-    def __init__(self, dest, *args, **kwargs):
-        if not isinstance(dest, str):
-            try:
-                dest.tell()
-            except (AttributeError, IOError):
-                dest = _Tellable(dest)
-        ZipFile.__init__(self, dest, *args, **kwargs)
+def _sample_file(fp, buf, size):
+    """
+    Return a sample of the first `size` bytes of the file `fp` of which
+    `buf` was already read: its start, middle and end. The position of
+    `fp` is restored.
+    """
+    if size <= PROBE_SIZE:
+        return buf[:PROBE_SIZE]
+    n = PROBE_SIZE // 3
+    samples = [buf[:n]]
+    offset = fp.tell()
+    for start in (size // 2, size - n):
+        if start + n <= len(buf):
+            samples.append(buf[start:start + n])
+        else:
+            fp.seek(start)
+            samples.append(fp.read(n))
+    fp.seek(offset)
+    return b''.join(samples)
+
+
+def _crc_file(fp, buf, size, bufsize=BUFFER_SIZE):
+    """
+    Return the CRC of the first `size` bytes of the file `fp` of which
+    `buf` was already read. The position of `fp` is restored.
+    """
+    crc = crc32(buf) & 0xffffffff
+    read = len(buf)
+    if read < size:
+        offset = fp.tell()
+        while read < size:
+            data = fp.read(min(bufsize, size - read))
+            if not data:
+                break
+            crc = crc32(data, crc) & 0xffffffff
+            read += len(data)
+        fp.seek(offset)
+    return crc
+
+
+class StreamZipFile(object):
+    """
+    Write-only zip file supporting non seek-able stream. The CRC and sizes
+    of deflated files are written after their data. Stored files have them
+    in the local header, as required by some readers (e.g.: Java), so
+    their CRC is computed before writing their data. Files, or blocks of a
+    large file, are deflated by a pool of `threads` threads and written in
+    order.
+
+    The central directory records are kept in a temporary file instead of
+    a list of ZipInfo to use a constant memory whatever the number of
+    files.
+
+    With `size_only`, the files are not read and only the size of the
+    archive is computed. Only exact when the files are stored.
+    """
+
+    def __init__(self, dest, compression=ZIP_DEFLATED, threads=1, level=None, threshold=None,
+                 bufsize=BUFFER_SIZE, size_only=False):
+        self.compression = compression
+        self.size_only = size_only
+        self.threshold = threshold
+        self.bufsize = bufsize
+        if isinstance(dest, str):
+            dest = open(dest, 'wb')
+            self._close_fp = True
+        else:
+            self._close_fp = False
+        # Offsets are relative to the beginning of the archive.
+        self.fp = _Tellable(dest)
+        self._writer = _ParallelWriter(self.fp, threads, level)
+        self._centdir = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._count = 0
+
+    def _add_central_directory(self, zinfo):
+        self._centdir.write(_central_directory(zinfo))
+        self._count += 1
+
+    def _set_stored(self, zinfo, crc):
+        """
+        Define the CRC and sizes of a stored file to be written in the local
+        header instead of a data descriptor. Return True if zip64 is used.
+        """
+        zinfo.compress_type = ZIP_STORED
+        zinfo.flag_bits = 0x00
+        zinfo.CRC = crc
+        zinfo.compress_size = zinfo.file_size
+        return zinfo.file_size > ZIP64_LIMIT
 
-    def write(self, filename, arcname=None, compress_type=None):
+    def write(self, filename, arcname=None, compress_type=None, st=None):
         """
-        Fixed version of write supporting bitflag 0x08 to write crc and size
-        at end of file.
+        Add the given file. `st` is the result of stat() if already known.
+        Unless `compress_type` is defined, files not worth compressing
+        according to `threshold` are stored.
         """
         if not self.fp:
             raise RuntimeError(
                 "Attempt to write to ZIP archive that was already closed")
 
-        st = os.stat(filename)
+        if st is None:
+            st = os.stat(filename)
         isdir = stat.S_ISDIR(st.st_mode)
         mtime = time.localtime(st.st_mtime)
         date_time = mtime[0:6]
@@ -142,114 +627,303 @@ class NonSeekZipFile(ZipFile):
             zinfo.compress_type = self.compression
         else:
             zinfo.compress_type = compress_type
-
-        zinfo.file_size = st.st_size
-        zinfo.flag_bits = 0x00
-        zinfo.header_offset = self.fp.tell()  # Start of header bytes
-
-        self._writecheck(zinfo)
-        self._didModify = True
-
+        zinfo.file_size = 0 if isdir else st.st_size
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.flag_bits = 0x00 if isdir else 0x08
         if isdir:
-            zinfo.file_size = 0
-            zinfo.compress_size = 0
-            zinfo.CRC = 0
             zinfo.external_attr |= 0x10  # MS-DOS directory flag
-            self.filelist.append(zinfo)
-            self.NameToInfo[zinfo.filename] = zinfo
-            self.fp.write(zinfo.FileHeader())
-            self.start_dir = self.fp.tell()
-            return
+        # Compressed size can be larger than uncompressed size
+        zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        if compress_type is None and self.threshold and zinfo.compress_type == ZIP_DEFLATED:
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in INCOMPRESSIBLE_EXTENSIONS:
+                zinfo.compress_type = ZIP_STORED
 
-        zinfo.flag_bits |= 0x08
-        with open(filename, "rb") as fp:
-            # Must overwrite CRC and sizes with correct data later
-            zinfo.CRC = CRC = 0
-            zinfo.compress_size = compress_size = 0
+        # The offset is only known when the header is written.
+        def header():
+            zinfo.header_offset = self.fp.tell()
             try:
-                # Python > 2.7.3
-                # Compressed size can be larger than uncompressed size
-                zip64 = self._allowZip64 and \
-                    zinfo.file_size * 1.05 > ZIP64_LIMIT
-                self.fp.write(zinfo.FileHeader(zip64))
+                data = zinfo.FileHeader(zip64)
             except TypeError:
                 # Python <= 2.7.3
-                zip64 = zinfo.file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
-                self.fp.write(zinfo.FileHeader())
-            if zinfo.compress_type == ZIP_DEFLATED:
-                cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                                        zlib.DEFLATED, -15)
-            else:
-                cmpr = None
-            file_size = 0
-            while 1:
-                buf = fp.read(CHUNK_SIZE)
-                if not buf:
-                    break
-                file_size = file_size + len(buf)
-                CRC = crc32(buf, CRC) & 0xffffffff
-                if cmpr:
-                    buf = cmpr.compress(buf)
-                    compress_size = compress_size + len(buf)
-                self.fp.write(buf)
-        if cmpr:
-            buf = cmpr.flush()
-            compress_size = compress_size + len(buf)
-            self.fp.write(buf)
-            zinfo.compress_size = compress_size
+                data = zinfo.FileHeader()
+            if isdir:
+                self._add_central_directory(zinfo)
+            return data
+        if isdir:
+            self._writer.write(header)
+            return
+
+        def add_size(size):
+            zinfo.compress_size += size
+
+        # Read up to the size returned by stat() to avoid a read() at the
+        # end of each file.
+        size = zinfo.file_size
+        crc = file_size = 0
+        if self.size_only:
+            # Count the data without reading it.
+            if zinfo.compress_type == ZIP_STORED:
+                zip64 = self._set_stored(zinfo, 0)
+            self._writer.write(header)
+            self._writer.write(_Hole(size), None if zinfo.compress_type == ZIP_STORED else add_size)
+            file_size = size
         else:
-            zinfo.compress_size = file_size
-        zinfo.CRC = CRC
-        zinfo.file_size = file_size
-        if not zip64 and self._allowZip64:
-            if file_size > ZIP64_LIMIT:
-                raise RuntimeError('File size has increased during compressing')
-            if compress_size > ZIP64_LIMIT:
-                raise RuntimeError('Compressed size larger than uncompressed size')
+            with open(filename, "rb") as fp:
+                buf = fp.read(min(self.bufsize, size))
+                # Probe the start, middle and end to store incompressible data.
+                if (compress_type is None and self.threshold and zinfo.compress_type == ZIP_DEFLATED and
+                        not _probe(_sample_file(fp, buf, size), self.threshold)):
+                    zinfo.compress_type = ZIP_STORED
+                if zinfo.compress_type == ZIP_STORED:
+                    zip64 = self._set_stored(zinfo, _crc_file(fp, buf, size, self.bufsize))
+                self._writer.write(header)
+                zdict = None
+                while True:
+                    crc = crc32(buf, crc) & 0xffffffff
+                    file_size += len(buf)
+                    next_buf = fp.read(min(self.bufsize, size - file_size)) if buf and file_size < size else b''
+                    if zinfo.compress_type == ZIP_DEFLATED:
+                        self._writer.compress(buf, not next_buf, zdict, add_size)
+                        zdict = buf[-DEFLATE_WINDOW:]
+                    elif buf:
+                        self._writer.write(buf)
+                    if not next_buf:
+                        break
+                    buf = next_buf
+
         # Write CRC and file sizes after the file data
-        fmt = b'<LQQ' if zip64 else b'<LLL'
-        self.fp.write(struct.pack(fmt, zinfo.CRC, zinfo.compress_size,
-                                  zinfo.file_size))
-        self.start_dir = self.fp.tell()
-        self.filelist.append(zinfo)
-        self.NameToInfo[zinfo.filename] = zinfo
+        def descriptor():
+            if not zinfo.flag_bits & 0x08:
+                # Stored file with CRC and sizes in the local header.
+                if crc != zinfo.CRC or file_size != zinfo.file_size:
+                    raise RuntimeError('File has changed during archiving')
+                self._add_central_directory(zinfo)
+                return b''
+            zinfo.CRC = crc
+            zinfo.file_size = file_size
+            if not zip64:
+                if file_size > ZIP64_LIMIT:
+                    raise RuntimeError('File size has increased during compressing')
+                if zinfo.compress_size > ZIP64_LIMIT:
+                    raise RuntimeError('Compressed size larger than uncompressed size')
+            self._add_central_directory(zinfo)
+            fmt = b'<LQQ' if zip64 else b'<LLL'
+            return struct.pack(fmt, zinfo.CRC, zinfo.compress_size, zinfo.file_size)
+        self._writer.write(descriptor)
+
+    def close(self):
+        """Write the central directory and the end of archive record."""
+        if not self.fp:
+            return
+        self._writer.flush()
+        offset = self.fp.tell()
+        self._centdir.seek(0)
+        while True:
+            buf = self._centdir.read(CHUNK_SIZE)
+            if not buf:
+                break
+            self.fp.write(buf)
+        self._centdir.close()
+        size = self.fp.tell() - offset
+        count = self._count
+        if count >= 0xffff or offset > ZIP64_LIMIT or size > ZIP64_LIMIT:
+            self.fp.write(struct.pack(
+                structEndArchive64, stringEndArchive64,
+                44, 45, 45, 0, 0, count, count, size, offset))
+            self.fp.write(struct.pack(
+                structEndArchive64Locator, stringEndArchive64Locator,
+                0, offset + size, 1))
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            offset = min(offset, 0xffffffff)
+        self.fp.write(struct.pack(
+            structEndArchive, stringEndArchive,
+            0, 0, count, count, size, offset, 0))
+        self.fp.flush()
+        if self._close_fp:
+            self.fp.close()
+        self.fp = None
 
 
 class ZipArchiver(object):
     """
     Write files to zip file or stream.
-    Can write uncompressed, or compressed with deflate.
+    Can write uncompressed, or compressed with deflate. If defined, files
+    not worth compressing according to `threshold` are stored. Files are
+    stored when `level` is 0.
     """
 
-    def __init__(self, dest, compress=True):
-        compress = compress and ZIP_DEFLATED or ZIP_STORED
-        if sys.version_info < (3, 5):
-            self.z = NonSeekZipFile(dest, 'w', compress)
-        else:
-            self.z = ZipFile(dest, 'w', compress)
+    def __init__(self, dest, compress=True, threads=1, level=None, threshold=None, bufsize=BUFFER_SIZE,
+                 size_only=False):
+        compress = compress and level != 0 and ZIP_DEFLATED or ZIP_STORED
+        self.z = StreamZipFile(
+            dest, compress, threads=threads, level=level, threshold=threshold, bufsize=bufsize,
+            size_only=size_only)
 
-    def addfile(self, filename, arcname):
+    def addfile(self, filename, arcname, st=None):
+        if st is None:
+            st = os.lstat(filename)
         # Python as of today doesn't support symlink or pipe in zipfile.
         # Skip them. See bug #26269 and #18595
-        if os.path.islink(filename) or not (os.path.isfile(filename) or os.path.isdir(filename)):
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode)):
             return
-        self.z.write(filename, arcname)
+        self.z.write(filename, arcname, st=st)
 
     def close(self):
         self.z.close()
 
 
+# Archivers accept `threads`, `level` and `threshold` to control the
+# compression, `bufsize` to read the files and `size_only` to compute the
+# size of the archive.
 ARCHIVERS = {
-    'tar': TarArchiver,
-    'tbz2': lambda dest, : TarArchiver(dest, 'bz2'),
-    'tar.bz2': lambda dest: TarArchiver(dest, 'bz2'),
-    'tar.gz': lambda dest: TarArchiver(dest, 'gz'),
-    'tgz': lambda dest: TarArchiver(dest, 'gz'),
+    'tar': lambda dest, bufsize=BUFFER_SIZE, size_only=False, **kwargs: TarArchiver(
+        dest, bufsize=bufsize, size_only=size_only),
+    'tbz2': lambda dest, bufsize=BUFFER_SIZE, **kwargs: TarArchiver(dest, 'bz2', bufsize=bufsize),
+    'tar.bz2': lambda dest, bufsize=BUFFER_SIZE, **kwargs: TarArchiver(dest, 'bz2', bufsize=bufsize),
+    'tar.gz': lambda dest, **kwargs: TarArchiver(dest, 'gz', **kwargs),
+    'tgz': lambda dest, **kwargs: TarArchiver(dest, 'gz', **kwargs),
     'zip': ZipArchiver,
 }
 
 
-def archive(path, dest, encoding, kind='zip', callback=None):
+class Archive(object):
+    """
+    Archive created by adding files and directories one after the other.
+    Used to stream an archive while its content is being restored.
+
+    `dest` define the destination of archive. Either a filename or fileobj.
+
+    `encoding` the encoding of path.
+
+    `kind` define the archive type to be created.
+
+    `callback` a function to be called with the filename and the result of
+    lstat() after processing each file.
+
+    `threads` the number of threads used to compress gzip and zip archives.
+
+    `level` the compression level (0-9) or None for the default level.
+
+    `threshold` the compression ratio above which data is stored without
+    compression or None to compress everything.
+
+    `bufsize` the size of the buffer used to read the files.
+
+    `size_only` to count the bytes written to `dest` without reading the
+    files. See `archive_size()`.
+    """
+
+    def __init__(self, dest, encoding, kind='zip', callback=None, threads=1, level=None,
+                 threshold=STORE_THRESHOLD, bufsize=BUFFER_SIZE, size_only=False):
+        assert dest
+        assert encoding
+        assert kind in ARCHIVERS
+
+        # Get the right decode function.
+        decoder = codecs.getdecoder(encoding)
+        assert decoder
+        if PY3 and kind != 'zip':
+            def decode(val):
+                return decoder(val, 'surrogateescape')[0]
+        else:
+            def decode(val):
+                return decoder(val, 'replace')[0]
+        self._decode = decode
+        self._callback = callback
+        self._archiver = ARCHIVERS[kind](
+            dest, threads=threads, level=level, threshold=threshold, bufsize=bufsize, size_only=size_only)
+
+    def _addfile(self, filename, arcname, st):
+        if PY3:
+            # Py3, doesn't support bytes file path. So we need
+            # to use surrogate escape to escape invalid unicode char.
+            filename = filename.decode('ascii', 'surrogateescape')
+        # Always need to decode the arcname as unicode to support non-ascii.
+        arcname = self._decode(arcname)
+        assert isinstance(arcname, str)
+
+        # Add the file to the archive.
+        logger.debug("adding file [%r] to archive", filename)
+        self._archiver.addfile(filename, arcname, st)
+        logger.debug("file [%r] added to archive", filename)
+
+        # Make a call to callback function
+        if self._callback:
+            self._callback(filename, st)
+
+    def _walk(self, path, exclude=None):
+        """
+        Iterate over the content of the given directory, depth first like
+        os.walk(). Yield tuples of (filename, lstat) with the directories
+        first. Each entry is stat only once. Symlinks are not followed.
+        """
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            logger.warning("fail to list [%r]", path, exc_info=1)
+            return
+        dirs = []
+        files = []
+        for entry in entries:
+            if exclude and entry.name in exclude:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # File removed in the meantime.
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append((entry.path, st))
+            else:
+                files.append((entry.path, st))
+        for item in chain(dirs, files):
+            yield item
+        for dirname, unused in dirs:
+            for item in self._walk(dirname):
+                yield item
+
+    def add(self, path, arcname=b'', exclude=None, rename=None, recursive=True):
+        """
+        Add the file or directory `path` as `arcname`. A directory is added
+        recursively unless `recursive` is False. When `arcname` is empty,
+        only the content of the directory is added.
+
+        `exclude` a list of names to be excluded from the top level directory.
+
+        `rename` a function to be called with the relative path (bytes) to
+        compute the name in the archive.
+        """
+        assert isinstance(path, bytes)
+        assert isinstance(arcname, bytes)
+
+        # Norm the path (remove ../, ./)
+        path = os.path.normpath(path)
+
+        logger.info("adding [%r] to archive", path)
+        if arcname:
+            st = os.lstat(path)
+            self._addfile(path, arcname, st)
+            if not recursive or not stat.S_ISDIR(st.st_mode):
+                return
+
+        # Add files to the archive
+        for filename, st in self._walk(path, exclude):
+            assert filename.startswith(path)
+            relname = filename[len(path) + 1:]
+            if rename:
+                relname = rename(relname)
+            self._addfile(filename, os.path.join(arcname, relname) if arcname else relname, st)
+
+    def close(self):
+        # Close the archive
+        self._archiver.close()
+
+
+def archive(path, dest, encoding, kind='zip', callback=None, exclude=None, rename=None, threads=1, level=None,
+            threshold=STORE_THRESHOLD, bufsize=BUFFER_SIZE):
     """
     Used to archive the given `path`.
 
@@ -259,55 +933,67 @@ def archive(path, dest, encoding, kind='zip', callback=None):
 
     `kind` define the archive type to be created.
 
-    `callback` a function to be called after processing each file.
+    `callback` a function to be called with the filename and the result of
+    lstat() after processing each file.
+
+    `exclude` a list of names to be excluded from the top level directory.
+
+    `rename` a function to be called with the relative path (bytes) to
+    compute the name in the archive.
+
+    `threads` the number of threads used to compress gzip and zip archives.
+
+    `level` the compression level (0-9) or None for the default level.
+
+    `threshold` the compression ratio above which data is stored without
+    compression or None to compress everything.
+
+    `bufsize` the size of the buffer used to read the files.
     """
     assert isinstance(path, bytes)
-    assert dest
-    assert encoding
-    assert kind in ARCHIVERS
-
-    # Get the right decode function.
-    decoder = codecs.getdecoder(encoding)
-    assert decoder
-    if PY3 and kind != 'zip':
-        def decode(val):
-            return decoder(val, 'surrogateescape')[0]
-    else:
-        def decode(val):
-            return decoder(val, 'replace')[0]
-
-    # Norm the path (remove ../, ./)
-    path = os.path.normpath(path)
 
     # Create a tar.gz archive
     logger.info("creating archive from [%r]", path)
-    archiver = ARCHIVERS[kind](dest)
+    a = Archive(dest, encoding, kind=kind, callback=callback, threads=threads, level=level, threshold=threshold,
+                bufsize=bufsize)
+    a.add(path, exclude=exclude, rename=rename)
+    a.close()
 
-    # Add files to the archive
-    for root, dirs, files in os.walk(path, topdown=True, followlinks=False):
-        for name in chain(dirs, files):
-            filename = os.path.join(root, name)
-            assert filename.startswith(path)
-            arcname = filename[len(path) + 1:]
-            if PY3:
-                # Py3, doesn't support bytes file path. So we need
-                # to use surrogate escape to escape invalid unicode char.
-                filename = filename.decode('ascii', 'surrogateescape')
-            # Always need to decode the arcname as unicode to support non-ascii.
-            arcname = decode(arcname)
-            assert isinstance(arcname, str)
-
-            # Add the file to the archive.
-            logger.debug("adding file [%r] to archive", filename)
-            archiver.addfile(filename, arcname)
-            logger.debug("file [%r] added to archive", filename)
-
-            # Make a call to callback function
-            if callback:
-                callback(filename)
 
-    # Close the archive
-    archiver.close()
+class _TooManyFiles(Exception):
+    """
+    Raised to stop computing the size of an archive.
+    """
+    pass
+
+
+def archive_size(path, encoding, kind='zip', exclude=None, rename=None, level=None, max_files=None, **kwargs):
+    """
+    Return the exact size of the archive created by archive() with the same
+    arguments, computed from the result of lstat() without reading the
+    files. Return None when the size is only known once the data is
+    compressed. Only `tar` and `zip` with `level` 0 are supported. If
+    defined, return None when the archive contains more than `max_files`
+    files.
+    """
+    assert isinstance(path, bytes)
+    if not (kind == 'tar' or (kind == 'zip' and level == 0)):
+        return None
+    count = [0]
+
+    def callback(filename, st):
+        count[0] += 1
+        if max_files is not None and count[0] > max_files:
+            raise _TooManyFiles()
+
+    dest = _SizeCounter()
+    a = Archive(dest, encoding, kind=kind, callback=callback, level=level, size_only=True)
+    try:
+        a.add(path, exclude=exclude, rename=rename)
+    except _TooManyFiles:
+        return None
+    a.close()
+    return dest.size
 
 
 def main():
@@ -19,11 +19,11 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+from array import array
 import bisect
 from builtins import bytes
 from builtins import object
 from builtins import str
-from collections import OrderedDict
 import encodings
 from future.utils import iteritems
 from future.utils import python_2_unicode_compatible
@@ -31,6 +31,7 @@ from future.utils.surrogateescape import encodefilename
 import gzip
 import io
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import psutil
 import re
@@ -42,10 +43,16 @@ import threading
 import weakref
 import zlib
 
+from rdiffweb import librsync
 from rdiffweb import rdw_helpers
-from rdiffweb.archiver import archive, ARCHIVERS
+from rdiffweb.archiver import archive, archive_size, Archive, ARCHIVERS
 from rdiffweb.i18n import ugettext as _
+from rdiffweb.rdw_catalog import Catalog, catalog_filename
 from rdiffweb.rdw_config import Configuration
+from rdiffweb.rdw_restore import CancelToken, CancellableReader, \
+    CancellableWriter, CancelledError, QueueFullError, RestoreProgress, \
+    _ProgressWriter
+from rdiffweb.rdw_workers import WorkerError
 
 
 try:
@@ -70,6 +77,44 @@ CHUNK_SIZE = 1024 * 1024
 # Increment folder name.
 INCREMENTS = b"increments"
 
+# Number of threads used to read session statistics.
+SESSION_STATISTICS_THREADS = 4
+
+# Thread pool shared to read session statistics.
+_stats_pool = None
+_stats_pool_lock = threading.Lock()
+
+# Typecode of the arrays storing integer session statistics.
+try:
+    array('q')
+    _INT_TYPECODE = 'q'
+except ValueError:
+    _INT_TYPECODE = 'l'
+
+# Sentinel used for missing integer statistics.
+_INT_MISSING = -2 ** 63
+
+# Maximum size of a restored file version kept in memory before using a
+# temporary file.
+RESTORE_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Maximum number of rdiff-backup executions used to restore a directory one
+# child at a time. Directories with more children are restored at once.
+RESTORE_MAX_CHUNKS = 20
+
+# Maximum number of files of an archive for which the size is computed
+# before streaming it.
+RESTORE_LENGTH_MAX_FILES = 10000
+
+# How a chunk of a directory is restored.
+RESTORE_MIRROR = 'mirror'
+RESTORE_DIR = 'dir'
+RESTORE_EXECUTE = 'execute'
+
+# Prefixes of the rdiff-backup-data entries used by rdiffweb.
+DATA_PREFIXES = [b"current_mirror", b"error_log", b"file_statistics",
+                 b"mirror_metadata", b"session_statistics"]
+
 # Zip file extension
 ZIP_SUFFIX = b".zip"
 
@@ -120,12 +165,15 @@ class DirEntry(object):
         if isinstance(parent, RdiffRepo):
             self._repo = weakref.proxy(parent)
             self.path = path
+            # Absolute path to the directory
+            self.full_path = os.path.normpath(os.path.join(self._repo.full_path, self.path))
         else:
             self._repo = parent._repo
             # Relative path to the repository.
             self.path = os.path.join(parent.path, path)
-        # Absolute path to the directory
-        self.full_path = os.path.normpath(os.path.join(self._repo.full_path, self.path))
+            # Absolute path to the directory. A child is always a single
+            # name, no need to normalize.
+            self.full_path = os.path.join(parent.full_path, path)
         # May need to compute our own state if not provided.
         self.exists = exists
         # Store the increments sorted by date.
@@ -145,13 +193,14 @@ class DirEntry(object):
 
         # Check if the directory exists. It may not exist if
         # it has been delete
-        existing_entries = []
+        existing_entries = {}
         if os.path.isdir(self.full_path) and os.access(self.full_path, os.F_OK):
             # Get entries from directory structure
-            existing_entries = os.listdir(self.full_path)
+            for dirent in rdw_helpers.scandir(self.full_path):
+                existing_entries[dirent.name] = dirent
             # Remove "rdiff-backup-data" directory
             if self.path == b'':
-                existing_entries.remove(RDIFF_BACKUP_DATA)
+                existing_entries.pop(RDIFF_BACKUP_DATA, None)
 
         # Process each increment entries and combine this with the existing
         # entries
@@ -168,27 +217,61 @@ class DirEntry(object):
             entriesDict[filename] = new_entry
 
         # Then add existing entries
-        for filename in existing_entries:
+        for filename, dirent in iteritems(existing_entries):
             # Check if the entry was created by increments entry
-            if filename in entriesDict:
-                continue
-            # The entry doesn't exists (mostly because it ever change). So
-            # create a DirEntry to represent it
-            new_entry = DirEntry(
-                self,
-                filename,
-                True,
-                [])
-            entriesDict[filename] = new_entry
+            new_entry = entriesDict.get(filename)
+            if new_entry is None:
+                # The entry doesn't exists (mostly because it ever change).
+                # So create a DirEntry to represent it
+                new_entry = DirEntry(
+                    self,
+                    filename,
+                    True,
+                    [])
+                entriesDict[filename] = new_entry
+            # Use the result of scandir to avoid more system calls.
+            new_entry._load_dirent(dirent)
 
         # Return the values (so the DirEntry objects)
         return list(entriesDict.values())
 
+    def prefetch_file_sizes(self, entries):
+        """
+        Compute the file size of the deleted files within the given entries
+        all at once. The entries are grouped by date to read each file
+        statistics only once. Used when the size of every entries is
+        displayed.
+        """
+        entries = [e for e in entries if not e.exists and not e.isdir]
+        for date, group in iteritems(rdw_helpers.groupby(entries, lambda x: x.last_change_date or None)):
+            stats = self._repo.get_file_statistic(date)
+            if not stats:
+                continue
+            # File stats uses unquoted name.
+            paths = {e: self._repo.unquote(e.path) for e in group}
+            sizes = stats.get_source_sizes(list(paths.values()))
+            for e, path in iteritems(paths):
+                e._file_size = sizes[path]
+
     @property
     def display_name(self):
         """Return the most human readable filename. Without quote."""
-        value = self._repo.unquote(os.path.basename(self.path))
-        return self._repo._decode(value)
+        if not hasattr(self, '_display_name'):
+            value = self._repo.unquote(os.path.basename(self.path))
+            self._display_name = self._repo._decode(value)
+        return self._display_name
+
+    def _load_dirent(self, dirent):
+        """
+        Define the type and the size of this entry using the result of
+        scandir(). The type is usually known without a system call.
+        """
+        try:
+            self._isdir = dirent.is_dir()
+            if not self._isdir:
+                self._file_size = dirent.stat(follow_symlinks=False).st_size
+        except OSError:
+            logger.debug("fail to stat [%r]", dirent.path, exc_info=1)
 
     @property
     def isdir(self):
@@ -288,11 +371,14 @@ class DirEntry(object):
         """Return last change date or False."""
         return self.change_dates and self.change_dates[-1]
 
-    def restore(self, restore_date, kind='zip'):
+    def restore(self, restore_date, kind='zip', executor=None, user=None, cache=None, flights=None, progress=None,
+                archive_options=None):
         """
         Restore the file identified by this directory entry.
         """
-        return self._repo.restore(self, restore_date, kind)
+        return self._repo.restore(
+            self, restore_date, kind, executor=executor, user=user, cache=cache, flights=flights,
+            progress=progress, archive_options=archive_options)
 
 
 class HistoryEntry(object):
@@ -306,7 +392,7 @@ class HistoryEntry(object):
     @property
     def size(self):
         try:
-            return self._repo.session_statistics[self.date].sourcefilesize
+            return self._repo.session_statistics.get(self.date, 'sourcefilesize') or 0
         except KeyError:
             return 0
 
@@ -326,7 +412,7 @@ class HistoryEntry(object):
     @property
     def increment_size(self):
         try:
-            return self._repo.session_statistics[self.date].incrementfilesize
+            return self._repo.session_statistics.get(self.date, 'incrementfilesize') or 0
         except KeyError:
             return 0
 
@@ -342,10 +428,13 @@ class IncrementEntry(object):
     SUFFIXES = [b".missing", b".snapshot.gz", b".snapshot",
                 b".diff.gz", b".data.gz", b".data", b".dir", b".diff"]
 
-    def __init__(self, parent, name):
+    __slots__ = ('repo', 'name', 'date', 'filename', '_suffix')
+
+    def __init__(self, parent, name, date=None):
         """Default constructor for an increment entry. User must provide the
             repository directory and an entry name. The entry name correspond
-            to an error_log.* filename."""
+            to an error_log.* filename. The date may be provided when already
+            known (e.g.: from the catalog)."""
         assert isinstance(parent, DirEntry) or isinstance(parent, RdiffRepo)
         assert isinstance(name, bytes)
         # Keep reference to the current path.
@@ -355,8 +444,15 @@ class IncrementEntry(object):
             self.repo = parent._repo
         # The given entry name may has quote character, replace them
         self.name = name
+        # Parse the name once.
+        self._suffix = b''
+        for suffix in IncrementEntry.SUFFIXES:
+            if name.endswith(suffix):
+                self._suffix = suffix
+                break
+        self.filename = name[:len(name) - len(self._suffix)].rsplit(b".", 1)[0]
         # Calculate the date of the increment.
-        self.date = self.repo._extract_date(self.name)
+        self.date = date or self.repo._extract_date(self.name)
 
     def _open(self, mode='rb'):
         """Should be used to open the increment file. This method handle
@@ -373,17 +469,9 @@ class IncrementEntry(object):
             return b''
         return self._open().read()
 
-    @property
-    def filename(self):
-        filename = IncrementEntry._remove_suffix(self.name)
-        return filename.rsplit(b".", 1)[0]
-
     @property
     def has_suffix(self):
-        for suffix in IncrementEntry.SUFFIXES:
-            if self.name.endswith(suffix):
-                return True
-        return False
+        return bool(self._suffix)
 
     @property
     def _is_compressed(self):
@@ -391,18 +479,22 @@ class IncrementEntry(object):
 
     @property
     def isdir(self):
-        return self.name.endswith(b".dir")
+        return self._suffix == b".dir"
 
     @property
     def is_missing(self):
         """Check if the curent entry is a missing increment."""
-        return self.name.endswith(self.MISSING_SUFFIX)
+        return self._suffix == self.MISSING_SUFFIX
+
+    @property
+    def is_diff(self):
+        """Check if the current entry is a reverse diff increment."""
+        return self._suffix in (b".diff.gz", b".diff")
 
     @property
     def is_snapshot(self):
         """Check if the current entry is a snapshot increment."""
-        return (self.name.endswith(b".snapshot.gz") or
-                self.name.endswith(b".snapshot"))
+        return self._suffix in (b".snapshot.gz", b".snapshot")
 
     @staticmethod
     def _remove_suffix(filename):
@@ -424,6 +516,36 @@ class IncrementEntry(object):
         return self.name
 
 
+class DataEntry(object):
+
+    """
+    Represent one file located in rdiff-backup-data as returned by the scan
+    of the directory. The size and the date are computed lazily and cached.
+    """
+
+    __slots__ = ('_repo', '_dirent', 'name', '_date')
+
+    def __init__(self, repo, dirent):
+        self._repo = repo
+        self._dirent = dirent
+        self.name = dirent.name
+
+    @property
+    def date(self):
+        """Return the date parsed from the entry name."""
+        if not hasattr(self, '_date'):
+            self._date = self._repo._extract_date(self.name)
+        return self._date
+
+    @property
+    def size(self):
+        """Return the size in bytes of the file."""
+        try:
+            return self._dirent.stat().st_size
+        except OSError:
+            return 0
+
+
 class FileStatisticsEntry(IncrementEntry):
 
     """
@@ -434,8 +556,8 @@ class FileStatisticsEntry(IncrementEntry):
     data.
     """
 
-    def __init__(self, repo_path, name):
-        IncrementEntry.__init__(self, repo_path, name)
+    def __init__(self, repo_path, name, date=None):
+        IncrementEntry.__init__(self, repo_path, name, date)
         # check to ensure we have a file_statistics entry
         assert self.name.startswith(b"file_statistics.")
         assert self.name.endswith(b".data") or self.name.endswith(b".data.gz")
@@ -458,103 +580,382 @@ class FileStatisticsEntry(IncrementEntry):
             logger.warning("source size not found for [%r]", path, exc_info=1)
             return 0
 
-    def _search(self, path):
+    def get_source_sizes(self, paths):
+        """Return a dict of {path: SourceSize} for the given files. Resolve
+        all the paths with a single lookup of the file statistics. Size of
+        files not found are 0."""
+        try:
+            entries = self._search_all(paths)
+        except:
+            logger.warning("fail to read file statistics [%r]", self.name, exc_info=1)
+            entries = {}
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = int(entries[path]["source_size"])
+            except (KeyError, TypeError, ValueError):
+                sizes[path] = 0
+        return sizes
+
+    def _read(self):
         """
-        This function search for a file entry in the file_statistics compress
-        file. Since python gzip seams to be 2 time slower, we directly use
-        zgrep to search the file. If zgrep is not available, fallback to
-        python implementation.
+        Iterate over every entries of the file statistics. Yield tuple of
+        `(path, changed, source_size, mirror_size, increment_size)`.
         """
         logger.debug("read file_statistics [%r]", self.name)
+        for line in self._read_lines():
+            # Skip comments
+            if line.startswith(b'#'):
+                continue
+            data = line.rstrip(b'\r\n').rsplit(b' ', 4)
+            if len(data) == 5:
+                yield data
 
-        path += b' '
+    def _read_lines(self):
+        """
+        Iterate over the lines of the file statistics.
+        """
+        fullfn = os.path.join(self.repo._data_path, self.name)
+        with io.open(fullfn, 'rb') as f:
+            if not self._is_compressed:
+                for line in f:
+                    yield line
+                return
+            # Python gzip module is slow to read line by line. Inflate the
+            # data by chunk and split the lines ourself.
+            decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            remaining = b''
+            while True:
+                buf = f.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                lines = (remaining + decompress.decompress(buf)).split(b'\n')
+                remaining = lines.pop()
+                for line in lines:
+                    yield line
+            remaining += decompress.flush()
+            if remaining:
+                yield remaining
 
-        # Open file are compress.
-        if self._is_compressed:
-            line = None
-            fullfn = os.path.join(self.repo._data_path, self.name)
-            in_file = gzip.open(fullfn, 'r')
-            decompress = zlib.decompressobj(-zlib.MAX_WBITS)
-            try:
-                in_file._read_gzip_header()
+    def _search(self, path):
+        """
+        Search for a file entry in the file_statistics file. Raise KeyError
+        if the path is not found.
+        """
+        return self._search_all([path])[path]
 
-                while 1:
-                    buf = in_file.fileobj.read(CHUNK_SIZE)
-                    if not buf:
-                        break
-                    if not line:
-                        d_buf = decompress.decompress(buf)
-                    else:
-                        d_buf = line + decompress.decompress(buf)
+    def _search_all(self, paths):
+        """
+        Search for multiple file entries in the file_statistics file. Return
+        a dict of {path: entry} for every path found.
 
-                    # Search beginning of a line matching our filename
-                    for line in io.BytesIO(d_buf):
-                        if line.startswith(path):
-                            break
-            finally:
-                in_file.fileobj.close()
-                decompress = None
-        else:
-            with self._open() as f:
-                for line in f:
-                    if not line.startswith(path):
-                        continue
+        When the repository has a catalog, the lookup is done using the index
+        of the file. Otherwise, the file is read once until all the paths are
+        found.
+        """
+        result = {}
+
+        # Lookup the index.
+        catalog = self.repo._catalog
+        if catalog:
+            fullfn = os.path.join(self.repo._data_path, self.name)
+            for path in paths:
+                try:
+                    entry = catalog.file_statistic(fullfn, path, self._read)
+                except KeyError:
+                    continue
+                if entry is None:
+                    # Catalog not usable.
                     break
+                result[path] = entry
+            else:
+                return result
 
-        # Split the line into array
-        data = line.rstrip(b'\r\n').rsplit(b' ', 4)
-        # From array create an entry
-        return {
-            'changed': data[1],
-            'source_size': data[2],
-            'mirror_size': data[3],
-            'increment_size': data[4]}
+        # Fallback to a linear search.
+        remaining = set(paths) - set(result)
+        for data in self._read():
+            if data[0] not in remaining:
+                continue
+            # From array create an entry
+            result[data[0]] = {
+                'changed': data[1],
+                'source_size': data[2],
+                'mirror_size': data[3],
+                'increment_size': data[4]}
+            remaining.discard(data[0])
+            if not remaining:
+                break
+        return result
 
 
-class SessionStatisticsEntry(IncrementEntry):
+def _read_session_statistics(fn):
+    """
+    Read a session_statistics file. Return a dict of {attribute: value}.
+    """
+    data = {}
+    if fn.endswith(b".gz"):
+        f = gzip.open(fn, 'rb')
+    else:
+        f = io.open(fn, 'rb')
+    with f:
+        for line in f:
+            # Skip comments
+            if line.startswith(b"#"):
+                continue
+            # Read the line into array
+            data_line = line.rstrip(b'\r\n').split(b" ", 2)
+            if len(data_line) < 2:
+                continue
+            key = data_line[0].decode('ascii').lower()
+            value = data_line[1].decode('ascii')
+            if '.' in value:
+                value = float(value)
+            else:
+                value = int(value)
+            data[key] = value
+    return data
 
-    """Represent a single session_statistics."""
 
-    def __init__(self, repo_path, name):
-        # check to ensure we have a file_statistics entry
-        assert name.startswith(b"session_statistics")
-        assert name.endswith(b".data") or name.endswith(b".data.gz")
-        IncrementEntry.__init__(self, repo_path, name)
-
-    def _load(self):
-        """This method is used to read the session_statistics and create the
-        appropriate structure to quickly get the data.
-
-        File Statistics contains different information related to each file of
-        the backup. This class provide a simple and easy way to access this
-        data."""
-
-        with self._open('r') as f:
-            for line in f.readlines():
-                # Skip comments
-                if line.startswith("#"):
-                    continue
-                # Read the line into array
-                line = line.rstrip('\r\n')
-                data_line = line.split(" ", 2)
-                # Read line into tuple
-                (key, value) = tuple(data_line)[0:2]
-                if '.' in value:
-                    value = float(value)
-                else:
-                    value = int(value)
-                setattr(self, key.lower(), value)
+class _TeeWriter(object):
+    """
+    Write the data to the given file object and to a copy.
+    """
+
+    def __init__(self, fp, copy):
+        self.fp = fp
+        self.copy = copy
+
+    def __getattr__(self, key):
+        return getattr(self.fp, key)
+
+    def write(self, data):
+        self.fp.write(data)
+        self.copy.write(data)
+
+
+def _get_stats_pool():
+    """Return the thread pool shared to read session statistics."""
+    global _stats_pool
+    with _stats_pool_lock:
+        if _stats_pool is None:
+            _stats_pool = ThreadPool(SESSION_STATISTICS_THREADS)
+        return _stats_pool
+
+
+class _KeepOpen(object):
+    """
+    Ignore close() of the given file object. Used to keep the pipe of a
+    restore open until the restore is completed even if the archiver closes
+    its file object.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, key):
+        return getattr(self.fp, key)
+
+    def close(self):
+        pass
+
+
+def _mkdtemp():
+    """Create a temporary directory used to restore data."""
+    output = tempfile.mkdtemp(prefix='rdiffweb_restore_')
+    if isinstance(output, str):
+        output = output.encode(encoding=FS_ENCODING)
+    return output
+
+
+def _open_increment(fn):
+    """Open the given file, uncompress it if required."""
+    if fn.endswith(b'.gz'):
+        return gzip.open(fn, 'rb')
+    return io.open(fn, 'rb')
+
+
+def _patch_files(files, fdst):
+    """
+    Restore a file into `fdst` by applying each reverse diff of `files` to
+    the full content found in `files[0]`. Intermediate versions are kept in
+    memory unless they get bigger than RESTORE_SPOOL_SIZE.
+    """
+    src = _open_increment(files[0])
+    try:
+        if len(files) > 1 and files[0].endswith(b'.gz'):
+            # Patch need to seek into the basis.
+            spool = tempfile.SpooledTemporaryFile(max_size=RESTORE_SPOOL_SIZE)
+            copyfileobj(src, spool)
+            src.close()
+            src = spool
+            src.seek(0)
+        for i, fn in enumerate(files[1:], 2):
+            if i == len(files):
+                dst = fdst
+            else:
+                dst = tempfile.SpooledTemporaryFile(max_size=RESTORE_SPOOL_SIZE)
+            with _open_increment(fn) as delta:
+                librsync.patch(src, delta, dst)
+            src.close()
+            src = dst
+            if src is not fdst:
+                src.seek(0)
+        if len(files) == 1:
+            copyfileobj(src, fdst)
+    finally:
+        if src is not fdst:
+            src.close()
+
+
+class SessionStatistics(object):
+
+    """
+    Columnar store of the session statistics of a repository. Every
+    statistic is kept in a typed array ordered by date. The store is loaded
+    once and extended when new session_statistics files are found.
+    """
+
+    ATTRS = ['starttime', 'endtime', 'elapsedtime', 'sourcefiles', 'sourcefilesize',
+             'mirrorfiles', 'mirrorfilesize', 'newfiles', 'newfilesize', 'deletedfiles',
+             'deletedfilesize', 'changedfiles', 'changedsourcesize', 'changedmirrorsize',
+             'incrementfiles', 'incrementfilesize', 'totaldestinationsizechange', 'errors']
+
+    FLOAT_ATTRS = ['starttime', 'endtime', 'elapsedtime']
+
+    def __init__(self, data_path):
+        self._data_path = data_path
+        self._lock = threading.Lock()
+        # The list of DataEntry the store was last updated with.
+        self._entries = None
+        # Keep every data in a single tuple to be replaced atomically:
+        # (names, dates, {date: index}, {attr: array})
+        self._data = ([], [], {}, {attr: self._array(attr) for attr in self.ATTRS})
+
+    def __contains__(self, date):
+        return date in self._data[2]
+
+    def __len__(self):
+        return len(self._data[1])
+
+    @property
+    def dates(self):
+        """Return the list of dates, from old to new."""
+        return self._data[1]
+
+    def _array(self, attr, values=()):
+        """Return a new array to store the given statistic. Integers are kept
+        in 64 bits to not lose precision."""
+        if attr in self.FLOAT_ATTRS:
+            return array('d', values)
+        return array(_INT_TYPECODE, values)
+
+    def _cell(self, attr, values):
+        """Return the value to be stored for the given statistic."""
+        value = values.get(attr)
+        if attr in self.FLOAT_ATTRS:
+            # NaN are used for missing value.
+            return float('nan') if value is None else float(value)
+        return _INT_MISSING if value is None else int(value)
+
+    def _value(self, attr, value):
+        if attr in self.FLOAT_ATTRS:
+            return None if value != value else value
+        return None if value == _INT_MISSING else value
+
+    def column(self, attr):
+        """Return the values of the given statistic, from old to new."""
+        return [self._value(attr, v) for v in self._data[3][attr]]
+
+    def get(self, date, attr):
+        """Return the value of a statistic for the given date. Raise KeyError
+        if the date is not found. Return None if the value is unknown."""
+        unused, unused, index, columns = self._data
+        return self._value(attr, columns[attr][index[date]])
+
+    def rows(self, attrs=None, start=None, end=None):
+        """
+        Return an iterator of (date, [values]) for the given statistics.
+        If defined, only return the rows between `start` and `end` dates
+        inclusively.
+        """
+        assert start is None or isinstance(start, rdw_helpers.rdwTime)
+        assert end is None or isinstance(end, rdw_helpers.rdwTime)
+        attrs = attrs or self.ATTRS
+        unused, dates, unused, columns = self._data
+        # Compare Timestamp to use native comparison.
+        first, last = 0, len(dates)
+        if start:
+            start = rdw_helpers.Timestamp(int(start.timeInSeconds), start.tzOffset)
+            first = bisect.bisect_left(dates, start)
+        if end:
+            end = rdw_helpers.Timestamp(int(end.timeInSeconds), end.tzOffset)
+            last = bisect.bisect_right(dates, end)
+        columns = [(attr, columns[attr]) for attr in attrs]
+        for i in range(first, last):
+            yield dates[i], [self._value(attr, c[i]) for attr, c in columns]
+
+    def update(self, entries):
+        """
+        Update the store with the given list of DataEntry. Read only the
+        files not already loaded.
+        """
+        if entries is self._entries:
+            return
+        with self._lock:
+            if entries is self._entries:
+                return
+            known = set(self._data[0])
+            current = set(e.name for e in entries)
+            new = [e for e in entries if e.name not in known and e.date is not None]
+            removed = not known.issubset(current)
+            if new or removed:
+                self._data = self._merge(new, current if removed else None)
+            self._entries = entries
+
+    def _read(self, entries):
+        """Read the given entries, in parallel if there is many."""
+        def read(e):
+            try:
+                return _read_session_statistics(os.path.join(self._data_path, e.name))
+            except:
+                logger.warning("fail to read session statistics [%r]", e.name, exc_info=1)
+                return {}
+        if len(entries) <= SESSION_STATISTICS_THREADS:
+            return [read(e) for e in entries]
+        return _get_stats_pool().map(read, entries)
 
-    def __getattr__(self, name):
+    def _merge(self, new, keep=None):
         """
-        Intercept attribute getter to load the file.
+        Return a new data tuple with the new entries. If `keep` is defined,
+        only keep the existing rows with these names.
         """
-        if name in ['starttime', 'endtime', 'elapsedtime', 'sourcefiles', 'sourcefilesize',
-                    'mirrorfiles', 'mirrorfilesize', 'newfiles', 'newfilesize', 'deletedfiles',
-                    'deletedfilesize', 'changedfiles', 'changedsourcesize', 'changedmirrorsize',
-                    'incrementfiles', 'incrementfilesize', 'totaldestinationsizechange', 'errors']:
-            self._load()
-        return self.__dict__[name]
+        names, dates, unused, columns = self._data
+        new = sorted(new, key=lambda e: e.date)
+        values = self._read(new)
+        if keep is None and (not dates or (new and new[0].date > dates[-1])):
+            # Append new rows.
+            names = names + [e.name for e in new]
+            dates = dates + [e.date for e in new]
+            columns = {
+                attr: columns[attr] + self._array(attr, [self._cell(attr, v) for v in values])
+                for attr in self.ATTRS}
+        else:
+            # Sort every rows by date.
+            rows = [
+                (dates[i], names[i], [columns[attr][i] for attr in self.ATTRS])
+                for i in range(len(names))
+                if keep is None or names[i] in keep]
+            rows.extend(
+                (e.date, e.name, [self._cell(attr, v) for attr in self.ATTRS])
+                for e, v in zip(new, values))
+            rows.sort(key=lambda r: r[0])
+            names = [r[1] for r in rows]
+            dates = [r[0] for r in rows]
+            columns = {
+                attr: self._array(attr, [r[2][i] for r in rows])
+                for i, attr in enumerate(self.ATTRS)}
+        index = {d: i for i, d in enumerate(dates)}
+        return (names, dates, index, columns)
 
 
 @python_2_unicode_compatible
@@ -562,7 +963,7 @@ class RdiffRepo(object):
 
     """Represent one rdiff-backup repository."""
 
-    def __init__(self, user_root, path):
+    def __init__(self, user_root, path, cache_dir=None, pool=None):
         if isinstance(user_root, str):
             user_root = encodefilename(user_root)
         if isinstance(path, str):
@@ -580,23 +981,53 @@ class RdiffRepo(object):
         self._increment_path = os.path.join(self._data_path, INCREMENTS)
         self._hint_file = os.path.join(self._data_path, RDIFFWEB_CONF)
 
+        # Cache of the dates parsed from the filenames.
+        self._dates = {}
+
+        # The object is shared between requests by the RepoCache. Protect
+        # the data loaded lazily. Each value is assigned once completed.
+        self._lock = threading.RLock()
+
+        # Incremented every time rdiffweb modifies the repository to let the
+        # RepoCache know the object is no longer valid.
+        self.generation = 0
+
+        # Pool of rdiff-backup workers used by execute().
+        self._pool = pool
+
         # Check if the object is valid.
         self._check()
 
         # Check if the repository has hint for rdiffweb.
         self._load_hints()
 
+        # Use a persistent catalog if a cache directory is defined.
+        self._catalog = None
+        if cache_dir:
+            self._catalog = Catalog(
+                catalog_filename(cache_dir, self.full_path),
+                parse=self._parse_name,
+                date_factory=rdw_helpers.Timestamp)
+
     @property
     def backup_dates(self):
         """Return a list of dates when backup was executed. This list is
         sorted from old to new (ascending order). To identify dates,
         'mirror_metadata' file located in rdiff-backup-data are used."""
         if not hasattr(self, '_backup_dates'):
-            logger.debug("get backup dates for [%r]", self.full_path)
-            self._backup_dates = sorted([
-                self._extract_date(x)
-                for x in self._data_entries
-                if x.startswith(b"mirror_metadata")])
+            with self._lock:
+                if not hasattr(self, '_backup_dates'):
+                    logger.debug("get backup dates for [%r]", self.full_path)
+                    entries = self._catalog and self._catalog.list(self._data_path)
+                    if entries is not None:
+                        self._backup_dates = sorted([
+                            x.date
+                            for x in entries
+                            if x.name.startswith(b"mirror_metadata") and x.date])
+                    else:
+                        self._backup_dates = sorted([
+                            x.date
+                            for x in self._data_entries[b"mirror_metadata"]])
         return self._backup_dates
 
     def _check(self):
@@ -609,12 +1040,40 @@ class RdiffRepo(object):
 
     @property
     def _data_entries(self):
-        return os.listdir(self._data_path)
+        """
+        Return a dict of {prefix: [DataEntry]} representing the content of
+        rdiff-backup-data. The directory is scanned only once and the result
+        is shared by every accessor. Only the entries matching one of
+        DATA_PREFIXES are kept.
+        """
+        if not hasattr(self, '_data_entries_data'):
+            with self._lock:
+                if not hasattr(self, '_data_entries_data'):
+                    logger.debug("scan data directory of [%r]", self.full_path)
+                    data = {prefix: [] for prefix in DATA_PREFIXES}
+                    repo = weakref.proxy(self)
+                    for dirent in rdw_helpers.scandir(self._data_path):
+                        bucket = data.get(dirent.name.split(b".", 1)[0])
+                        if bucket is not None:
+                            bucket.append(DataEntry(repo, dirent))
+                    for bucket in data.values():
+                        bucket.sort(key=lambda x: x.name)
+                    self._data_entries_data = data
+        return self._data_entries_data
+
+    def changed(self):
+        """
+        Called after modifying the repository, e.g.: by executing
+        rdiff-backup. The RepoCache creates a new object on next access.
+        """
+        with self._lock:
+            self.generation += 1
 
     def delete(self):
         """Delete the repository permanently."""
         # Not sure if error should be ignored.
         shutil.rmtree(self.full_path)
+        self.changed()
 
     @property
     def display_name(self):
@@ -633,17 +1092,21 @@ class RdiffRepo(object):
     def _error_logs(self):
         """Return dict of {date: IncrementEntry} to represent each file statistics."""
         if not hasattr(self, '_error_logs_data'):
-            self._error_logs_data = {
-                self._extract_date(x): IncrementEntry(self, x)
-                for x in self._data_entries
-                if x.startswith(b"error_log.")}
+            with self._lock:
+                if not hasattr(self, '_error_logs_data'):
+                    self._error_logs_data = {
+                        x.date: IncrementEntry(self, x.name, x.date)
+                        for x in self._data_entries[b"error_log"]}
         return self._error_logs_data
 
-    def execute(self, *args):
+    def execute(self, *args, **kwargs):
         """
-        Execute rdiff-backup command.
+        Execute rdiff-backup command. If a CancelToken is provided with
+        `cancel`, the process is killed when the token is cancelled and
+        CancelledError is raised.
         """
         assert all(isinstance(arg, bytes) for arg in args)
+        cancel = kwargs.pop('cancel', None)
         # Need to explicitly export some environment variable. Do not export
         # all of them otherwise it also export some python environment variable
         # and might brake rdiff-backup execution.
@@ -651,46 +1114,85 @@ class RdiffRepo(object):
         if os.environ.get('TMPDIR'):
             env['TMPDIR'] = os.environ['TMPDIR']
 
-        parms = [b'rdiff-backup']
-        parms.extend(args)
-        execution = subprocess.Popen(
-            parms, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env)
-
+        # Use a long-lived worker if available.
         results = {}
-        output, error = execution.communicate()
-        results['exitCode'] = execution.wait()
+        try:
+            result = self._pool and self._pool.execute(args, env=env, cancel=cancel)
+        except WorkerError as e:
+            raise ExecuteError(str(e))
+        if result:
+            results['exitCode'], output, error = result
+        else:
+            parms = [b'rdiff-backup']
+            parms.extend(args)
+            execution = subprocess.Popen(
+                parms, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env)
+
+            if cancel:
+                cancel.add_callback(execution.kill)
+            try:
+                output, error = execution.communicate()
+                results['exitCode'] = execution.wait()
+            finally:
+                if cancel:
+                    cancel.remove_callback(execution.kill)
+        if cancel:
+            cancel.check()
         if results['exitCode'] != 0:
             error = error.decode(encoding=sys.getdefaultencoding(), errors='replace')
             raise ExecuteError(error)
 
         return (output, error)
 
+    def _parse_name(self, name):
+        """
+        Return the filename and the date of an entry located in
+        rdiff-backup-data. Used to populate the catalog.
+        """
+        filename = IncrementEntry._remove_suffix(name)
+        if filename == name:
+            # Not an rdiff-backup increment.
+            return (None, None)
+        return (filename.rsplit(b".", 1)[0], self._extract_date(name))
+
     def _extract_date(self, filename):
         """
-        Extract date from rdiff-backup filenames.
+        Extract date from rdiff-backup filenames. Since many increments share
+        the same date, the parsed values are cached.
         """
         # Remove suffix from filename
         filename = IncrementEntry._remove_suffix(filename)
         # Remove prefix from filename
         date_string = filename.rsplit(b".", 1)[-1]
+        try:
+            return self._dates[date_string]
+        except KeyError:
+            pass
         # Unquote string
-        date_string = self.unquote(date_string)
+        value = self.unquote(date_string)
         try:
-            return rdw_helpers.rdwTime(date_string.decode())
+            value = rdw_helpers.Timestamp.parse(value.decode())
         except:
-            logger.warn('fail to parse date [%r]', date_string, exc_info=1)
-            return None
+            logger.warn('fail to parse date [%r]', value, exc_info=1)
+            value = None
+        with self._lock:
+            self._dates[date_string] = value
+        return value
 
     @property
     def _file_statistics(self):
         """Return dict of {date: filename} to represent each file statistics."""
         if not hasattr(self, '_file_statistics_data'):
-            self._file_statistics_data = {
-                self._extract_date(x): x
-                for x in self._data_entries
-                if x.startswith(b"file_statistics.")}
+            with self._lock:
+                if not hasattr(self, '_file_statistics_data'):
+                    # Prefer the uncompressed file if both exists for the
+                    # same date.
+                    data = {}
+                    for x in self._data_entries[b"file_statistics"]:
+                        data.setdefault(x.date, x)
+                    self._file_statistics_data = data
         return self._file_statistics_data
 
     def get_encoding(self):
@@ -711,7 +1213,7 @@ class RdiffRepo(object):
         try:
             value = self._file_statistics[date]
             if not isinstance(value, FileStatisticsEntry):
-                entry = FileStatisticsEntry(self, value)
+                entry = FileStatisticsEntry(self, value.name, value.date)
                 self._file_statistics[date] = entry
                 return entry
             return self._file_statistics[date]
@@ -734,35 +1236,43 @@ class RdiffRepo(object):
 
         logger.debug("get history entries for [%r]", self.full_path)
 
-        entries = []
-        # Take care of reverse
-        backup_dates = reversed(self.backup_dates) if reverse else self.backup_dates
-        # Loop to dates
-        for backup_date in backup_dates:
-            # compare local times because of discrepancy between client/server
-            # time zones
-            if earliestDate and backup_date < earliestDate:
-                continue
-
-            if latestDate and backup_date > latestDate:
-                continue
-
-            entries.append(HistoryEntry(self, backup_date))
+        # Backup dates are sorted, use bisect to find the range of dates.
+        # Compare Timestamp to use native comparison.
+        backup_dates = self.backup_dates
+        start, end = 0, len(backup_dates)
+        if earliestDate:
+            earliestDate = rdw_helpers.Timestamp(int(earliestDate.timeInSeconds), earliestDate.tzOffset)
+            start = bisect.bisect_left(backup_dates, earliestDate)
+        if latestDate:
+            latestDate = rdw_helpers.Timestamp(int(latestDate.timeInSeconds), latestDate.tzOffset)
+            end = bisect.bisect_right(backup_dates, latestDate)
+        backup_dates = backup_dates[start:end]
 
-            if numLatestEntries != -1 and len(entries) == numLatestEntries:
-                return entries
-
-        return entries
+        # Take care of reverse
+        if reverse:
+            backup_dates.reverse()
+        if numLatestEntries > 0:
+            backup_dates = backup_dates[:numLatestEntries]
+        return [HistoryEntry(self, d) for d in backup_dates]
 
-    def _get_increment_entries(self, path):
+    def _get_increment_entries(self, path, filename=None):
         """
         Get the increment entries for the current path. This path is located
-        under rdiff-backup-data/increments.
+        under rdiff-backup-data/increments. If `filename` is defined, only
+        return the increments of this file.
         """
         # Compute increment directory location.
         p = os.path.join(self._increment_path, path.strip(b'/'))
         assert p.startswith(self.full_path)
 
+        # Read the increments from the catalog if available.
+        entries = self._catalog and self._catalog.list(p, filename)
+        if entries is not None:
+            return [
+                IncrementEntry(self, x.name, date=x.date)
+                for x in entries
+                if not x.isdir]
+
         # Check if increment directory exists. The path may not exists if
         # the folder always exists and never changed.
         if not os.access(p, os.F_OK):
@@ -771,9 +1281,11 @@ class RdiffRepo(object):
         # List content of the increment directory.
         # Ignore sub-directories.
         entries = [
-            IncrementEntry(self, x)
-            for x in os.listdir(p)
-            if not os.path.isdir(os.path.join(p, x))]
+            IncrementEntry(self, x.name)
+            for x in rdw_helpers.scandir(p)
+            if not x.is_dir()]
+        if filename is not None:
+            entries = [e for e in entries if e.filename == filename]
         return entries
 
     def get_path(self, path):
@@ -797,8 +1309,7 @@ class RdiffRepo(object):
         # Check if path exists or has increment. If not raise an exception.
         exists = os.path.exists(p)
         fn = os.path.basename(p)
-        increments = [e for e in self._get_increment_entries(os.path.dirname(path))
-                      if e.filename == fn]
+        increments = self._get_increment_entries(os.path.dirname(path), fn)
         if not exists and not increments:
             logger.error("path [%r] doesn't exists", path)
             raise DoesNotExistError(path)
@@ -829,8 +1340,19 @@ class RdiffRepo(object):
             self._encoding = encodings.search_function(FS_ENCODING)
         assert self._encoding
 
-    def restore(self, path, restore_date, kind='zip'):
-        """Used to restore the given file located in this path."""
+    def restore(self, path, restore_date, kind='zip', executor=None, user=None, cache=None, flights=None,
+                progress=None, archive_options=None):
+        """
+        Used to restore the given file located in this path. If defined,
+        the restore is executed by the given `RestoreExecutor` on behalf of
+        `user`. Raise QueueFullError if the executor doesn't accept more
+        restores. If defined, the result is read from and written to the
+        given `RestoreCache`. If defined, identical restores in progress
+        are shared using the given `RestoreFlights`. If defined, the state
+        of the restore is reported to the given `RestoreProgress`.
+        `archive_options` is a dict of options passed to the archiver, i.e.:
+        `threads`, `level`, `threshold` and `bufsize`.
+        """
         assert isinstance(path, bytes) or isinstance(path, DirEntry)
         assert isinstance(restore_date, rdw_helpers.rdwTime) or isinstance(restore_date, int)
         assert kind in ARCHIVERS
@@ -851,8 +1373,11 @@ class RdiffRepo(object):
         # Convert the date into epoch.
         if isinstance(restore_date, rdw_helpers.rdwTime):
             restore_date = restore_date.getSeconds()
+        # Increments are compared with the date of the restored backup.
+        restore_date = self._get_backup_date(restore_date)
 
         # Define a nice filename for the archive or file to be created.
+        entry = entry or self.get_path(path)
         if path == b"":
             filename = "%s.%s" % (self.display_name, kind)
         else:
@@ -862,89 +1387,476 @@ class RdiffRepo(object):
             # Decode string as repo encoding.
             filename = self._decode(filename_b)
             # Append archive extention if a directory
-            entry = entry or self.get_path(path)
-            if entry and entry.isdir:
+            if entry.isdir:
                 filename = filename + '.' + kind
 
+        # When the data didn't change since the requested date, serve it
+        # directly from the mirror without running rdiff-backup.
+        if progress:
+            progress.estimate = lambda: self._estimate_restore(entry, restore_date)
+
+        current = self._is_current(entry, restore_date)
+        if current and not entry.isdir:
+            logger.info("restore [%r] from mirror", entry.full_path)
+            if progress:
+                progress.add_file(entry.full_path)
+                progress.set_phase(RestoreProgress.DONE)
+            return filename, io.open(entry.full_path, 'rb')
+
+        # Serve the result of a previous restore.
+        kind_key = kind if entry.isdir else ''
+        if cache:
+            cached = cache.open(self.full_path, path, restore_date, kind_key)
+            if cached:
+                logger.info("restore [%r] from cache", entry.full_path)
+                if progress:
+                    progress.set_phase(RestoreProgress.DONE)
+                return filename, cached
+
+        # Follow the output of an identical restore in progress.
+        reader = None
+        if flights:
+            flight, reader = flights.acquire((self.full_path, path, restore_date, kind_key), progress)
+            if flight is None:
+                logger.info("restore [%r] already in progress", entry.full_path)
+                if progress and reader.flight.progress:
+                    progress.follow(reader.flight.progress)
+                return filename, reader
+
+        try:
+            return filename, self._start_restore(
+                entry, file_to_restore, restore_date, kind, current, executor, user,
+                cache.create(self.full_path, path, restore_date, kind_key) if cache else None,
+                reader, progress, archive_options)
+        except:
+            if reader:
+                reader.close()
+                reader.flight.close()
+            if progress:
+                progress.set_phase(RestoreProgress.FAILED)
+            raise
+
+    def _start_restore(self, entry, file_to_restore, restore_date, kind, current, executor, user, cache_file,
+                       reader, progress, archive_options=None):
+        """
+        Select the fastest way to restore the given entry and start it.
+        `restore_date` is the date of the restored backup (epoch).
+        """
+        # Options passed to the archiver.
+        options = dict(archive_options or {})
+        options['callback'] = progress.add_file if progress else None
+        if current:
+            return self._restore_async(
+                lambda fdst, cancel: self._archive_mirror(entry, fdst, kind, **options),
+                executor, user, cache_file, reader, progress,
+                length=self._archive_mirror_size(entry, kind, **options))
+
+        # Restore a regular file by applying the increments ourself.
+        files = self._get_restore_files(entry, restore_date)
+        if files:
+            logger.info("restore [%r] from increments", entry.full_path)
+            return self._restore_async(
+                lambda fdst, cancel: _patch_files(files, fdst), executor, user, cache_file, reader, progress)
+
+        # Restore a directory one child at a time to start streaming the
+        # archive before the whole tree is restored. Archive the children
+        # that didn't change from the mirror.
+        chunks = self._get_restore_chunks(entry, restore_date)
+        if chunks:
+            logger.info("restore [%r] by chunks", entry.full_path)
+            return self._restore_async(
+                lambda fdst, cancel: self._restore_chunks(entry, chunks, restore_date, fdst, kind, cancel, **options),
+                executor, user, cache_file, reader, progress)
+
         # Generate a temporary location used to restore data.
-        output = tempfile.mkdtemp(prefix='rdiffweb_restore_')
-        if isinstance(output, str):
-            output = output.encode(encoding=FS_ENCODING)
+        output = _mkdtemp()
 
         # Asynchronously create an archive if multiple file.
-        def _async(fdst):
+        def _async(fdst, cancel):
             try:
-                # Change thread name
-                threading.currentThread().name = 'Restore' + threading.currentThread().name
-
-                # Execute rdiff-backup to restore the data.
-                logger.info("execute rdiff-backup --restore-as-of=%s %r %r", restore_date, file_to_restore, output)
-                try:
-                    self.execute(
-                        b"--restore-as-of=" + str(restore_date).encode(encoding='latin1'),
-                        file_to_restore,
-                        output)
-                except ExecuteError:
-                    raise UnknownError('unable to restore')
-                logger.debug("restored locally completed")
-
-                # Check the result
-                if not os.access(output, os.F_OK):
-                    error = '''rdiff-backup claimed success, but did not restore
-                            anything. This indicates a bug in rdiffweb. Please
-                            report this to a developer.'''
-                    raise UnknownError(error)
+                self._execute_restore(file_to_restore, output, restore_date, cancel)
 
                 # Archive data or pipe data.
                 if os.path.isdir(output):
-                    archive(output, fdst, kind=kind, encoding=self.get_encoding())
+                    archive(output, fdst, kind=kind, encoding=self.get_encoding(), **options)
                 else:
                     # Pipe the content of the file.
                     with io.open(output, 'rb') as fsrc:
                         copyfileobj(fsrc, fdst)
                 logger.debug("restore completed")
-            except:
-                logger.error('restore failed', exc_info=1)
             finally:
-                # Make sure to close pipe.
-                fdst.close()
                 # Clean up temp file or dir.
                 if os.path.isdir(output):
                     shutil.rmtree(output, ignore_errors=True)
                 elif os.path.exists(output):
                     os.remove(output)
 
-        # Start new thread.
-        rfd, wfd = os.pipe()
-        r = io.open(rfd, 'rb')
-        w = io.open(wfd, 'wb')
         try:
-            thread = threading.Thread(target=_async, args=(w,))
-            thread.start()
+            return self._restore_async(_async, executor, user, cache_file, reader, progress)
+        except:
+            shutil.rmtree(output, ignore_errors=True)
+            raise
+
+    def _execute_restore(self, file_to_restore, output, restore_date, cancel):
+        """
+        Execute rdiff-backup to restore `file_to_restore` into `output`.
+        """
+        logger.info("execute rdiff-backup --restore-as-of=%s %r %r", restore_date, file_to_restore, output)
+        try:
+            self.execute(
+                b"--restore-as-of=" + str(restore_date).encode(encoding='latin1'),
+                file_to_restore,
+                output,
+                cancel=cancel)
+        except ExecuteError:
+            raise UnknownError('unable to restore')
+        logger.debug("restored locally completed")
+
+        # Check the result
+        if not os.access(output, os.F_OK):
+            error = '''rdiff-backup claimed success, but did not restore
+                    anything. This indicates a bug in rdiffweb. Please
+                    report this to a developer.'''
+            raise UnknownError(error)
+
+    def _exists_at(self, entry, restore_date):
+        """
+        Check if the given entry exists at the given backup date (epoch).
+        The state is defined by the first increment at or after that date or
+        by the mirror.
+        """
+        for increment in entry._increments:
+            if not increment.has_suffix or increment.date.getSeconds() < restore_date:
+                continue
+            return not increment.is_missing
+        return entry.exists
+
+    def _get_changed_dirs(self, path, restore_date):
+        """
+        Return the set of directories under `path` (included) with
+        increments created at or after the given backup date (epoch) in their
+        content. Read the increments tree or the catalog if available.
+        """
+        changed = set()
+        stack = [path]
+        while stack:
+            d = stack.pop()
+            p = os.path.join(self._increment_path, d)
+            entries = self._catalog and self._catalog.list(p)
+            if entries is not None:
+                entries = [(e.name, e.isdir, e.date) for e in entries]
+            elif os.path.isdir(p):
+                entries = [(e.name, e.is_dir(), None) for e in rdw_helpers.scandir(p)]
+            else:
+                entries = []
+            for name, isdir, date in entries:
+                if isdir:
+                    stack.append(os.path.join(d, name))
+                    continue
+                date = date or self._extract_date(name)
+                if date is None or date.getSeconds() < restore_date:
+                    continue
+                # Mark the directory and its parents as changed.
+                while d not in changed:
+                    changed.add(d)
+                    if d == path:
+                        break
+                    d = os.path.dirname(d)
+        return changed
+
+    def _get_restore_chunks(self, entry, restore_date):
+        """
+        Split the restore of the given directory content at the given
+        backup date (epoch). Return a list of (child, mode) where mode is
+        one of:
+         * RESTORE_MIRROR: archive the child from the mirror,
+         * RESTORE_DIR: archive the directory itself from the mirror, its
+           content follows,
+         * RESTORE_EXECUTE: restore the child with rdiff-backup.
+        Return None to restore the directory at once.
+        """
+        if not entry.isdir or not entry.exists:
+            return None
+        if os.path.realpath(entry.full_path) != os.path.normpath(entry.full_path):
+            return None
+        changed = self._get_changed_dirs(entry.path, restore_date)
+        chunks = []
+
+        def _split(parent):
+            children = [c for c in parent.dir_entries if self._exists_at(c, restore_date)]
+            for child in sorted(children, key=lambda c: c.path):
+                # When the child and its content didn't change, use the mirror.
+                unchanged = (
+                    child.exists and
+                    all(i.date.getSeconds() < restore_date for i in child._increments))
+                realdir = unchanged and os.path.isdir(child.full_path) and not os.path.islink(child.full_path)
+                if unchanged and (not realdir or child.path not in changed):
+                    chunks.append((child, RESTORE_MIRROR))
+                elif realdir:
+                    # The directory itself didn't change, split its content.
+                    chunks.append((child, RESTORE_DIR))
+                    _split(child)
+                else:
+                    chunks.append((child, RESTORE_EXECUTE))
+
+        _split(entry)
+        executions = sum(1 for unused, mode in chunks if mode == RESTORE_EXECUTE)
+        if executions > RESTORE_MAX_CHUNKS:
+            return None
+        if executions == len(chunks) < 2:
+            # Nothing to gain.
+            return None
+        return chunks
+
+    def _restore_chunks(self, entry, chunks, restore_date, fdst, kind, cancel, **kwargs):
+        """
+        Restore the given chunks one at a time and add each of them to the
+        archive as soon as restored. The disk space used is bounded by the
+        biggest chunk restored with rdiff-backup. `kwargs` are passed to the
+        archive.
+        """
+        output = _mkdtemp()
+        try:
+            a = Archive(fdst, encoding=self.get_encoding(), kind=kind, **kwargs)
+            for child, mode in chunks:
+                # Name relative to the restored directory.
+                arcname = self.unquote(child.path[len(entry.path):].lstrip(b'/'))
+                if mode == RESTORE_MIRROR:
+                    cancel.check()
+                    a.add(child.full_path, arcname, rename=self.unquote)
+                    continue
+                if mode == RESTORE_DIR:
+                    a.add(child.full_path, arcname, recursive=False)
+                    continue
+                dest = os.path.join(output, os.path.basename(arcname))
+                self._execute_restore(
+                    self.unquote(child.full_path), dest, restore_date, cancel)
+                a.add(dest, arcname)
+                if os.path.isdir(dest) and not os.path.islink(dest):
+                    shutil.rmtree(dest, ignore_errors=True)
+                else:
+                    os.remove(dest)
+            a.close()
+            logger.debug("restore completed")
+        finally:
+            shutil.rmtree(output, ignore_errors=True)
+
+    def _estimate_restore(self, entry, restore_date):
+        """
+        Return a tuple (files, bytes) estimating the size of the given entry
+        at the given date (epoch) from the statistics of the backup.
+        """
+        if not entry.isdir:
+            return 1, entry.file_size
+        # Statistics are indexed by backup date.
+        date = rdw_helpers.Timestamp(restore_date)
+        if entry.path == b'':
+            return (
+                self.session_statistics.get(date, 'sourcefiles'),
+                self.session_statistics.get(date, 'sourcefilesize'))
+        stats = self.get_file_statistic(date)
+        if not stats:
+            return None, None
+        # File stats uses unquoted name.
+        prefix = self.unquote(entry.path) + b'/'
+        files = size = 0
+        for data in stats._read():
+            if data[0].startswith(prefix):
+                files += 1
+                if data[2].isdigit():
+                    size += int(data[2])
+        return files, size
+
+    def _get_backup_date(self, restore_date):
+        """
+        Return the date (epoch) of the backup restored at the given date:
+        like rdiff-backup, the last backup at or before it.
+        """
+        dates = self.backup_dates
+        index = bisect.bisect_right(dates, rdw_helpers.Timestamp(restore_date)) - 1
+        if index < 0:
+            return restore_date
+        return dates[index].getSeconds()
+
+    def _is_current(self, entry, restore_date):
+        """
+        Check if the data found in the mirror is the same as the data at
+        the given backup date (epoch). It's the case when the restore date
+        is the last backup or, for a file, when no increment was created at
+        or after it.
+        The mirror is not used while a backup is in progress or after an
+        interrupted backup since it may be partially updated.
+        """
+        if not entry.exists:
+            return False
+        if self.status[0] != 'ok':
+            return False
+        # Let rdiff-backup restore symlinks.
+        if os.path.realpath(entry.full_path) != os.path.normpath(entry.full_path):
+            return False
+        if self.last_backup_date and restore_date >= self.last_backup_date.getSeconds():
+            return True
+        # Increments of a directory don't tell if its content changed.
+        if entry.isdir:
+            return False
+        if not os.path.isfile(entry.full_path):
+            return False
+        return all(i.date.getSeconds() < restore_date for i in entry._increments)
+
+    def _get_restore_files(self, entry, restore_date):
+        """
+        Return the list of files required to restore a regular file at the
+        given backup date (epoch): the full content (mirror or snapshot) followed
+        by the reverse diffs to apply. Return None if rdiff-backup is
+        required. Follow rdiff-backup `RestoreFile.set_relevant_incs()`.
+        """
+        if entry.isdir:
+            return None
+        # Select the increments newer than the restore date up to the first
+        # increment that is not a diff. e.g.: a snapshot.
+        relevant = []
+        for increment in entry._increments:
+            if increment.date.getSeconds() < restore_date:
+                continue
+            relevant.append(increment)
+            if not increment.is_diff:
+                break
+        if not relevant or relevant[-1].is_diff:
+            # Use the mirror as base. Let rdiff-backup handle special files.
+            if (not entry.exists or
+                    not os.path.isfile(entry.full_path) or
+                    os.path.realpath(entry.full_path) != os.path.normpath(entry.full_path)):
+                return None
+            base = entry.full_path
+            diffs = relevant
+        elif relevant[-1].is_snapshot:
+            base = os.path.join(self._increment_path, os.path.dirname(entry.path), relevant[-1].name)
+            if os.path.islink(base) or not os.path.isfile(base):
+                return None
+            diffs = relevant[:-1]
+        else:
+            # Missing or directory increment.
+            return None
+        increment_dir = os.path.join(self._increment_path, os.path.dirname(entry.path))
+        return [base] + [os.path.join(increment_dir, i.name) for i in reversed(diffs)]
+
+    def _archive_mirror(self, entry, fdst, kind, **kwargs):
+        """
+        Archive the given directory entry directly from the mirror.
+        `kwargs` are passed to the archiver.
+        """
+        logger.info("archive [%r] from mirror", entry.full_path)
+        archive(
+            entry.full_path, fdst, kind=kind, encoding=self.get_encoding(),
+            exclude=[RDIFF_BACKUP_DATA] if entry.path == b'' else None,
+            rename=self.unquote, **kwargs)
+
+    def _archive_mirror_size(self, entry, kind, **kwargs):
+        """
+        Return the exact size of the archive created by `_archive_mirror()`
+        or None if unknown before the data is compressed. The tree is
+        walked in the request thread, so the size of large trees is not
+        computed.
+        """
+        return archive_size(
+            entry.full_path, kind=kind, encoding=self.get_encoding(),
+            exclude=[RDIFF_BACKUP_DATA] if entry.path == b'' else None,
+            rename=self.unquote, max_files=RESTORE_LENGTH_MAX_FILES, **kwargs)
+
+    def _restore_async(self, func, executor=None, user=None, cache_file=None, reader=None, progress=None,
+                       length=None):
+        """
+        Call `func` with the write end of a pipe and a CancelToken, using
+        the executor if defined or a new thread. Return the read end of the
+        pipe. Closing it cancels the restore. If defined, the data is also
+        written to `cache_file` and committed when completed. If defined,
+        the data is written to the in-flight restore of the given `reader`
+        instead of a pipe and the reader is returned. If defined, the
+        phase and the bytes written are reported to `progress`. If defined,
+        `length` is the exact size of the data, exposed to the client by the
+        `length` attribute of the returned stream.
+        """
+        cancel = reader.flight.token if reader else CancelToken()
+
+        def _async(fdst):
+            completed = False
+            phase = RestoreProgress.FAILED
+            try:
+                # The client may be gone while the restore was queued.
+                cancel.check()
+                w = _KeepOpen(fdst)
+                if cache_file:
+                    w = _TeeWriter(w, cache_file)
+                if progress:
+                    progress.set_phase(RestoreProgress.RESTORING)
+                    w = _ProgressWriter(w, progress)
+                func(w, cancel)
+                completed = True
+                phase = RestoreProgress.DONE
+            except CancelledError:
+                logger.info('restore cancelled')
+                phase = RestoreProgress.CANCELLED
+            except:
+                logger.error('restore failed', exc_info=1)
+            finally:
+                if progress:
+                    progress.set_phase(phase)
+                # Commit the cache before closing the pipe so the restore is
+                # available once the client reaches the end of the stream.
+                if cache_file and completed:
+                    cache_file.commit()
+                elif cache_file:
+                    cache_file.discard()
+                # Make sure to close pipe.
+                fdst.close()
+
+        def _thread(fdst):
+            # Change thread name
+            threading.currentThread().name = 'Restore' + threading.currentThread().name
+            _async(fdst)
+
+        if reader:
+            r, w = reader, reader.flight
+            w.length = length
+        else:
+            rfd, wfd = os.pipe()
+            r = CancellableReader(io.open(rfd, 'rb'), cancel, length)
+            w = CancellableWriter(io.open(wfd, 'wb'), cancel)
+        try:
+            if executor:
+                executor.submit(lambda: _async(w), user)
+            else:
+                # Start new thread.
+                thread = threading.Thread(target=_thread, args=(w,))
+                thread.start()
             # Return one of a stream.
-            return filename, r
+            return r
         except Exception as e:
             # If creation of thread fail, close pipe.
             r.close()
             w.close()
+            if cache_file:
+                cache_file.discard()
+            if progress:
+                progress.set_phase(RestoreProgress.FAILED)
             # Then re-raise issue
-            logger.error('fail to create new thread', exc_info=1)
+            if not isinstance(e, QueueFullError):
+                logger.error('fail to start restore', exc_info=1)
             raise e
 
     @property
     def status(self):
         """Check if a backup is in progress for the current repo."""
         # Filter the files to keep current_mirror.* files
-        current_mirrors = [
-            x
-            for x in self._data_entries
-            if x.startswith(b"current_mirror.")]
+        current_mirrors = self._data_entries[b"current_mirror"]
 
         pid_re = re.compile(b"^PID\s*([0-9]+)", re.I | re.M)
 
         def extract_pid(current_mirror):
             """Return process ID from a current mirror marker, if any"""
-            entry = IncrementEntry(self, current_mirror)
+            if not current_mirror.size:
+                return None
+            entry = IncrementEntry(self, current_mirror.name, current_mirror.date)
             match = pid_re.search(entry.read())
             if not match:
                 return None
@@ -970,16 +1882,27 @@ class RdiffRepo(object):
 
     @property
     def session_statistics(self):
-        """Return list of IncrementEntry to represent each sessions
-        statistics."""
+        """Return the SessionStatistics of this repository."""
         if not hasattr(self, '_session_statistics_data'):
-            data = (
-                SessionStatisticsEntry(self, x)
-                for x in sorted(self._data_entries)
-                if x.startswith(b"session_statistics."))
-            self._session_statistics_data = OrderedDict([(x.date, x) for x in data])
+            with self._lock:
+                if not hasattr(self, '_session_statistics_data'):
+                    self._session_statistics_data = SessionStatistics(self._data_path)
+        self._session_statistics_data.update(self._data_entries[b"session_statistics"])
         return self._session_statistics_data
 
+    def reuse(self, repo):
+        """
+        Reuse the data of `repo`, a previous object representing the same
+        repository, which remains valid when new backups are made: the
+        parsed dates and the session statistics. The session statistics
+        then only get updated with the new sessions.
+        """
+        assert isinstance(repo, RdiffRepo)
+        assert repo.full_path == self.full_path
+        self._dates = repo._dates
+        if hasattr(repo, '_session_statistics_data'):
+            self._session_statistics_data = repo._session_statistics_data
+
     def set_encoding(self, name):
         """
         Change the encoding of the repository.
@@ -996,6 +1919,7 @@ class RdiffRepo(object):
         config = Configuration(self._hint_file)
         config.set_config('encoding', name)
         config.save()
+        self.changed()
         # Also update current encoding.
         self._encoding = encoding
 
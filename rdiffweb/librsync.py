@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pure python implementation of librsync patch used to apply the reverse
+diffs (.diff.gz increments) created by rdiff-backup.
+
+A delta starts with a magic number followed by a list of commands. Each
+command either insert literal data found in the delta or copy a range of
+the basis file. All integers are big-endian.
+"""
+
+from __future__ import unicode_literals
+
+from builtins import object
+import logging
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+# Read and write data by chunks.
+CHUNK_SIZE = 4096 * 16
+
+# Magic number of a delta file.
+DELTA_MAGIC = 0x72730236
+
+# Commands opcodes.
+OP_END = 0x00
+OP_LITERAL_N1 = 0x41
+OP_LITERAL_N8 = 0x44
+OP_COPY_N1_N1 = 0x45
+OP_COPY_N8_N8 = 0x54
+
+# Format used to read integers of 1, 2, 4 and 8 bytes.
+_INT_FORMATS = {1: b'>B', 2: b'>H', 4: b'>I', 8: b'>Q'}
+
+
+class DeltaError(Exception):
+    """
+    Raised when the delta is not valid.
+    """
+    pass
+
+
+class _Reader(object):
+    """
+    Read exact amount of data from a file object.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise DeltaError('unexpected end of delta')
+        return data
+
+    def read_int(self, size):
+        return struct.unpack(_INT_FORMATS[size], self.read(size))[0]
+
+
+def _copy(src, dst, length):
+    """
+    Copy `length` bytes from `src` to `dst`.
+    """
+    while length > 0:
+        data = src.read(min(length, CHUNK_SIZE))
+        if not data:
+            raise DeltaError('unexpected end of data')
+        dst.write(data)
+        length -= len(data)
+
+
+def patch(basis, delta, out):
+    """
+    Apply the `delta` to the `basis` and write the result into `out`. All
+    are file objects. The basis must be seekable. The delta is read
+    sequentially so it may be a compressed stream.
+    """
+    delta = _Reader(delta)
+    if delta.read_int(4) != DELTA_MAGIC:
+        raise DeltaError('invalid delta magic number')
+    while True:
+        op = delta.read_int(1)
+        if op == OP_END:
+            return
+        elif op < OP_LITERAL_N1:
+            # Literal with immediate length.
+            _copy(delta.f, out, op)
+        elif op <= OP_LITERAL_N8:
+            _copy(delta.f, out, delta.read_int(1 << (op - OP_LITERAL_N1)))
+        elif op <= OP_COPY_N8_N8:
+            i = op - OP_COPY_N1_N1
+            offset = delta.read_int(1 << (i // 4))
+            length = delta.read_int(1 << (i % 4))
+            basis.seek(offset)
+            _copy(basis, out, length)
+        else:
+            raise DeltaError('invalid command %#x' % op)
@@ -56,7 +56,9 @@ class AdminPage(page_main.MainPage):
             repo_count += len(user.repos)
 
         params = {"user_count": user_count,
-                  "repo_count": repo_count}
+                  "repo_count": repo_count,
+                  "restore_stats": self.app.restore_executor.stats(),
+                  "restores": [p.to_dict() for p in self.app.restore_tracker.list()]}
 
         return self._compile_template("admin.html", **params)
 
@@ -84,6 +84,8 @@ class BrowsePage(page_main.MainPage):
         else:
             # Get list of actual directory entries
             dir_entries = path_obj.dir_entries[::-1]
+            # Size of every entries is displayed.
+            path_obj.prefetch_file_sizes(dir_entries)
 
         return {"limit": limit,
                 "repo_name": repo_obj.display_name,
@@ -59,7 +59,7 @@ class LocationsPage(page_main.MainPage):
         for user_repo in user_repos:
             try:
                 # Get reference to a repo object
-                repo_obj = librdiff.RdiffRepo(user_root, user_repo)
+                repo_obj = self.app.repo_cache.get(user_root, user_repo)
                 path = repo_obj.path
                 name = repo_obj.display_name
                 status = repo_obj.status
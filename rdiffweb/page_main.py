@@ -26,7 +26,7 @@ import logging
 
 from rdiffweb.core import Component
 from rdiffweb.i18n import get_current_lang
-from rdiffweb.librdiff import RdiffRepo, AccessDeniedError, DoesNotExistError
+from rdiffweb.librdiff import AccessDeniedError, DoesNotExistError
 from rdiffweb.rdw_plugin import ITemplateFilterPlugin
 
 
@@ -103,7 +103,7 @@ class MainPage(Component):
 
         # Get reference to the repository (this ensure the repository does
         # exists and is valid.)
-        repo_obj = RdiffRepo(user_root_b, repo_b)
+        repo_obj = self.app.repo_cache.get(user_root_b, repo_b)
 
         # Get reference to the path.
         path_b = path_b[len(repo_b):]
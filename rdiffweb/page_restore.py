@@ -23,7 +23,13 @@ from builtins import bytes
 from builtins import str
 import cherrypy
 from cherrypy.lib.static import _serve_fileobj
+import io
+import json
 import logging
+import os
+import re
+import stat
+import time
 
 from rdiffweb import page_main
 from rdiffweb import rdw_helpers
@@ -31,11 +37,53 @@ import rdiffweb
 from rdiffweb.i18n import ugettext as _
 from rdiffweb.rdw_helpers import quote_url
 from rdiffweb.archiver import ARCHIVERS
+from rdiffweb.rdw_restore import CHUNK_SIZE, QueueFullError, RestoreProgress
 
 
 # Define the logger
 logger = logging.getLogger(__name__)
 
+# Restore identifier generated by the client.
+RESTORE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Maximum time (in seconds) a stream of progress events is kept open. The
+# client reconnects after PROGRESS_EVENTS_RETRY milliseconds.
+PROGRESS_EVENTS_TIMEOUT = 15
+PROGRESS_EVENTS_RETRY = 1000
+
+# Identifier of the last event sent when a restore is completed.
+PROGRESS_EVENTS_LAST_ID = 'finished'
+
+
+def _serve_stream(fileobj, content_length=None):
+    """
+    Stream the output of a restore. Range requests are not supported since
+    the stream cannot seek. When `content_length` is defined, the response
+    is aborted if the data doesn't match it. e.g.: the mirror changed while
+    being archived.
+    """
+    response = cherrypy.serving.response
+    if content_length is None:
+        response.body = fileobj
+        return response.body
+    response.headers['Content-Length'] = content_length
+
+    def stream():
+        size = 0
+        while True:
+            data = fileobj.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if size > content_length:
+                break
+            yield data
+        if size != content_length:
+            logger.warning("restore of %s bytes doesn't match Content-Length %s", size, content_length)
+            raise IOError("restore doesn't match Content-Length")
+    response.body = stream()
+    return response.body
+
 
 @rdiffweb.dispatch.poppath()
 class RestorePage(page_main.MainPage):
@@ -65,11 +113,12 @@ class RestorePage(page_main.MainPage):
 
     @cherrypy.expose
     @cherrypy.tools.gzip(on=False)
-    def default(self, path=b"", date=None, kind=None, usetar=None):
+    def default(self, path=b"", date=None, kind=None, usetar=None, restore_id=None):
         self.assertIsInstance(path, bytes)
         self.assertIsInstance(date, str)
         self.assertTrue(kind is None or kind in ARCHIVERS)
         self.assertTrue(usetar is None or isinstance(usetar, str))
+        self.assertTrue(restore_id is None or RESTORE_ID_PATTERN.match(restore_id))
 
         logger.debug("restoring [%r][%s]", path, date)
 
@@ -93,11 +142,108 @@ class RestorePage(page_main.MainPage):
         if usetar is not None:
             kind = 'tar.gz'
 
+        # Keep track of the restore. The identifier may be generated by the
+        # client to follow a download started by the browser.
+        username = self.app.currentuser and self.app.currentuser.username
+        progress = self.app.restore_tracker.create(
+            username, repo_obj.display_name,
+            repo_obj._decode(repo_obj.unquote(path_obj.path)), kind, restore_id)
+        cherrypy.response.headers['X-Restore-Id'] = progress.id
+
         # Restore file(s)
-        filename, fileobj = path_obj.restore(int(date), kind=kind)
+        try:
+            filename, fileobj = path_obj.restore(
+                int(date), kind=kind,
+                executor=self.app.restore_executor,
+                user=username,
+                cache=self.app.restore_cache,
+                flights=self.app.restore_flights,
+                progress=progress,
+                archive_options=self.app.archive_options)
+        except QueueFullError as e:
+            progress.set_phase(RestoreProgress.FAILED)
+            # HTTPError removes Retry-After, set it on the error response.
+            cherrypy.HTTPError(503, _("Too many restores in progress. Please try again later.")).set_response()
+            cherrypy.response.headers['Retry-After'] = str(e.retry_after)
+            return cherrypy.response.body
+
+        # Cancel the restore when the request ends. e.g.: client disconnect.
+        cherrypy.request.hooks.attach('on_end_request', fileobj.close)
 
         # Define content-disposition.
         cherrypy.response.headers["Content-Disposition"] = self._content_disposition(filename)
 
-        # Stream the data.
-        return _serve_fileobj(fileobj, content_type=None, content_length=None)
+        # Serve a regular file with its length and support for range
+        # requests.
+        try:
+            st = os.fstat(fileobj.fileno())
+            if stat.S_ISREG(st.st_mode):
+                return _serve_fileobj(fileobj, content_type=None, content_length=st.st_size)
+        except io.UnsupportedOperation:
+            # Output of a restore in progress.
+            pass
+        # Stream the output of the restore. Provide the length of an
+        # archive of known size.
+        return _serve_stream(fileobj, getattr(fileobj, 'length', None))
+
+
+class RestoreProgressPage(page_main.MainPage):
+    """
+    Report the progress of the restores of the current user as JSON. Every
+    restores are visible to administrators.
+    """
+
+    def _get_progress(self, restore_id):
+        progress = self.app.restore_tracker.get(restore_id)
+        user = self.app.currentuser
+        if progress is None or (not user.is_admin and progress.user != user.username):
+            raise cherrypy.NotFound()
+        return progress
+
+    @cherrypy.expose
+    def index(self, id=None):  # @ReservedAssignment
+        """
+        Return the progress of the given restore or the list of restores.
+        """
+        if id:
+            data = self._get_progress(id).to_dict()
+        else:
+            user = self.app.currentuser
+            data = [
+                p.to_dict()
+                for p in self.app.restore_tracker.list(None if user.is_admin else user.username)]
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(data, sort_keys=True).encode('utf8')
+
+    @cherrypy.expose
+    @cherrypy.tools.gzip(on=False)
+    def events(self, id):  # @ReservedAssignment
+        """
+        Stream the progress of the given restore as server-sent events.
+        To not hold a thread for the whole restore, the stream is closed
+        after PROGRESS_EVENTS_TIMEOUT seconds and the client reconnects.
+        Once the restore is completed, reconnections get a "204 No Content"
+        to stop the client.
+        """
+        progress = self._get_progress(id)
+        last_id = cherrypy.request.headers.get('Last-Event-ID')
+        if last_id == PROGRESS_EVENTS_LAST_ID and progress.finished:
+            cherrypy.response.status = 204
+            return b''
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+
+        def stream():
+            yield ('retry: %d\n\n' % PROGRESS_EVENTS_RETRY).encode('utf8')
+            deadline = time.time() + PROGRESS_EVENTS_TIMEOUT
+            while True:
+                finished = progress.finished
+                data = 'data: %s\n' % json.dumps(progress.to_dict(), sort_keys=True)
+                if finished:
+                    data += 'id: %s\n' % PROGRESS_EVENTS_LAST_ID
+                yield (data + '\n').encode('utf8')
+                if finished or time.time() >= deadline:
+                    return
+                time.sleep(1)
+        return stream()
+    events._cp_config = {'response.stream': True}
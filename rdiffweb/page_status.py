@@ -157,7 +157,7 @@ class StatusPage(page_main.MainPage):
         for repo in repos:
             repo = repo.lstrip("/")
             try:
-                repo_obj = librdiff.RdiffRepo(user_root, repo)
+                repo_obj = self.app.repo_cache.get(user_root, repo)
                 backups = repo_obj.get_history_entries(-1, earliest_date,
                                                        latest_date)
                 allBackups += [{"repo_path": repo_obj.path,
@@ -63,6 +63,8 @@ class DeleteRepoPage(MainPage):
         # Update the repository encoding
         _logger.info("deleting repository [%s]", repo_obj)
         repo_obj.delete()
+        if self.app.restore_cache:
+            self.app.restore_cache.invalidate(repo_obj.full_path)
 
         # Refresh repository list
         repos = self.app.currentuser.repos
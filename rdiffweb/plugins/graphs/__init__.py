@@ -20,9 +20,15 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from builtins import bytes
+from builtins import range
 from builtins import str
+import calendar
 import cherrypy
-from future.utils import iteritems
+from cherrypy.lib import cptools, httputil
+import datetime
+import hashlib
+import itertools
+import json
 import logging
 import pkg_resources
 
@@ -37,6 +43,15 @@ from rdiffweb.rdw_plugin import IRdiffwebPlugin, ITemplateFilterPlugin
 
 _logger = logging.getLogger(__name__)
 
+# Number of lines returned in a single chunk of data.
+CHUNK_SIZE = 1000
+
+# Supported period to group statistics.
+BUCKETS = ['day', 'week', 'month']
+
+# Supported data format.
+FORMATS = ['csv', 'json']
+
 
 def url_for_graphs(repo, graph=''):
     """
@@ -52,10 +67,122 @@ def url_for_graphs(repo, graph=''):
     return ''.join(url)
 
 
+def _bucket_start(seconds, bucket):
+    """
+    Return the beginning of the day, week or month containing the given
+    epoch (UTC).
+    """
+    d = datetime.datetime.utcfromtimestamp(seconds).date()
+    if bucket == 'week':
+        d -= datetime.timedelta(days=d.weekday())
+    elif bucket == 'month':
+        d = d.replace(day=1)
+    return calendar.timegm(d.timetuple())
+
+
+def bucket_rows(rows, bucket):
+    """
+    Group the rows (seconds, [values]) by day, week or month. Return an
+    iterator of (seconds, [min, max, avg, ...]) with three values per
+    original value. Unknown values are ignored.
+    """
+    assert bucket in BUCKETS
+    for key, group in itertools.groupby(rows, key=lambda r: _bucket_start(r[0], bucket)):
+        values = []
+        for column in zip(*[v for unused, v in group]):
+            column = [v for v in column if v is not None]
+            if column:
+                values.extend((min(column), max(column), sum(column) / float(len(column))))
+            else:
+                values.extend((None, None, None))
+        yield key, values
+
+
+def lttb(rows, threshold, index=0):
+    """
+    Downsample the rows (seconds, [values]) to `threshold` rows using the
+    Largest-Triangle-Three-Buckets algorithm on the value at `index`.
+    The first and last rows are always kept.
+    """
+    assert threshold >= 3
+    if len(rows) <= threshold:
+        return rows
+
+    def y(row):
+        return row[1][index] or 0
+
+    sampled = [rows[0]]
+    every = (len(rows) - 2) / float(threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average point of the next bucket.
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, len(rows))
+        avg_x = sum(rows[j][0] for j in range(avg_start, avg_end)) / float(avg_end - avg_start)
+        avg_y = sum(y(rows[j]) for j in range(avg_start, avg_end)) / float(avg_end - avg_start)
+        # Select the point of the current bucket making the largest
+        # triangle with the previous selected point and the average.
+        ax, ay = rows[a][0], y(rows[a])
+        max_area, next_a = -1, None
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (y(rows[j]) - ay) - (ax - rows[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area, next_a = area, j
+        sampled.append(rows[next_a])
+        a = next_a
+    sampled.append(rows[-1])
+    return sampled
+
+
+def _csv(names, rows):
+    """
+    Generate CSV data in chunks of CHUNK_SIZE lines.
+    """
+    def fmt(value):
+        return '' if value is None else str(value)
+    yield ','.join(['date'] + names) + '\n'
+    rows = iter(rows)
+    while True:
+        lines = [
+            ','.join([str(seconds)] + [fmt(v) for v in values]) + '\n'
+            for seconds, values in itertools.islice(rows, CHUNK_SIZE)]
+        if not lines:
+            break
+        yield ''.join(lines)
+
+
+def _json(names, rows):
+    """
+    Generate JSON data with one list of values per column.
+    """
+    rows = list(rows)
+    data = {'date': [seconds for seconds, unused in rows]}
+    for i, name in enumerate(names):
+        data[name] = [values[i] for unused, values in rows]
+    yield json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def _encode(chunks):
+    """
+    Encode the generated data as UTF-8. Done here for every format since the
+    encode tool doesn't handle application/json.
+    """
+    for chunk in chunks:
+        yield chunk.encode('utf8')
+
+
 @poppath('graph')
 class GraphsPage(page_main.MainPage):
 
-    def _data(self, path, **kwargs):
+    def _data(self, path, start=None, end=None, attrs=None, points=None,
+              bucket=None, format='csv', **kwargs):
+        """
+        Return the session statistics. The data may be limited to the dates
+        between `start` and `end` (epoch) and to a comma separated list of
+        `attrs`. The statistics may be grouped by `bucket` (day, week or
+        month) as min, max and average values or downsampled to the given
+        number of `points`.
+        """
         assert isinstance(path, bytes)
 
         _logger.debug("repo stats [%r]", path)
@@ -67,29 +194,56 @@ class GraphsPage(page_main.MainPage):
             _logger.exception("invalid user path [%r]", path)
             return self._compile_error_template(str(e))
 
-        attrs = [
-            'starttime', 'endtime', 'elapsedtime', 'sourcefiles', 'sourcefilesize',
-            'mirrorfiles', 'mirrorfilesize', 'newfiles', 'newfilesize', 'deletedfiles',
-            'deletedfilesize', 'changedfiles', 'changedsourcesize', 'changedmirrorsize',
-            'incrementfiles', 'incrementfilesize', 'totaldestinationsizechange', 'errors']
+        # Validate the parameters.
+        if start:
+            self.assertIsInt(start, _("Invalid start date"))
+            start = rdw_helpers.rdwTime(int(start))
+        if end:
+            self.assertIsInt(end, _("Invalid end date"))
+            end = rdw_helpers.rdwTime(int(end))
+        if attrs:
+            if not isinstance(attrs, list):
+                attrs = attrs.split(',')
+            self.assertTrue(
+                all(a in librdiff.SessionStatistics.ATTRS for a in attrs),
+                _("Invalid attributes"))
+        else:
+            attrs = librdiff.SessionStatistics.ATTRS
+        if points:
+            self.assertIsInt(points, _("Invalid number of points"))
+            points = int(points)
+            self.assertTrue(points >= 3, _("Invalid number of points"))
+        self.assertTrue(not bucket or bucket in BUCKETS, _("Invalid bucket"))
+        self.assertTrue(format in FORMATS, _("Invalid format"))
+
+        # Let the browser use it's cache if nothing changed since the last
+        # backup.
+        stats = repo_obj.session_statistics
+        if stats.dates:
+            latest = stats.dates[-1].getSeconds()
+            query = cherrypy.request.query_string or ''
+            etag = hashlib.md5(('%s:%s:%s:%s' % (repo_obj.full_path, latest, len(stats), query)).encode('utf8'))
+            cherrypy.response.headers['ETag'] = '"%s"' % etag.hexdigest()
+            cherrypy.response.headers['Last-Modified'] = httputil.HTTPDate(latest)
+            cptools.validate_etags()
+            cptools.validate_since()
+
+        # Select the data.
+        names = list(attrs)
+        rows = ((d.getSeconds(), values) for d, values in stats.rows(attrs, start, end))
+        if bucket:
+            names = ['%s_%s' % (attr, f) for attr in attrs for f in ['min', 'max', 'avg']]
+            rows = bucket_rows(rows, bucket)
+        if points:
+            # Downsample using the first attribute (average when grouped).
+            rows = lttb(list(rows), points, index=2 if bucket else 0)
 
         # Return a generator
-        def func():
-            # Header
-            yield 'date'
-            for attr in attrs:
-                yield ','
-                yield attr
-            yield '\n'
-            # Content
-            for d, s in iteritems(repo_obj.session_statistics):
-                yield str(d.getSeconds())
-                for attr in attrs:
-                    yield ','
-                    yield str(getattr(s, attr))
-                yield '\n'
-
-        return func()
+        if format == 'json':
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return _encode(_json(names, rows))
+        cherrypy.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        return _encode(_csv(names, rows))
 
     def _page(self, path, graph, **kwargs):
         """
@@ -22,9 +22,11 @@ Created on Jan 1, 2016
 """
 from __future__ import unicode_literals
 
+import json
 import logging
 import unittest
 
+from rdiffweb.plugins.graphs import lttb
 from rdiffweb.test import WebCase
 
 
@@ -73,6 +75,48 @@ class SettingsTest(WebCase):
 """
         self.assertEquals(expected, self.body)
 
+    def test_stats_with_attrs(self):
+        self.getPage("/graphs/data/" + self.REPO + "/?attrs=sourcefiles,errors&start=1414871426&end=1414871448")
+        self.assertStatus('200 OK')
+        self.assertEquals(b"date,sourcefiles,errors\n1414871426,10,0\n1414871448,10,0\n", self.body)
+
+    def test_stats_with_invalid_attrs(self):
+        self.getPage("/graphs/data/" + self.REPO + "/?attrs=invalid")
+        self.assertStatus(400)
+
+    def test_stats_with_bucket(self):
+        self.getPage("/graphs/data/" + self.REPO + "/?attrs=sourcefiles&bucket=month")
+        self.assertStatus('200 OK')
+        self.assertEquals(
+            b"date,sourcefiles_min,sourcefiles_max,sourcefiles_avg\n1414800000,5,19,12.8\n1451606400,22,22,22.0\n1454284800,25,25,25.0\n",
+            self.body)
+
+    def test_stats_with_points(self):
+        self.getPage("/graphs/data/" + self.REPO + "/?attrs=sourcefiles&points=5&format=json")
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Type', 'application/json')
+        data = json.loads(self.body.decode('utf8'))
+        self.assertEqual(5, len(data['date']))
+        self.assertEqual([1414871387, 1454448640], [data['date'][0], data['date'][-1]])
+        self.assertEqual(5, len(data['sourcefiles']))
+
+    def test_stats_not_modified(self):
+        self._stats(self.REPO)
+        etag = dict((k.lower(), v) for k, v in self.headers)['etag']
+        self.getPage("/graphs/data/" + self.REPO + "/", headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        self.getPage("/graphs/data/" + self.REPO + "/?attrs=errors", headers=[('If-None-Match', etag)])
+        self.assertStatus('200 OK')
+
+
+class LttbTest(unittest.TestCase):
+
+    def test_lttb(self):
+        rows = [(i, [v]) for i, v in enumerate([0, 1, 0, 10, 0, 1, 0, 1, 0])]
+        sampled = lttb(rows, 3)
+        self.assertEqual([0, 3, 8], [r[0] for r in sampled])
+        self.assertEqual(rows, lttb(rows, 20))
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     logging.basicConfig(level=logging.DEBUG)
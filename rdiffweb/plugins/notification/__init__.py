@@ -34,7 +34,6 @@ import smtplib
 import time
 from xml.etree.ElementTree import fromstring, tostring
 
-from rdiffweb import librdiff
 from rdiffweb.core import RdiffError, RdiffWarning
 from rdiffweb.i18n import ugettext as _
 from rdiffweb.rdw_helpers import rdwTime
@@ -219,7 +218,7 @@ class NotificationPlugin(IPreferencesPanelProvider, JobPlugin, IUserChangeListen
                     if not maxage or maxage <= 0:
                         continue
                     # Check repo age.
-                    r = librdiff.RdiffRepo(user.user_root, repo.name)
+                    r = self.app.repo_cache.get(user.user_root, repo.name)
                     if r.last_backup_date < (now - datetime.timedelta(days=maxage)):
                         old_repos.append(r)
                 # Return an item only if user had old repo
@@ -30,7 +30,7 @@ import logging
 import os
 import re
 
-from rdiffweb import rdw_spider_repos, page_main, librdiff
+from rdiffweb import rdw_spider_repos, page_main
 from rdiffweb.dispatch import poppath
 from rdiffweb.i18n import ugettext as _
 from rdiffweb.page_main import MainPage
@@ -124,7 +124,7 @@ class RemoveOlderPlugin(ITemplateFilterPlugin, JobPlugin):
         """
         assert keepdays > 0
         # Get instance of the repo.
-        r = librdiff.RdiffRepo(user.user_root, repo.name)
+        r = self.app.repo_cache.get(user.user_root, repo.name)
         # Check history date.
         if not r.last_backup_date:
             _logger.info("no backup dates for [%r]", r.full_path)
@@ -133,6 +133,15 @@ class RemoveOlderPlugin(ITemplateFilterPlugin, JobPlugin):
         d = d.days + keepdays
 
         _logger.info("execute rdiff-backup --force --remove-older-than=%sD %r", d, r.full_path)
-        r.execute(b'--force',
-                  b'--remove-older-than=' + str(d).encode(encoding='latin1') + b'D',
-                  r.full_path)
+        try:
+            r.execute(b'--force',
+                      b'--remove-older-than=' + str(d).encode(encoding='latin1') + b'D',
+                      r.full_path)
+        finally:
+            r.changed()
+
+        # Remove restores of deleted backups from the cache.
+        if self.app.restore_cache:
+            r = self.app.repo_cache.get(user.user_root, repo.name)
+            if r.backup_dates:
+                self.app.restore_cache.invalidate(r.full_path, before=r.backup_dates[0].getSeconds())
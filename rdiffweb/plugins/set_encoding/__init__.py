@@ -31,7 +31,7 @@ import logging
 import os
 import re
 
-from rdiffweb import rdw_spider_repos, page_main, librdiff
+from rdiffweb import rdw_spider_repos, page_main
 from rdiffweb.dispatch import poppath
 from rdiffweb.i18n import ugettext as _
 from rdiffweb.page_main import MainPage
@@ -95,7 +95,7 @@ class SetEncodingPlugin(ITemplateFilterPlugin):
             template = self.app.templates.get_template("set_encoding.html")
             data["templates_content"].append(template)
             # Query current data from database.
-            repo_obj = librdiff.RdiffRepo(self.app.currentuser.user_root, data['repo_path'])
+            repo_obj = self.app.repo_cache.get(self.app.currentuser.user_root, data['repo_path'])
             current_encoding = repo_obj.get_encoding()
             current_encoding = encodings.normalize_encoding(current_encoding)
             data['current_encoding'] = current_encoding
@@ -40,12 +40,16 @@ from rdiffweb.page_browse import BrowsePage
 from rdiffweb.page_history import HistoryPage
 from rdiffweb.page_locations import LocationsPage
 from rdiffweb.page_prefs import PreferencesPage
-from rdiffweb.page_restore import RestorePage
+from rdiffweb.page_restore import RestorePage, RestoreProgressPage
 from rdiffweb.page_settings import SettingsPage
 from rdiffweb.page_status import StatusPage
 from rdiffweb.user import UserManager
 from rdiffweb.page_main import MainPage
 from rdiffweb.librdiff import DoesNotExistError, AccessDeniedError
+from rdiffweb.rdw_repo_cache import RepoCache
+from rdiffweb.rdw_restore import RestoreCache, RestoreExecutor, RestoreFlights, \
+    RestoreTracker
+from rdiffweb.rdw_workers import RdiffBackupPool
 
 
 # Define the logger
@@ -61,6 +65,7 @@ class Root(LocationsPage):
         LocationsPage.__init__(self, app)
         self.browse = BrowsePage(app)
         self.restore = RestorePage(app)
+        self.restore_progress = RestoreProgressPage(app)
         self.history = HistoryPage(app)
         self.status = StatusPage(app)
         self.admin = AdminPage(app)
@@ -95,6 +100,51 @@ class RdiffwebApp(Application):
         # Initialise the configuration
         self.load_config(configfile)
 
+        # Initialise the pool of rdiff-backup workers.
+        self.rdiff_backup_pool = None
+        workers = self.cfg.get_config_int("RdiffBackupWorkers", "0")
+        if workers > 0:
+            self.rdiff_backup_pool = RdiffBackupPool(
+                size=workers,
+                max_jobs=self.cfg.get_config_int("RdiffBackupWorkerJobs", "100"))
+            cherrypy.engine.subscribe('stop', self.rdiff_backup_pool.close)
+
+        # Initialise the repository cache.
+        self.repo_cache = RepoCache(
+            size=self.cfg.get_config_int("RepoCacheSize", "100"),
+            ttl=self.cfg.get_config_int("RepoCacheTTL", "300"),
+            cache_dir=self.cfg.get_config("CacheDir") or None,
+            pool=self.rdiff_backup_pool)
+
+        # Initialise the restore executor.
+        self.restore_executor = RestoreExecutor(
+            max_workers=self.cfg.get_config_int("RestoreMaxWorkers", "4"),
+            max_per_user=self.cfg.get_config_int("RestoreMaxPerUser", "2"),
+            max_queue=self.cfg.get_config_int("RestoreMaxQueue", "50"))
+
+        # Share identical restores in progress.
+        self.restore_flights = RestoreFlights()
+
+        # Keep track of the restores progress.
+        self.restore_tracker = RestoreTracker()
+
+        # Options used to create the archives.
+        level = self.cfg.get_config_int("ArchiveCompressionLevel", "-1")
+        threshold = float(self.cfg.get_config("ArchiveStoreThreshold", "0.95"))
+        self.archive_options = {
+            'threads': max(1, self.cfg.get_config_int("ArchiveThreads", "1")),
+            'level': level if level >= 0 else None,
+            'threshold': threshold if threshold > 0 else None,
+            'bufsize': max(4, self.cfg.get_config_int("ArchiveBufferSize", "1024")) * 1024}
+
+        # Initialise the restore cache.
+        self.restore_cache = None
+        restore_cache_dir = self.cfg.get_config("RestoreCacheDir")
+        if restore_cache_dir:
+            self.restore_cache = RestoreCache(
+                restore_cache_dir,
+                self.cfg.get_config_int("RestoreCacheSize", "1024") * 1024 * 1024)
+
         # Initialise the template engine.
         self.templates = rdw_templating.TemplateManager()
 
@@ -200,6 +250,14 @@ class RdiffwebApp(Application):
         if tempdir:
             os.environ["TMPDIR"] = tempdir
 
+        # Create the cache directory
+        cache_dir = self.cfg.get_config("CacheDir", default="")
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                logger.warning("fail to create cache directory [%s]", cache_dir, exc_info=1)
+
     def _setup_session_storage(self, config):
         # Configure session storage.
         session_storage = self.cfg.get_config("SessionStorage")
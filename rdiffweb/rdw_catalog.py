@@ -0,0 +1,439 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent catalog of rdiff-backup metadata.
+
+A catalog is a SQLite file stored in the cache directory. It keeps the
+listing of `rdiff-backup-data` and of every `increments` directory visited
+with the date parsed from each entry. A listing is only read again from the
+file system when the modification time of the directory changed, e.g.: when
+a new backup session wrote into it.
+
+The catalog also keeps an index of the `file_statistics` files. The lines
+of those files are sorted by path and grouped in compressed blocks. Each
+block is keyed by its first path to lookup the sizes of a file with a
+single seek instead of reading the whole statistics again. The rows of the
+statistics files and directories removed from the repository are deleted
+every time a statistics file is indexed, i.e.: once per new backup.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from builtins import bytes
+from builtins import object
+import hashlib
+import logging
+import os
+import threading
+import zlib
+
+from rdiffweb.rdw_helpers import scandir
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3  # @UnresolvedImport @Reimport
+
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Version of the database schema. Increase this value to force the catalog
+# to be re-created when the layout of the tables changed.
+SCHEMA_VERSION = 3
+
+SCHEMA = [
+    """CREATE TABLE listings (
+        dir BLOB PRIMARY KEY,
+        mtime REAL NOT NULL)""",
+    """CREATE TABLE entries (
+        dir BLOB NOT NULL,
+        name BLOB NOT NULL,
+        filename BLOB,
+        isdir INTEGER NOT NULL,
+        time INTEGER,
+        tz INTEGER)""",
+    """CREATE INDEX entries_dir_filename ON entries (dir, filename)""",
+    """CREATE TABLE statistics_files (
+        id INTEGER PRIMARY KEY,
+        name BLOB NOT NULL UNIQUE,
+        mtime REAL NOT NULL,
+        size INTEGER NOT NULL)""",
+    """CREATE TABLE statistics_blocks (
+        file_id INTEGER NOT NULL,
+        first BLOB NOT NULL,
+        data BLOB NOT NULL)""",
+    """CREATE INDEX statistics_blocks_file_id_first ON statistics_blocks (file_id, first)""",
+]
+
+# Tables dropped when the schema is created, including the tables of
+# previous versions.
+TABLES = ['listings', 'entries', 'statistics_files', 'statistics_blocks', 'statistics']
+
+# Size of the lines of a statistics file grouped in a block before
+# compression.
+BLOCK_SIZE = 32 * 1024
+
+
+def catalog_filename(cache_dir, full_path):
+    """
+    Return the location of the catalog used for the repository located at
+    `full_path`.
+    """
+    assert isinstance(full_path, bytes)
+    return os.path.join(cache_dir, hashlib.sha1(full_path).hexdigest() + '.db')
+
+
+def _key(path):
+    """
+    Return the key used to sort the paths. Paths are compared component by
+    component, the order used by rdiff-backup to write the statistics. The
+    key keeps this order when compared as bytes by SQLite.
+    """
+    return path.replace(b'/', b'\x00')
+
+
+class _Unsorted(Exception):
+    """
+    Raised when the lines of a statistics file are not sorted.
+    """
+    pass
+
+
+def _check_sorted(rows):
+    """
+    Yield the given `(key, line)` rows. Raise _Unsorted if not sorted.
+    """
+    last = None
+    for row in rows:
+        if last is not None and row[0] < last:
+            raise _Unsorted()
+        last = row[0]
+        yield row
+
+
+def _int(value):
+    """
+    Convert the value read from a statistics file into integer. Return None
+    for `NA`.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CatalogEntry(object):
+    """
+    Represent one entry of a cached directory listing.
+    """
+
+    __slots__ = ('name', 'filename', 'isdir', 'date')
+
+    def __init__(self, name, filename, isdir, date):
+        self.name = name
+        self.filename = filename
+        self.isdir = isdir
+        self.date = date
+
+
+class Catalog(object):
+    """
+    SQLite backed cache of directory listings for a single repository.
+
+    The `parse` function is used to extract `(filename, date)` from an entry
+    name when a directory is listed from the file system. `date` must be
+    None or an object with `timeInSeconds` and `tzOffset` attributes. The
+    `date_factory` is used to re-create the date from those two values.
+
+    Every method returns None if the catalog is not usable. Callers are
+    expected to fallback to the file system.
+    """
+
+    def __init__(self, filename, parse, date_factory):
+        self._filename = filename
+        self._parse = parse
+        self._date_factory = date_factory
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _connect(self):
+        """
+        Open the database and create the tables if required.
+        """
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self._filename, timeout=30, check_same_thread=False)
+        conn.isolation_level = None
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            logger.info("creating catalog [%s]", self._filename)
+            for table in TABLES:
+                conn.execute('DROP TABLE IF EXISTS %s' % table)
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+            conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+        self._conn = conn
+        return conn
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def file_statistic(self, filename, path, read):
+        """
+        Return a dict with `changed`, `source_size`, `mirror_size` and
+        `increment_size` of `path` from the statistics file `filename`. Raise
+        KeyError if the path is not found.
+
+        The index of the statistics file is built the first time and every
+        time the file changes. `read` must return an iterator of
+        `(path, changed, source_size, mirror_size, increment_size)` for the
+        whole file.
+        """
+        assert isinstance(filename, bytes)
+        assert isinstance(path, bytes)
+        try:
+            with self._lock:
+                row = self._file_statistic(filename, path, read)
+        except sqlite3.Error:
+            logger.warning("catalog [%s] is not usable", self._filename, exc_info=1)
+            self.close()
+            return None
+        if row is None:
+            raise KeyError(path)
+        return {
+            'changed': row[0],
+            'source_size': row[1],
+            'mirror_size': row[2],
+            'increment_size': row[3]}
+
+    def _file_statistic(self, filename, path, read):
+        conn = self._connect()
+        key = sqlite3.Binary(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            # Removed in the meantime. e.g.: by remove older.
+            self._delete_statistics(conn, key)
+            return None
+        row = conn.execute(
+            'SELECT id, mtime, size FROM statistics_files WHERE name=?',
+            (key,)).fetchone()
+        if row is None or row[1] != st.st_mtime or row[2] != st.st_size:
+            file_id = self._index(conn, key, st, read)
+            self._prune(conn)
+        else:
+            file_id = row[0]
+
+        # Search the path in the block starting before it.
+        row = conn.execute(
+            'SELECT data FROM statistics_blocks WHERE file_id=? AND first<=? ORDER BY first DESC LIMIT 1',
+            (file_id, sqlite3.Binary(_key(path)))).fetchone()
+        if row is None:
+            return None
+        for line in zlib.decompress(bytes(row[0])).split(b'\n'):
+            data = line.rsplit(b' ', 4)
+            if data[0] == path:
+                return [_int(v) for v in data[1:]]
+        return None
+
+    def _index(self, conn, key, st, read):
+        """
+        Build the index of a statistics file.
+        """
+        logger.debug("indexing statistics [%r]", bytes(key))
+
+        def rows():
+            return ((_key(r[0]), b' '.join(r)) for r in read())
+
+        conn.execute('BEGIN')
+        try:
+            self._delete_statistics(conn, key)
+            file_id = conn.execute(
+                'INSERT INTO statistics_files (name, mtime, size) VALUES (?, ?, ?)',
+                (key, st.st_mtime, st.st_size)).lastrowid
+            # The statistics are written in order by rdiff-backup. Otherwise,
+            # sort them in memory.
+            try:
+                self._insert_blocks(conn, file_id, _check_sorted(rows()))
+            except _Unsorted:
+                conn.execute('DELETE FROM statistics_blocks WHERE file_id=?', (file_id,))
+                self._insert_blocks(conn, file_id, sorted(rows()))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return file_id
+
+    def _insert_blocks(self, conn, file_id, rows):
+        """
+        Group the sorted `(key, line)` rows in compressed blocks.
+        """
+        block = []
+        size = 0
+        for key, line in rows:
+            if not block:
+                first = key
+            block.append(line)
+            size += len(line) + 1
+            if size >= BLOCK_SIZE:
+                self._insert_block(conn, file_id, first, block)
+                block = []
+                size = 0
+        if block:
+            self._insert_block(conn, file_id, first, block)
+
+    def _insert_block(self, conn, file_id, first, lines):
+        conn.execute(
+            'INSERT INTO statistics_blocks (file_id, first, data) VALUES (?, ?, ?)',
+            (file_id, sqlite3.Binary(first), sqlite3.Binary(zlib.compress(b'\n'.join(lines)))))
+
+    def _delete_statistics(self, conn, key):
+        """
+        Delete the index of the given statistics file.
+        """
+        row = conn.execute('SELECT id FROM statistics_files WHERE name=?', (key,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM statistics_blocks WHERE file_id=?', (row[0],))
+            conn.execute('DELETE FROM statistics_files WHERE id=?', (row[0],))
+
+    def _prune(self, conn):
+        """
+        Delete the index of the statistics files and the listing of the
+        directories that no longer exist.
+        """
+        names = [bytes(r[0]) for r in conn.execute('SELECT name FROM statistics_files')]
+        dirs = [bytes(r[0]) for r in conn.execute('SELECT dir FROM listings')]
+        names = [n for n in names if not os.path.exists(n)]
+        dirs = [d for d in dirs if not os.path.isdir(d)]
+        if not names and not dirs:
+            return
+        logger.debug("pruning catalog [%s]", self._filename)
+        conn.execute('BEGIN')
+        try:
+            for name in names:
+                self._delete_statistics(conn, sqlite3.Binary(name))
+            for d in dirs:
+                conn.execute('DELETE FROM entries WHERE dir=?', (sqlite3.Binary(d),))
+                conn.execute('DELETE FROM listings WHERE dir=?', (sqlite3.Binary(d),))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def list(self, path, filename=None):
+        """
+        Return the list of `CatalogEntry` for the given directory. If
+        `filename` is defined, only return the entries matching it.
+
+        The listing is read from the database when the directory didn't
+        change since the last call. Otherwise, the directory is listed again
+        and only the new entries get parsed.
+        """
+        assert isinstance(path, bytes)
+        try:
+            with self._lock:
+                return self._list(path, filename)
+        except sqlite3.Error:
+            logger.warning("catalog [%s] is not usable", self._filename, exc_info=1)
+            self.close()
+            return None
+
+    def _list(self, path, filename):
+        conn = self._connect()
+        key = sqlite3.Binary(path)
+
+        # Check if the directory still exists.
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+
+        row = conn.execute('SELECT mtime FROM listings WHERE dir=?', (key,)).fetchone()
+        if row is None or row[0] != mtime:
+            self._refresh(conn, path, key, mtime)
+        if mtime is None:
+            return []
+
+        # Query the listing.
+        if filename is None:
+            cursor = conn.execute(
+                'SELECT name, filename, isdir, time, tz FROM entries WHERE dir=?',
+                (key,))
+        else:
+            cursor = conn.execute(
+                'SELECT name, filename, isdir, time, tz FROM entries WHERE dir=? AND filename=?',
+                (key, sqlite3.Binary(filename)))
+        return [self._entry(*r) for r in cursor]
+
+    def _entry(self, name, filename, isdir, time, tz):
+        date = None
+        if time is not None:
+            date = self._date_factory(int(time), int(tz))
+        return CatalogEntry(
+            bytes(name),
+            bytes(filename) if filename is not None else None,
+            bool(isdir),
+            date)
+
+    def _refresh(self, conn, path, key, mtime):
+        """
+        Update the listing of the given directory.
+        """
+        logger.debug("refreshing catalog for [%r]", path)
+        # Keep reference to the entries already parsed.
+        known = {}
+        for r in conn.execute('SELECT name, filename, isdir, time, tz FROM entries WHERE dir=?', (key,)):
+            known[bytes(r[0])] = r
+
+        # List the directory content.
+        rows = []
+        if mtime is not None:
+            for dirent in scandir(path):
+                name = dirent.name
+                if name in known:
+                    rows.append(known[name])
+                    continue
+                filename, date = self._parse(name)
+                isdir = dirent.is_dir()
+                if date is not None:
+                    rows.append((name, filename, isdir, date.timeInSeconds, date.tzOffset))
+                else:
+                    rows.append((name, filename, isdir, None, None))
+
+        # Replace the listing in a single transaction.
+        conn.execute('BEGIN')
+        try:
+            conn.execute('DELETE FROM entries WHERE dir=?', (key,))
+            conn.execute('DELETE FROM listings WHERE dir=?', (key,))
+            if mtime is not None:
+                conn.executemany(
+                    'INSERT INTO entries (dir, name, filename, isdir, time, tz) VALUES (?, ?, ?, ?, ?, ?)',
+                    ((key, sqlite3.Binary(bytes(r[0])),
+                      sqlite3.Binary(bytes(r[1])) if r[1] is not None else None,
+                      int(r[2]), r[3], r[4]) for r in rows))
+                conn.execute('INSERT INTO listings (dir, mtime) VALUES (?, ?)', (key, mtime))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
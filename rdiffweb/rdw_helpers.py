@@ -28,6 +28,8 @@ from future.utils import iteritems
 from future.utils import python_2_unicode_compatible
 from past.builtins import cmp
 from past.utils import old_div
+import os
+import stat
 import time
 from datetime import timedelta, datetime
 
@@ -38,6 +40,15 @@ except ImportError:
     # Python 2
     from urllib import quote, unquote
 
+try:
+    from os import scandir as _scandir  # @UnresolvedImport
+except ImportError:
+    try:
+        # Python < 3.5
+        from scandir import scandir as _scandir  # @UnresolvedImport @Reimport
+    except ImportError:
+        _scandir = None
+
 
 # TODO: Move this into page_main
 def quote_url(url, safe='/'):
@@ -89,6 +100,8 @@ class rdwTime(object):
     "local" time, but pass the timezone information on to rdiff-backup, so
     it can restore to the correct state"""
 
+    __slots__ = ('timeInSeconds', 'tzOffset')
+
     def __init__(self, value=None, tz_offset=None):
         assert value is None or isinstance(value, int) or isinstance(value, str)
         if value is None:
@@ -238,6 +251,130 @@ class rdwTime(object):
         """return second since epoch"""
         return str(self.getSeconds())
 
+
+class _DirEntry(object):
+
+    """
+    Minimal implementation of `os.DirEntry` used when scandir is not
+    available. The result of stat() is cached like the original.
+    """
+
+    __slots__ = ('name', 'path', '_stat', '_lstat')
+
+    def __init__(self, top, name):
+        self.name = name
+        self.path = os.path.join(top, name)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(False).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if not hasattr(self, '_lstat'):
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if not hasattr(self, '_stat'):
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def scandir(path):
+    """
+    Return an iterator of `os.DirEntry` for the given directory. Fallback to
+    listdir() when neither `os.scandir` nor the scandir module are
+    available.
+    """
+    if _scandir is not None:
+        return _scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
+
+
+class Timestamp(rdwTime):
+
+    """
+    Immutable replacement of rdwTime used for the dates read from a
+    repository. The time in seconds since epoch (UTC) is computed once and
+    compared directly. Equality and hash are the same as rdwTime.
+
+    Use `Timestamp.parse()` to create a timestamp from a string.
+    """
+
+    __slots__ = ('_seconds',)
+
+    def __init__(self, value=None, tz_offset=None):
+        rdwTime.__init__(self, value, tz_offset)
+        self._seconds = self.timeInSeconds - self.tzOffset
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Return a timestamp from a w3 datetime string, e.g.:
+        `2014-11-02T17:23:41-05:00`. Raise ValueError if the string is not
+        valid.
+        """
+        return cls(value)
+
+    def getSeconds(self):
+        return self._seconds
+
+    def initFromMidnightUTC(self, daysFromToday):
+        raise TypeError('Timestamp is immutable')
+
+    def setTime(self, hour, minute, second):
+        raise TypeError('Timestamp is immutable')
+
+    def __lt__(self, other):
+        try:
+            return self._seconds < other._seconds
+        except AttributeError:
+            return rdwTime.__lt__(self, other)
+
+    def __le__(self, other):
+        try:
+            return self._seconds <= other._seconds
+        except AttributeError:
+            return rdwTime.__le__(self, other)
+
+    def __gt__(self, other):
+        try:
+            return self._seconds > other._seconds
+        except AttributeError:
+            return rdwTime.__gt__(self, other)
+
+    def __ge__(self, other):
+        try:
+            return self._seconds >= other._seconds
+        except AttributeError:
+            return rdwTime.__ge__(self, other)
+
+    def __eq__(self, other):
+        try:
+            return self._seconds == other._seconds
+        except AttributeError:
+            return rdwTime.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._seconds)
+
+
 # Taken from ASPN:
 # http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/259173
 
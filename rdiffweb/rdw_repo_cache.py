@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of repository objects shared between requests.
+
+An `RdiffRepo` keeps in memory everything it reads from `rdiff-backup-data`
+(backup dates, statistics, hints). Keeping the object alive between
+requests avoids reading those again. An object is considered valid until
+the modification time of `rdiff-backup-data` or of the hint file changes,
+until rdiffweb modifies the repository (see `RdiffRepo.changed()`) or until
+it gets older than the configured time to live.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from builtins import object
+from builtins import str
+from collections import OrderedDict
+from future.utils.surrogateescape import encodefilename
+import logging
+import os
+import threading
+import time
+
+from rdiffweb.librdiff import RdiffRepo
+
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+def _mtime(path):
+    """Return the modification time of path or None if it doesn't exists."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class RepoCache(object):
+    """
+    Thread-safe LRU cache of `RdiffRepo` objects keyed by
+    `(user_root, path)`.
+
+    `size` is the maximum number of repositories kept in memory, 0 to
+    disable the cache. `ttl` is the maximum number of seconds a repository
+    object is kept, 0 to keep it until the repository changes. `cache_dir` and
+    `pool` are passed to every `RdiffRepo` created.
+    """
+
+    def __init__(self, size=100, ttl=300, cache_dir=None, pool=None):
+        self._size = size
+        self._ttl = ttl
+        self._cache_dir = cache_dir
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._repos = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, user_root, path):
+        if isinstance(user_root, str):
+            user_root = encodefilename(user_root)
+        if isinstance(path, str):
+            path = encodefilename(path)
+        return (user_root, path.strip(b"/"))
+
+    def _signature(self, repo):
+        """
+        Return the value used to detect modification of the repository.
+        The modification time may not change when modified within the same
+        second, the generation is incremented by rdiffweb.
+        """
+        return (_mtime(repo._data_path), _mtime(repo._hint_file), repo.generation)
+
+    def clear(self):
+        """Remove every repository from the cache."""
+        with self._lock:
+            self._repos.clear()
+
+    def get(self, user_root, path):
+        """
+        Return the repository object for the given location. Raise
+        DoesNotExistError if the repository doesn't exists.
+        """
+        key = self._key(user_root, path)
+        now = time.time()
+
+        # Lookup the cache. Remove the item to re-insert it as the most
+        # recently used.
+        with self._lock:
+            item = self._repos.pop(key, None)
+        previous = None
+        if item is not None:
+            repo, signature, created = item
+            if ((not self._ttl or now - created < self._ttl) and
+                    self._signature(repo) == signature):
+                with self._lock:
+                    self.hits += 1
+                    self._repos[key] = item
+                return repo
+            logger.debug("repository [%r] changed", repo.full_path)
+            previous = repo
+
+        # Create a new repository object. Compute the signature before
+        # reading any data from it.
+        with self._lock:
+            self.misses += 1
+        repo = RdiffRepo(key[0], key[1], cache_dir=self._cache_dir, pool=self._pool)
+        if previous is not None and previous.full_path == repo.full_path:
+            repo.reuse(previous)
+        if self._size <= 0:
+            return repo
+        item = (repo, self._signature(repo), now)
+        with self._lock:
+            self._repos[key] = item
+            while len(self._repos) > self._size:
+                self._repos.popitem(last=False)
+        return repo
+
+    def invalidate(self, user_root, path):
+        """Remove the given repository from the cache."""
+        key = self._key(user_root, path)
+        with self._lock:
+            self._repos.pop(key, None)
@@ -0,0 +1,852 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Execution of restores in a bounded pool of worker threads.
+
+Restores are expensive (rdiff-backup process, disk I/O, archiving). The
+executor limits the number of restores running at the same time, globally
+and per user. Other restores wait in a FIFO queue. When the queue is full,
+new restores are rejected until some restores complete.
+
+Restores may be cancelled using a `CancelToken`, fired when the client
+closes the stream or disconnects.
+
+Completed restores may be kept in a `RestoreCache` to be served again
+without running the restore. Identical restores requested at the same time
+are executed once and their output shared using `RestoreFlights`. The
+state of each restore is reported by a `RestoreProgress` registered in a
+`RestoreTracker`.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from builtins import object
+from collections import deque
+import errno
+import hashlib
+import io
+import logging
+import math
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+from rdiffweb.rdw_helpers import scandir
+
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Number of seconds an idle worker waits for new restore before exiting.
+IDLE_TIMEOUT = 60
+
+# Duration of a restore used to compute Retry-After until some restores
+# complete.
+DEFAULT_DURATION = 30
+
+# Read the output of in-flight restores by chunks.
+CHUNK_SIZE = 4096 * 16
+
+# Maximum size of the output of an in-flight restore kept in memory. A
+# restore is only shared with identical restores while its output is
+# smaller.
+FLIGHT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of seconds the progress of a completed restore is kept.
+PROGRESS_TTL = 300
+
+
+class CancelledError(Exception):
+    """
+    Raised when a restore is cancelled.
+    """
+    pass
+
+
+class CancelToken(object):
+    """
+    Thread-safe token used to cancel a restore. Callbacks registered with
+    `add_callback()` are called once when the token is cancelled. e.g.: to
+    kill a subprocess.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+
+    def add_callback(self, func):
+        """Register a function to be called on cancel. Call it immediately
+        if already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(func)
+                return
+        func()
+
+    def remove_callback(self, func):
+        with self._lock:
+            if func in self._callbacks:
+                self._callbacks.remove(func)
+
+    def cancel(self):
+        """Cancel the restore and call the registered callbacks."""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func()
+            except:
+                logger.warning('fail to cancel restore', exc_info=1)
+
+    def check(self):
+        """Raise CancelledError if the token is cancelled."""
+        if self.cancelled:
+            raise CancelledError()
+
+
+class CancellableReader(object):
+    """
+    Wrap the stream returned to the client. Closing it, explicitly or when
+    garbage collected, cancels the restore. `length` is the size of the
+    stream when known in advance.
+    """
+
+    def __init__(self, fp, token, length=None):
+        self.fp = fp
+        self.token = token
+        self.length = length
+
+    def __getattr__(self, key):
+        return getattr(self.fp, key)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        self.token.cancel()
+        self.fp.close()
+
+
+class CancellableWriter(object):
+    """
+    Wrap the stream where the restore is written. Raise CancelledError when
+    the token is cancelled or when the client is gone (broken pipe).
+    """
+
+    def __init__(self, fp, token):
+        self.fp = fp
+        self.token = token
+
+    def __getattr__(self, key):
+        return getattr(self.fp, key)
+
+    def write(self, data):
+        self.token.check()
+        try:
+            return self.fp.write(data)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.token.cancel()
+            raise CancelledError()
+
+    def close(self):
+        try:
+            self.fp.close()
+        except (IOError, OSError):
+            # Client is gone.
+            pass
+
+
+class RestoreCacheFile(object):
+    """
+    Temporary file where a restore is written. Must be committed once the
+    restore is completed to become available in the cache.
+    """
+
+    def __init__(self, cache, filename):
+        self._cache = cache
+        self._filename = filename
+        self._fp = tempfile.NamedTemporaryFile(
+            dir=cache.path, prefix='.tmp', delete=False)
+        self._failed = False
+
+    def write(self, data):
+        # Failing to write the cache (e.g.: disk full) must not break the
+        # restore.
+        if self._failed:
+            return
+        try:
+            self._fp.write(data)
+        except (IOError, OSError):
+            logger.warning("fail to write restore cache", exc_info=1)
+            self._failed = True
+
+    def commit(self):
+        """Make the file available in the cache."""
+        try:
+            self._fp.close()
+            if self._failed:
+                raise IOError('incomplete')
+            os.rename(self._fp.name, os.path.join(self._cache.path, self._filename))
+        except (IOError, OSError):
+            self.discard()
+            return
+        self._cache._evict()
+
+    def discard(self):
+        """Remove the temporary file."""
+        self._fp.close()
+        try:
+            os.remove(self._fp.name)
+        except OSError:
+            pass
+
+
+class RestoreCache(object):
+    """
+    Directory keeping the result of completed restores. Data backed up at a
+    given date never changes, so entries are immutable. They are removed
+    when the total size is bigger than `max_size` bytes, least recently used
+    first, or explicitly when backups are removed.
+
+    Entries are named `<repo>_<date>_<hash>`, where `repo` is a hash of the
+    repository location and `hash` identify the restored path and kind.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _repo_key(self, repo_path):
+        return hashlib.sha1(repo_path).hexdigest()[:16]
+
+    def _filename(self, repo_path, path, restore_date, kind):
+        assert isinstance(repo_path, bytes)
+        assert isinstance(path, bytes)
+        key = hashlib.sha1(path + b'\0' + kind.encode('ascii')).hexdigest()
+        return '%s_%d_%s' % (self._repo_key(repo_path), restore_date, key)
+
+    def create(self, repo_path, path, restore_date, kind):
+        """
+        Return a new RestoreCacheFile to write the given restore.
+        """
+        return RestoreCacheFile(self, self._filename(repo_path, path, restore_date, kind))
+
+    def _entries(self):
+        """Return the list of (name, size, atime) of the cached restores."""
+        entries = []
+        for e in scandir(self.path):
+            if e.name.startswith('.'):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((e.name, st.st_size, st.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Remove least recently used entries until the size is below the
+        limit."""
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            size = sum(e[1] for e in entries)
+            while entries and size > self.max_size:
+                name, entry_size, unused = entries.pop(0)
+                logger.debug("remove restore [%s] from cache", name)
+                self._remove(name)
+                size -= entry_size
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def invalidate(self, repo_path, before=None):
+        """
+        Remove the cached restores of the given repository. If defined, only
+        remove the restores of dates before `before` (epoch).
+        """
+        prefix = self._repo_key(repo_path) + '_'
+        for name, unused, unused in self._entries():
+            if not name.startswith(prefix):
+                continue
+            if before is None or int(name.split('_')[1]) < before:
+                self._remove(name)
+
+    def open(self, repo_path, path, restore_date, kind):
+        """
+        Open the cached restore or return None if not found.
+        """
+        fn = os.path.join(self.path, self._filename(repo_path, path, restore_date, kind))
+        try:
+            f = io.open(fn, 'rb')
+        except (IOError, OSError):
+            return None
+        # Update modification time for LRU eviction.
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+        return f
+
+
+class RestoreFlight(object):
+    """
+    Output of an in-flight restore shared by every client requesting it.
+    The output is kept in memory until a second client joins the restore,
+    then written into a temporary file followed by every reader as it
+    grows. Clients may only join while the whole output is in memory: once
+    it gets bigger than FLIGHT_BUFFER_SIZE, the restore is not shared and
+    the memory is released as the data is read, like a pipe. The restore
+    is cancelled when every reader is closed.
+    """
+
+    def __init__(self, flights, key, progress=None):
+        self._flights = flights
+        self.key = key
+        self.progress = progress
+        self.token = CancelToken()
+        self._cond = threading.Condition()
+        # Data in memory starting at offset `_start` of the output.
+        self._chunks = deque()
+        self._start = 0
+        # Temporary file used once shared.
+        self._fp = None
+        # Readers closed when garbage collected.
+        self._readers = weakref.WeakSet()
+        self.joinable = True
+        self.size = 0
+        self.done = False
+        # Size of the output when known in advance.
+        self.length = None
+
+    def write(self, data):
+        self.token.check()
+        with self._cond:
+            if self._fp:
+                self._fp.write(data)
+                self._fp.flush()
+            else:
+                # Wait for the reader like a pipe.
+                while (not self.joinable and self.size - self._start >= FLIGHT_BUFFER_SIZE and
+                       not self.token.cancelled):
+                    self._cond.wait()
+                self.token.check()
+                self._chunks.append(data)
+            self.size += len(data)
+            self._cond.notify_all()
+            leave = self.joinable and not self._fp and self.size > FLIGHT_BUFFER_SIZE
+            if leave:
+                self.joinable = False
+        if leave:
+            logger.debug("restore [%r] too big to be shared", self.key)
+            self._flights._remove(self)
+
+    def close(self):
+        """
+        Called by the restore when completed or failed. Readers get the end
+        of the stream once they read everything written.
+        """
+        self._flights._remove(self)
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self._cond.notify_all()
+            if not self._fp:
+                return
+        self._fp.close()
+        # Opened readers keep reading the data.
+        try:
+            os.remove(self._fp.name)
+        except OSError:
+            pass
+
+    def open(self):
+        """
+        Return a new reader of the restore output. Return None if the
+        restore is already completed or not shared.
+        """
+        with self._cond:
+            if self.done or not self.joinable:
+                return None
+            if self._readers and not self._fp:
+                # Second client, share the output with a temporary file.
+                self._fp = tempfile.NamedTemporaryFile(prefix='rdiffweb_flight_', delete=False)
+                for data in self._chunks:
+                    self._fp.write(data)
+                self._fp.flush()
+                self._chunks.clear()
+                for reader in list(self._readers):
+                    reader._follow(self._fp.name)
+            reader = RestoreFlightReader(self)
+            if self._fp:
+                reader._follow(self._fp.name)
+            self._readers.add(reader)
+            return reader
+
+    def _release(self, reader):
+        with self._cond:
+            self._readers.discard(reader)
+            if self._readers or self.done:
+                return
+        logger.debug("every client of restore [%r] is gone", self.key)
+        self.token.cancel()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _read(self, reader, size):
+        """
+        Return up to `size` bytes from the memory at the position of the
+        given reader or None if it follows the temporary file. Wait for the
+        data not yet written. Return empty bytes at the end.
+        """
+        with self._cond:
+            while self.size <= reader._pos and not self.done and not self._fp:
+                self._cond.wait()
+            if self._fp:
+                return None
+            pos = reader._pos
+            if self.size <= pos:
+                return b''
+            offset = self._start
+            data = []
+            for chunk in self._chunks:
+                if offset + len(chunk) > pos:
+                    data.append(chunk[max(pos - offset, 0):])
+                    if offset + len(chunk) - pos >= size:
+                        break
+                offset += len(chunk)
+            data = b''.join(data)[:size]
+            reader._pos += len(data)
+            if not self.joinable:
+                # Release the data read by the only reader.
+                while self._chunks and self._start + len(self._chunks[0]) <= reader._pos:
+                    self._start += len(self._chunks.popleft())
+                self._cond.notify_all()
+            return data
+
+    def _wait(self, pos):
+        """
+        Wait until more than `pos` bytes are written. Return False if the
+        restore is done.
+        """
+        with self._cond:
+            while self.size <= pos and not self.done:
+                self._cond.wait()
+            return self.size > pos
+
+
+class RestoreFlightReader(object):
+    """
+    Read the output of an in-flight restore, waiting for the data not yet
+    written.
+    """
+
+    def __init__(self, flight):
+        self.flight = flight
+        self._fp = None
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def length(self):
+        return self.flight.length
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        # The file is growing, don't let the caller look at its size.
+        raise io.UnsupportedOperation('fileno')
+
+    def _follow(self, filename):
+        """
+        Called when the output is shared to read the temporary file from
+        the current position.
+        """
+        if self.closed:
+            return
+        self._fp = io.open(filename, 'rb')
+        self._fp.seek(self._pos)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        if self._fp is None:
+            data = self.flight._read(self, size)
+            if data is not None:
+                return data
+        while True:
+            data = self._fp.read(size)
+            if data or not self.flight._wait(self._fp.tell()):
+                return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._fp:
+            self._fp.close()
+        self.flight._release(self)
+
+
+class RestoreFlights(object):
+    """
+    Registry of in-flight restores used to execute identical restores once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def acquire(self, key, progress=None):
+        """
+        Return a tuple (flight, reader). When an identical restore is in
+        progress, `flight` is None and `reader` reads its output. Otherwise,
+        the caller must execute the restore, write its output to `flight`
+        and close it. `progress` is the RestoreProgress of the caller, shared
+        with the followers.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                reader = flight.open()
+                if reader is not None:
+                    return None, reader
+            flight = RestoreFlight(self, key, progress)
+            self._flights[key] = flight
+            return flight, flight.open()
+
+    def _remove(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+
+class RestoreProgress(object):
+    """
+    Thread-safe state of a restore: phase, number of files and bytes
+    processed and estimated total. `estimate` may be defined to a function
+    returning a tuple (files, bytes) called once when the total is
+    requested.
+    """
+
+    QUEUED = 'queued'
+    RESTORING = 'restoring'
+    ARCHIVING = 'archiving'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, restore_id, user, repo, path, kind):
+        self.id = restore_id
+        self.user = user
+        self.repo = repo
+        self.path = path
+        self.kind = kind
+        self.phase = RestoreProgress.QUEUED
+        self.files = 0
+        self.bytes = 0
+        self.written = 0
+        self.started = time.time()
+        self.completed = None
+        self.estimate = None
+        self._total = None
+        self._source = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.phase in (RestoreProgress.DONE, RestoreProgress.FAILED, RestoreProgress.CANCELLED)
+
+    def follow(self, other):
+        """Report the progress of another restore. e.g.: in-flight restore."""
+        self._source = other
+
+    def set_phase(self, phase):
+        with self._lock:
+            if self.finished:
+                return
+            self.phase = phase
+            if self.finished:
+                self.completed = time.time()
+
+    def add_file(self, filename, st=None):
+        """
+        Called by the archiver for every file added with the result of
+        lstat() if known.
+        """
+        if st is None:
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                pass
+        with self._lock:
+            self.files += 1
+            if st is not None and stat.S_ISREG(st.st_mode):
+                self.bytes += st.st_size
+
+    def add_written(self, size):
+        with self._lock:
+            if self.phase == RestoreProgress.RESTORING:
+                self.phase = RestoreProgress.ARCHIVING
+            self.written += size
+
+    def _get_total(self):
+        if self._total is None and self.estimate:
+            try:
+                self._total = self.estimate()
+            except:
+                logger.warning("fail to estimate restore size", exc_info=1)
+                self._total = (None, None)
+        return self._total or (None, None)
+
+    def to_dict(self):
+        """Return the progress as a dict serializable to JSON."""
+        if self._source is not None:
+            data = self._source.to_dict()
+            data.update({'id': self.id, 'user': self.user})
+            return data
+        total_files, total_bytes = self._get_total()
+        with self._lock:
+            return {
+                'id': self.id,
+                'user': self.user,
+                'repo': self.repo,
+                'path': self.path,
+                'kind': self.kind,
+                'phase': self.phase,
+                'files': self.files,
+                'bytes': self.bytes,
+                'written': self.written,
+                'total_files': total_files,
+                'total_bytes': total_bytes,
+                'elapsed': (self.completed or time.time()) - self.started,
+            }
+
+
+class _ProgressWriter(object):
+    """
+    Count the bytes written to the given file object.
+    """
+
+    def __init__(self, fp, progress):
+        self.fp = fp
+        self.progress = progress
+
+    def __getattr__(self, key):
+        return getattr(self.fp, key)
+
+    def write(self, data):
+        self.fp.write(data)
+        self.progress.add_written(len(data))
+
+
+class RestoreTracker(object):
+    """
+    Thread-safe registry of the restores progress. The progress of a
+    completed restore is kept for `ttl` seconds.
+    """
+
+    def __init__(self, ttl=PROGRESS_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._restores = {}
+
+    def _cleanup(self):
+        now = time.time()
+        for key, progress in list(self._restores.items()):
+            if progress.completed and now - progress.completed > self._ttl:
+                del self._restores[key]
+
+    def create(self, user, repo, path, kind, restore_id=None):
+        """
+        Register a new restore. Use the given `restore_id` if not already
+        used, usually generated by the client to follow the restore.
+        """
+        with self._lock:
+            self._cleanup()
+            if not restore_id or restore_id in self._restores:
+                restore_id = uuid.uuid4().hex
+            progress = RestoreProgress(restore_id, user, repo, path, kind)
+            self._restores[restore_id] = progress
+            return progress
+
+    def get(self, restore_id):
+        """Return the progress of the given restore or None."""
+        with self._lock:
+            return self._restores.get(restore_id)
+
+    def list(self, user=None):
+        """Return the restores of the given user or every restores."""
+        with self._lock:
+            self._cleanup()
+            return [
+                p for p in self._restores.values()
+                if user is None or p.user == user]
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the restore queue is full. `retry_after` is the estimated
+    number of seconds before a restore could be accepted.
+    """
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'restore queue is full')
+        self.retry_after = retry_after
+
+
+class RestoreExecutor(object):
+    """
+    Thread-safe executor running restores in a pool of worker threads.
+
+    `max_workers` is the maximum number of restores running at the same
+    time. `max_per_user` is the maximum number of restores running at the
+    same time for a single user, 0 for no limit. `max_queue` is the maximum
+    number of restores waiting to be executed, 0 for no limit.
+    """
+
+    def __init__(self, max_workers=4, max_per_user=2, max_queue=50):
+        assert max_workers > 0
+        self._max_workers = max_workers
+        self._max_per_user = max_per_user
+        self._max_queue = max_queue
+        self._cond = threading.Condition()
+        # Pending restores: (func, user, submit time)
+        self._queue = deque()
+        # Number of running restores per user.
+        self._users = {}
+        self._workers = 0
+        # Statistics
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self._wait_total = 0.0
+        self._duration_total = 0.0
+
+    def _next(self):
+        """
+        Remove and return the first restore allowed to run or None.
+        """
+        if self.active >= self._max_workers:
+            return None
+        for item in self._queue:
+            if not self._max_per_user or self._users.get(item[1], 0) < self._max_per_user:
+                self._queue.remove(item)
+                return item
+        return None
+
+    def _retry_after(self):
+        """
+        Estimate the number of seconds before a restore could be accepted.
+        """
+        duration = DEFAULT_DURATION
+        if self.completed:
+            duration = self._duration_total / self.completed
+        return max(1, int(math.ceil(duration * (len(self._queue) + 1) / self._max_workers)))
+
+    def _run(self):
+        """
+        Worker loop executing restores until idle for too long.
+        """
+        while True:
+            with self._cond:
+                item = self._next()
+                deadline = time.time() + IDLE_TIMEOUT
+                while item is None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._workers -= 1
+                        return
+                    self._cond.wait(remaining)
+                    item = self._next()
+                func, user, submitted = item
+                start = time.time()
+                self.active += 1
+                self._users[user] = self._users.get(user, 0) + 1
+                self._wait_total += start - submitted
+            try:
+                func()
+            except:
+                logger.error('restore failed', exc_info=1)
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    self._users[user] -= 1
+                    if not self._users[user]:
+                        del self._users[user]
+                    self.completed += 1
+                    self._duration_total += time.time() - start
+                    # Let other workers pick restores of the same user.
+                    self._cond.notify_all()
+
+    def stats(self):
+        """
+        Return a dict with the state of the executor for monitoring.
+        """
+        with self._cond:
+            total = self.completed + self.active
+            oldest = self._queue[0][2] if self._queue else None
+            return {
+                'active': self.active,
+                'queued': len(self._queue),
+                'workers': self._workers,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait': self._wait_total / total if total else 0.0,
+                'queued_wait': time.time() - oldest if oldest else 0.0,
+                'avg_duration': self._duration_total / self.completed if self.completed else 0.0,
+            }
+
+    def submit(self, func, user=None):
+        """
+        Queue `func` to be executed by a worker. Raise QueueFullError if the
+        queue is full.
+        """
+        with self._cond:
+            if self._max_queue and len(self._queue) >= self._max_queue:
+                self.rejected += 1
+                retry_after = self._retry_after()
+                logger.warning("restore queue is full, retry after %ss", retry_after)
+                raise QueueFullError(retry_after)
+            self._queue.append((func, user, time.time()))
+            logger.debug("restore queued, %s active, %s queued", self.active, len(self._queue))
+            # Start a new worker if all of them are busy.
+            if self._workers < min(self._max_workers, self.active + len(self._queue)):
+                self._workers += 1
+                thread = threading.Thread(target=self._run, name='Restore-%s' % self._workers)
+                thread.daemon = True
+                thread.start()
+            self._cond.notify_all()
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Worker process executing rdiff-backup commands without paying for the
+interpreter startup and the import of rdiff-backup on every execution.
+
+This script is executed with the interpreter of rdiff-backup, which may be
+a different python version than rdiffweb. It must not import rdiffweb and
+must stay compatible with python 2 and 3.
+
+The rdiff-backup module is imported once. For every job received on stdin,
+a child process is forked to run rdiff-backup with the given arguments.
+All integers are 4 bytes big-endian. A job is the number of arguments
+followed by each argument (length + bytes). A number of arguments of -1
+is a health check. While a job is running, -2 cancels it: the child is
+killed by the worker, which is the only one to know if it's still
+running. A cancel received when no job is running is ignored. The worker
+replies with:
+ * on startup: 0 when rdiff-backup is imported, 1 otherwise,
+ * for a health check: 0,
+ * for a job: the pid of the child, then the exit code (negative signal
+   number if killed), stdout and stderr (length + bytes).
+
+Usage: python rdw_worker_server.py [module:function]
+"""
+
+import os
+import select
+import signal
+import struct
+import sys
+import tempfile
+import traceback
+
+# Entry points of rdiff-backup called with the list of arguments.
+ENTRY_POINTS = ['rdiff_backup.Main:error_check_Main', 'rdiffbackup.run:main_run']
+
+# Control messages sent instead of the number of arguments.
+HEALTH_CHECK = -1
+CANCEL = -2
+
+
+def _read(f, n):
+    data = b''
+    while len(data) < n:
+        chunk = f.read(n - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _read_int(f):
+    return struct.unpack(b'>i', _read(f, 4))[0]
+
+
+def _write_int(f, value):
+    f.write(struct.pack(b'>i', value))
+
+
+def _write_bytes(f, data):
+    _write_int(f, len(data))
+    f.write(data)
+
+
+def _load(entry_points):
+    """
+    Import and return the first entry point available.
+    """
+    for entry in entry_points:
+        module, func = entry.split(':')
+        try:
+            return getattr(__import__(module, fromlist=[func]), func)
+        except (ImportError, AttributeError):
+            continue
+    raise ImportError('rdiff-backup is not available')
+
+
+def _run(main, args, out, err):
+    """
+    Called in the child process to execute rdiff-backup. Never returns.
+    """
+    code = 1
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        sys.argv = ['rdiff-backup'] + args
+        try:
+            # Recent rdiff-backup returns the exit code instead of exiting.
+            ret = main(args)
+            code = ret if isinstance(ret, int) else 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write('%s\n' % e.code)
+                code = 1
+        except:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+
+def _wait(pid, fin, exit_fd):
+    """
+    Wait for the child `pid` to exit while reading the control messages
+    received on `fin`. `exit_fd` is closed when the child exits. The child
+    is killed when the job is cancelled or when `fin` is closed. Return a
+    tuple (status, closed).
+    """
+    closed = False
+    while True:
+        fds = [exit_fd] if closed else [exit_fd, fin]
+        # The timeout covers a grandchild keeping `exit_fd` open.
+        readable = select.select(fds, [], [], 1)[0]
+        if fin in readable:
+            try:
+                message = _read_int(fin)
+            except EOFError:
+                closed = True
+                message = CANCEL
+            if message == CANCEL:
+                # Not yet reaped, the pid cannot be reused.
+                os.kill(pid, signal.SIGKILL)
+        if exit_fd in readable and not os.read(exit_fd, 1):
+            return os.waitpid(pid, 0)[1], closed
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid:
+            return status, closed
+
+
+def serve(main, fin, fout):
+    """
+    Execute the jobs received on `fin` until end of file.
+    """
+    while True:
+        try:
+            count = _read_int(fin)
+        except EOFError:
+            return
+        if count == CANCEL:
+            # The job is already completed.
+            continue
+        if count < 0:
+            # Health check.
+            _write_int(fout, 0)
+            fout.flush()
+            continue
+        args = [_read(fin, _read_int(fin)) for unused in range(count)]
+        if sys.version_info[0] >= 3:
+            args = [os.fsdecode(a) for a in args]
+
+        out = tempfile.TemporaryFile()
+        err = tempfile.TemporaryFile()
+        # The write end is only kept open by the child.
+        exit_r, exit_w = os.pipe()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                os.close(fin.fileno())
+                os.close(fout.fileno())
+                os.close(exit_r)
+                _run(main, args, out, err)
+            os.close(exit_w)
+            _write_int(fout, pid)
+            fout.flush()
+            status, closed = _wait(pid, fin, exit_r)
+            if closed:
+                return
+            if os.WIFSIGNALED(status):
+                code = -os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            out.seek(0)
+            err.seek(0)
+            _write_int(fout, code)
+            _write_bytes(fout, out.read())
+            _write_bytes(fout, err.read())
+            fout.flush()
+        finally:
+            os.close(exit_r)
+            out.close()
+            err.close()
+
+
+def main():
+    # Keep stdin and stdout for the protocol. Anything printed by
+    # rdiff-backup goes to stderr.
+    # Unbuffered to wait for control messages with select().
+    fin = os.fdopen(os.dup(0), 'rb', 0)
+    fout = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    try:
+        func = _load(sys.argv[1:] or ENTRY_POINTS)
+    except:
+        traceback.print_exc()
+        _write_int(fout, 1)
+        fout.flush()
+        return 1
+    _write_int(fout, 0)
+    fout.flush()
+    serve(func, fin, fout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
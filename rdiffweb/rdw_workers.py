@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pool of long-lived worker processes executing rdiff-backup.
+
+Each worker runs `rdw_worker_server` with the interpreter of rdiff-backup.
+It imports rdiff-backup once and forks a child for every job. Workers are
+checked before being used after some idle time and replaced after a number
+of jobs. When no worker is available, the caller should fall back to
+executing rdiff-backup in a new process.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from builtins import object
+import logging
+import os
+import shlex
+import struct
+import subprocess
+import threading
+import time
+
+from rdiffweb import rdw_worker_server
+
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Number of seconds a worker may be idle before being checked.
+HEALTH_CHECK_INTERVAL = 30
+
+
+class WorkerError(Exception):
+    """
+    Raised when a worker is not responding as expected.
+    """
+    pass
+
+
+def _which(name):
+    """Return the location of the given executable or None."""
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        fn = os.path.join(d, name)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return fn
+    return None
+
+
+def find_command(executable='rdiff-backup'):
+    """
+    Return the command used to start a worker with the interpreter of
+    rdiff-backup or None if it cannot be found.
+    """
+    fn = _which(executable)
+    if not fn:
+        return None
+    try:
+        with open(fn, 'rb') as f:
+            line = f.readline(1024)
+    except IOError:
+        return None
+    if not line.startswith(b'#!'):
+        # Not a python script.
+        return None
+    interpreter = shlex.split(line[2:].decode('utf-8', 'replace').strip())
+    if not interpreter:
+        return None
+    server = os.path.splitext(rdw_worker_server.__file__)[0] + '.py'
+    return interpreter + [server]
+
+
+class _Worker(object):
+    """
+    A running worker process.
+    """
+
+    def __init__(self, command, env):
+        self.jobs = 0
+        self.last_used = time.time()
+        # Protect the job being cancelled from another thread.
+        self._lock = threading.Lock()
+        self._running = False
+        self._proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=env, close_fds=True)
+        try:
+            if self._read_int() != 0:
+                raise WorkerError('fail to import rdiff-backup')
+        except:
+            self.close()
+            raise
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self._proc.stdout.read(n - len(data))
+            if not chunk:
+                raise WorkerError('worker is gone')
+            data += chunk
+        return data
+
+    def _read_int(self):
+        return struct.unpack(b'>i', self._read(4))[0]
+
+    def _send(self, *values):
+        try:
+            for value in values:
+                if isinstance(value, bytes):
+                    self._proc.stdin.write(struct.pack(b'>i', len(value)) + value)
+                else:
+                    self._proc.stdin.write(struct.pack(b'>i', value))
+            self._proc.stdin.flush()
+        except (IOError, OSError) as e:
+            raise WorkerError(str(e))
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def ping(self):
+        """Check if the worker is responding."""
+        self._send(rdw_worker_server.HEALTH_CHECK)
+        if self._read_int() != 0:
+            raise WorkerError('invalid health check')
+
+    def execute(self, args, cancel=None):
+        """
+        Execute rdiff-backup with the given arguments. Return a tuple
+        (exit code, output, error).
+        """
+        self._send(len(args), *args)
+        # Pid of the child, only known to be running by the worker.
+        self._read_int()
+        self.jobs += 1
+        self._running = True
+
+        def kill():
+            # Let the worker kill its child. Once the job is completed, the
+            # worker may be used by another job.
+            with self._lock:
+                if self._running:
+                    self._send(rdw_worker_server.CANCEL)
+
+        if cancel:
+            cancel.add_callback(kill)
+        try:
+            code = self._read_int()
+            output = self._read(self._read_int())
+            error = self._read(self._read_int())
+        finally:
+            with self._lock:
+                self._running = False
+            if cancel:
+                cancel.remove_callback(kill)
+        self.last_used = time.time()
+        return code, output, error
+
+    def close(self):
+        """Stop the worker."""
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._proc.stdout.close()
+
+
+class RdiffBackupPool(object):
+    """
+    Thread-safe pool of at most `size` rdiff-backup workers. A worker is
+    replaced after `max_jobs` jobs. `command` is used to start a worker,
+    by default the interpreter of rdiff-backup found in PATH.
+    """
+
+    def __init__(self, size=2, max_jobs=100, command=None):
+        assert size > 0
+        self._size = size
+        self._max_jobs = max_jobs
+        self._command = command
+        self._lock = threading.Lock()
+        self._idle = []
+        self._count = 0
+        # Set when workers cannot be started.
+        self._disabled = False
+
+    def _get_command(self):
+        if self._command is None:
+            self._command = find_command() or False
+            if not self._command:
+                logger.info("rdiff-backup interpreter not found, workers disabled")
+        return self._command
+
+    def _acquire(self, env):
+        """
+        Return an idle worker, start a new one or return None if every
+        worker is busy.
+        """
+        while True:
+            with self._lock:
+                if self._disabled:
+                    return None
+                if self._idle:
+                    worker = self._idle.pop()
+                elif self._count < self._size:
+                    self._count += 1
+                    worker = None
+                else:
+                    return None
+            if worker is None:
+                return self._start(env)
+            if self._check(worker):
+                return worker
+            self._discard(worker)
+
+    def _check(self, worker):
+        """Check the health of an idle worker."""
+        if not worker.alive:
+            return False
+        if time.time() - worker.last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            worker.ping()
+            return True
+        except WorkerError:
+            logger.warning("rdiff-backup worker is not responding")
+            return False
+
+    def _start(self, env):
+        command = self._get_command()
+        if command:
+            try:
+                logger.debug("starting rdiff-backup worker %r", command)
+                return _Worker(command, env)
+            except (OSError, WorkerError):
+                logger.warning("fail to start rdiff-backup worker, workers disabled", exc_info=1)
+        with self._lock:
+            self._disabled = True
+            self._count -= 1
+        return None
+
+    def _discard(self, worker):
+        worker.close()
+        with self._lock:
+            self._count -= 1
+
+    def _release(self, worker):
+        if worker.jobs >= self._max_jobs:
+            logger.debug("recycling rdiff-backup worker after %s jobs", worker.jobs)
+            self._discard(worker)
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def close(self):
+        """Stop the idle workers."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for worker in idle:
+            worker.close()
+
+    def execute(self, args, env=None, cancel=None):
+        """
+        Execute rdiff-backup with the given arguments using a worker.
+        Return a tuple (exit code, output, error) or None if no worker is
+        available. Raise WorkerError if the worker fails during the
+        execution.
+        """
+        worker = self._acquire(env)
+        if worker is None:
+            return None
+        jobs = worker.jobs
+        try:
+            result = worker.execute(args, cancel=cancel)
+        except WorkerError:
+            self._discard(worker)
+            if worker.jobs == jobs:
+                # The job was not started, let the caller retry.
+                logger.warning("rdiff-backup worker is gone", exc_info=1)
+                return None
+            raise
+        except:
+            self._discard(worker)
+            raise
+        self._release(worker)
+        return result
@@ -26,17 +26,23 @@ Test archiver module.
 from __future__ import unicode_literals
 
 from future.builtins import str
+import gzip
 import io
 import os
 import shutil
+import struct
 import sys
 import tarfile
 import tempfile
 import threading
 import unittest
-from zipfile import ZipFile
+from mock import patch
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED, structFileHeader, \
+    sizeFileHeader, _FH_COMPRESSION_METHOD, _FH_GENERAL_PURPOSE_FLAG_BITS, _FH_CRC, \
+    _FH_COMPRESSED_SIZE, _FH_UNCOMPRESSED_SIZE
 
-from rdiffweb.archiver import archive
+from rdiffweb import archiver
+from rdiffweb.archiver import archive, archive_size, ParallelGzipFile, TarArchiver
 from rdiffweb.test import AppTestCase
 
 
@@ -304,6 +310,210 @@ class ArchiverTest(AppTestCase):
         finally:
             os.remove(filename)
 
+    def test_pipe_zip_file_parallel(self):
+        """
+        Check creation of a zip compressed by many threads.
+        """
+        rfd, wfd = os.pipe()
+        # Run archiver
+        archive_async(self.path, io.open(wfd, 'wb'), encoding='utf-8', kind='zip', threads=4, level=1)
+        # Check result.
+        self.assertInZip(ZIP_EXPECTED, io.open(rfd, 'rb'))
+
+    def test_zip_file_parallel(self):
+        """
+        Check content of a zip compressed by many threads.
+        """
+        filename = tempfile.mktemp(prefix='rdiffweb_test_archiver_', suffix='.zip')
+        try:
+            # Run archiver
+            with open(filename, 'wb') as f:
+                archive(self.path, f, encoding='utf-8', kind='zip', threads=4)
+            # Check result.
+            self.assertInZip(ZIP_EXPECTED, filename)
+            with ZipFile(filename) as z:
+                self.assertIsNone(z.testzip())
+                self.assertEqual(b'Version3\n', z.read('Revisions/Data'))
+        finally:
+            os.remove(filename)
+
+    def test_tar_gz_file_parallel(self):
+        """
+        Check creation of tar.gz compressed by many threads.
+        """
+        filename = tempfile.mktemp(prefix='rdiffweb_test_archiver_', suffix='.tar.gz')
+        try:
+            # Run archiver
+            with open(filename, 'wb') as f:
+                archive(self.path, f, encoding='utf-8', kind='tar.gz', threads=4, level=1)
+            # Check result.
+            self.assertInTar(TAR_EXPECTED, filename)
+        finally:
+            os.remove(filename)
+
+    def test_zip_file_store(self):
+        """
+        Check incompressible files are stored.
+        """
+        filename = tempfile.mktemp(prefix='rdiffweb_test_archiver_', suffix='.zip')
+        try:
+            with open(filename, 'wb') as f:
+                archive(self.path, f, encoding='utf-8', kind='zip')
+            with ZipFile(filename) as z:
+                self.assertEqual(ZIP_STORED, z.getinfo("이루마 YIRUMA - River Flows in You.mp3").compress_type)
+                self.assertEqual(ZIP_DEFLATED, z.getinfo("Char ;059090 to quote/Untitled Testcase.doc").compress_type)
+            # Compress everything.
+            with open(filename, 'wb') as f:
+                archive(self.path, f, encoding='utf-8', kind='zip', threshold=None)
+            with ZipFile(filename) as z:
+                self.assertEqual(ZIP_DEFLATED, z.getinfo("이루마 YIRUMA - River Flows in You.mp3").compress_type)
+        finally:
+            os.remove(filename)
+
+    def test_zip_file_stored_header(self):
+        """
+        Check stored files have their CRC and sizes in the local header
+        without data descriptor.
+        """
+        f = io.BytesIO()
+        f.close = lambda: None
+        archive(self.path, f, encoding='utf-8', kind='zip', level=0, bufsize=4096)
+        data = f.getvalue()
+        with ZipFile(f) as z:
+            self.assertIsNone(z.testzip())
+            for zinfo in z.infolist():
+                header = struct.unpack(structFileHeader, data[zinfo.header_offset:zinfo.header_offset + sizeFileHeader])
+                self.assertEqual(ZIP_STORED, header[_FH_COMPRESSION_METHOD])
+                self.assertEqual(0, header[_FH_GENERAL_PURPOSE_FLAG_BITS] & 0x08)
+                self.assertEqual(zinfo.CRC, header[_FH_CRC])
+                self.assertEqual(zinfo.file_size, header[_FH_COMPRESSED_SIZE])
+                self.assertEqual(zinfo.file_size, header[_FH_UNCOMPRESSED_SIZE])
+
+    def test_zip_file_spool(self):
+        """
+        Check central directory written to a temporary file.
+        """
+        filename = tempfile.mktemp(prefix='rdiffweb_test_archiver_', suffix='.zip')
+        with patch.object(archiver, 'SPOOL_SIZE', 100):
+            try:
+                with open(filename, 'wb') as f:
+                    archive(self.path, f, encoding='utf-8', kind='zip')
+                self.assertInZip(ZIP_EXPECTED, filename)
+            finally:
+                os.remove(filename)
+
+    def test_tar_no_members(self):
+        """
+        Check members are not kept in memory.
+        """
+        a = TarArchiver(io.BytesIO())
+        a.addfile(os.path.join(self.path, b'Revisions').decode('utf-8'), 'Revisions')
+        a.addfile(os.path.join(self.path, b'Revisions', b'Data').decode('utf-8'), 'Revisions/Data')
+        self.assertEqual([], a.z.members)
+        a.close()
+
+    def test_zip_file_probe(self):
+        """
+        Check files not worth compressing are stored.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        try:
+            path = os.path.join(temp_dir, 'data').encode('utf-8')
+            os.mkdir(path)
+            with open(os.path.join(path, b'random'), 'wb') as f:
+                f.write(os.urandom(16384))
+            with open(os.path.join(path, b'text'), 'wb') as f:
+                f.write(b'a' * 16384)
+            with open(os.path.join(path, b'photo.JPG'), 'wb') as f:
+                f.write(b'a' * 16384)
+            filename = os.path.join(temp_dir, 'data.zip')
+            with open(filename, 'wb') as f:
+                archive(path, f, encoding='utf-8', kind='zip')
+            with ZipFile(filename) as z:
+                self.assertEqual(ZIP_STORED, z.getinfo('random').compress_type)
+                self.assertEqual(ZIP_DEFLATED, z.getinfo('text').compress_type)
+                self.assertEqual(ZIP_STORED, z.getinfo('photo.JPG').compress_type)
+                self.assertEqual(b'a' * 16384, z.read('photo.JPG'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_zip_file_probe_mixed(self):
+        """
+        Check a file starting with incompressible data is compressed when
+        the rest of it is compressible.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        try:
+            path = os.path.join(temp_dir, 'data').encode('utf-8')
+            os.mkdir(path)
+            data = os.urandom(100 * 1024) + b'a' * (5 * 1024 * 1024)
+            with open(os.path.join(path, b'mixed'), 'wb') as f:
+                f.write(data)
+            filename = os.path.join(temp_dir, 'data.zip')
+            with open(filename, 'wb') as f:
+                archive(path, f, encoding='utf-8', kind='zip', bufsize=64 * 1024)
+            self.assertLess(os.path.getsize(filename), len(data) // 4)
+            with ZipFile(filename) as z:
+                self.assertEqual(ZIP_DEFLATED, z.getinfo('mixed').compress_type)
+                self.assertEqual(data, z.read('mixed'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_callback(self):
+        """
+        Check callback is called with the stat of each file.
+        """
+        files = []
+        with open(os.devnull, 'wb') as f:
+            archive(self.path, f, encoding='utf-8', kind='tar', callback=lambda fn, st: files.append((fn, st)),
+                    bufsize=4096)
+        self.assertEqual(len(TAR_EXPECTED), len(files))
+        for fn, st in files:
+            self.assertEqual(os.lstat(fn).st_mode, st.st_mode)
+
+    def test_archive_size(self):
+        """
+        Check the size computed without reading the files is the size of
+        the archive.
+        """
+        for kind, level in [('tar', None), ('zip', 0)]:
+            f = io.BytesIO()
+            f.close = lambda: None
+            archive(self.path, f, encoding='utf-8', kind=kind, level=level, exclude=[b'Revisions'])
+            self.assertEqual(
+                len(f.getvalue()),
+                archive_size(self.path, encoding='utf-8', kind=kind, level=level, exclude=[b'Revisions']))
+        # Files are stored with level 0.
+        with ZipFile(f) as z:
+            self.assertEqual(ZIP_STORED, z.getinfo("Char ;059090 to quote/Untitled Testcase.doc").compress_type)
+
+    def test_archive_size_max_files(self):
+        self.assertIsNone(archive_size(self.path, encoding='utf-8', kind='tar', max_files=2))
+        self.assertTrue(archive_size(self.path, encoding='utf-8', kind='tar', max_files=1000))
+
+    def test_archive_size_compressed(self):
+        # Unknown until the data is compressed.
+        self.assertIsNone(archive_size(self.path, encoding='utf-8', kind='zip'))
+        self.assertIsNone(archive_size(self.path, encoding='utf-8', kind='tar.gz', level=0))
+
+    def test_parallel_gzip_file(self):
+        data = b''.join(b'%d\n' % i for i in range(100000))
+        f = io.BytesIO()
+        g = ParallelGzipFile(f, threads=4, block_size=4096)
+        for i in range(0, len(data), 1000):
+            g.write(data[i:i + 1000])
+        g.close()
+        self.assertEqual(data, gzip.GzipFile(fileobj=io.BytesIO(f.getvalue())).read())
+
+    def test_parallel_gzip_file_store(self):
+        # Incompressible blocks are stored.
+        data = os.urandom(1024 * 1024)
+        f = io.BytesIO()
+        g = ParallelGzipFile(f, threads=2, block_size=256 * 1024, threshold=0.95)
+        g.write(data)
+        g.close()
+        self.assertEqual(data, gzip.GzipFile(fileobj=io.BytesIO(f.getvalue())).read())
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
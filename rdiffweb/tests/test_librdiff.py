@@ -27,17 +27,25 @@ from __future__ import unicode_literals
 
 from builtins import bytes
 from future.utils import native_str
+import io
+from mock import patch
 import os
 import pkg_resources
 import shutil
 import tarfile
 import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 from rdiffweb.librdiff import FileStatisticsEntry, RdiffRepo, \
-    DirEntry, IncrementEntry, SessionStatisticsEntry, HistoryEntry, \
+    DirEntry, IncrementEntry, HistoryEntry, \
     AccessDeniedError, DoesNotExistError, FileError, UnknownError
+from rdiffweb import librdiff
+from rdiffweb import rdw_helpers
 from rdiffweb.rdw_helpers import rdwTime
+from rdiffweb.rdw_restore import RestoreCache, RestoreFlights, RestoreProgress
 
 
 class MockRdiffRepo(RdiffRepo):
@@ -53,6 +61,7 @@ class MockDirEntry(DirEntry):
     def __init__(self, repo):
         self._repo = repo
         self.path = b''
+        self.full_path = repo.full_path
 
 
 class IncrementEntryTest(unittest.TestCase):
@@ -74,6 +83,28 @@ class IncrementEntryTest(unittest.TestCase):
         self.assertEqual(b'my_filename.txt', increment.filename)
         self.assertIsNotNone(increment.repo)
 
+    def test_kind(self):
+        increment = IncrementEntry(self.root_path, b'my_dir.2014-11-02T17:23:41-05:00.dir')
+        self.assertEqual(b'my_dir', increment.filename)
+        self.assertTrue(increment.has_suffix)
+        self.assertTrue(increment.isdir)
+        self.assertFalse(increment.is_missing)
+        self.assertFalse(increment.is_snapshot)
+        increment = IncrementEntry(self.root_path, b'my_file.2014-11-02T17:23:41-05:00.snapshot.gz')
+        self.assertTrue(increment.is_snapshot)
+        self.assertTrue(increment._is_compressed)
+        increment = IncrementEntry(self.root_path, b'my_file.2014-11-02T17:23:41-05:00.missing')
+        self.assertTrue(increment.is_missing)
+        self.assertFalse(increment.isdir)
+        increment = IncrementEntry(self.root_path, b'my_file.2014-11-02T17:23:41-05:00')
+        self.assertFalse(increment.has_suffix)
+
+    def test_date_cache(self):
+        # Date are parsed once for all the increments.
+        a = IncrementEntry(self.root_path, b'a.2014-11-02T17:23:41-05:00.diff.gz')
+        b = IncrementEntry(self.root_path, b'b.2014-11-02T17:23:41-05:00.missing')
+        self.assertIs(a.date, b.date)
+
 
 class DirEntryTest(unittest.TestCase):
 
@@ -190,6 +221,15 @@ class FileStatisticsEntryTest(unittest.TestCase):
         size = entry.get_source_size(bytes('<F!chïer> (@vec) {càraçt#èrë} $épêcial', encoding='utf-8'))
         self.assertEqual(286, size)
 
+    def test_get_source_sizes(self):
+        for name in [b'file_statistics.2014-11-05T16:05:07-05:00.data', b'file_statistics.2014-11-05T16:05:07-05:00.data.gz']:
+            entry = FileStatisticsEntry(self.root_path, name)
+            sizes = entry.get_source_sizes([b'Char ;090 to quote', bytes('<F!chïer> (@vec) {càraçt#èrë} $épêcial', encoding='utf-8'), b'invalid'])
+            self.assertEqual({
+                b'Char ;090 to quote': 0,
+                bytes('<F!chïer> (@vec) {càraçt#èrë} $épêcial', encoding='utf-8'): 286,
+                b'invalid': 0}, sizes)
+
 
 class HistoryEntryTest(unittest.TestCase):
 
@@ -219,6 +259,23 @@ class RdiffRepoTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.temp_dir.encode('utf8'), True)
 
+    def test_data_entries(self):
+        # Check if rdiff-backup-data is scanned only once.
+        with patch('rdiffweb.rdw_helpers.scandir', wraps=rdw_helpers.scandir) as scandir:
+            self.assertTrue(len(self.repo.backup_dates) > 1)
+            self.assertEqual(len(self.repo.backup_dates), len(self.repo.session_statistics))
+            self.repo._error_logs
+            self.repo._file_statistics
+            self.repo.status
+            self.assertEqual(1, scandir.call_count)
+        # Check if entries are grouped by prefix.
+        for prefix, entries in self.repo._data_entries.items():
+            self.assertTrue(all(e.name.startswith(prefix + b'.') for e in entries))
+        self.assertEqual([], self.repo._data_entries[b'current_mirror'][1:])
+        entry = self.repo._data_entries[b'mirror_metadata'][0]
+        self.assertEqual(self.repo.backup_dates[0], entry.date)
+        self.assertTrue(entry.size > 0)
+
     def test_extract_date(self):
 
         self.assertEqual(rdwTime(1414967021), self.repo._extract_date(b'my_filename.txt.2014-11-02T17:23:41-05:00.diff.gz'))
@@ -238,6 +295,15 @@ class RdiffRepoTest(unittest.TestCase):
         with self.assertRaises(DoesNotExistError):
             RdiffRepo(self.temp_dir, '/invalid')
 
+    def test_get_history_entries(self):
+        backup_dates = self.repo.backup_dates
+        self.assertEqual(backup_dates, [e.date for e in self.repo.get_history_entries()])
+        self.assertEqual(backup_dates[::-1][:2], [e.date for e in self.repo.get_history_entries(2, reverse=True)])
+        entries = self.repo.get_history_entries(
+            earliestDate=rdwTime(backup_dates[1].timeInSeconds, backup_dates[1].tzOffset),
+            latestDate=rdwTime(backup_dates[3].timeInSeconds, backup_dates[3].tzOffset))
+        self.assertEqual(backup_dates[1:4], [e.date for e in entries])
+
     def test_get_path_root(self):
         dir_entry = self.repo.get_path(b"/")
         self.assertEqual('', dir_entry.display_name)
@@ -265,6 +331,25 @@ class RdiffRepoTest(unittest.TestCase):
         self.assertEqual([], dir_entry.dir_entries)
         self.assertTrue(len(dir_entry.change_dates) > 1)
 
+    def test_get_path_deleted_file_size(self):
+        # Size of deleted files are resolved all at once when requested.
+        dir_entry = self.repo.get_path('Répertoire Supprimé'.encode('utf8'))
+        with patch.object(FileStatisticsEntry, '_read', autospec=True, side_effect=FileStatisticsEntry._read) as read:
+            entries = {e.display_name: e for e in dir_entry.dir_entries}
+            self.assertEqual(0, read.call_count)
+            dir_entry.prefetch_file_sizes(entries.values())
+            self.assertEqual(1, read.call_count)
+        self.assertEqual(21, entries['Untitled Empty Text File'].file_size)
+        self.assertEqual(14, entries['Untitled Empty Text File 2'].file_size)
+        self.assertEqual(0, entries['Untitled Empty Text File 3'].file_size)
+
+    def test_get_path_dir_entries(self):
+        # Type and size are defined while listing the directory.
+        for entry in self.repo.get_path(b'Subdirectory').dir_entries:
+            self.assertEqual(os.path.isdir(entry.full_path), entry._isdir)
+            if not entry.isdir:
+                self.assertEqual(os.lstat(entry.full_path).st_size, entry._file_size)
+
     def test_get_path_rdiff_backup_data(self):
         with self.assertRaises(AccessDeniedError):
             self.repo.get_path(b'rdiff-backup-data')
@@ -307,6 +392,250 @@ class RdiffRepoTest(unittest.TestCase):
         data = stream.read()
         self.assertTrue(data)
 
+    def test_restore_from_mirror(self):
+        # Latest version is served without rdiff-backup.
+        with patch.object(RdiffRepo, 'execute') as execute:
+            filename, stream = self.repo.restore(b"Revisions/Data", restore_date=1454448640)
+            self.assertEqual(b'Version3\n', stream.read())
+            stream.close()
+            filename, stream = self.repo.restore(b"/", restore_date=1454448640, kind='zip')
+            names = zipfile.ZipFile(io.BytesIO(stream.read())).namelist()
+            self.assertFalse(execute.called)
+        self.assertIn('Revisions/Data', names)
+        self.assertIn('Char ;090 to quote/', names)
+        self.assertFalse(any(n.startswith('rdiff-backup-data') for n in names))
+
+    def test_restore_from_mirror_length(self):
+        # Exact length of uncompressed archives.
+        filename, stream = self.repo.restore(b"/", restore_date=1454448640, kind='tar')
+        self.assertEqual(stream.length, len(stream.read()))
+        filename, stream = self.repo.restore(
+            b"/", restore_date=1454448640, kind='zip', archive_options={'level': 0})
+        self.assertEqual(stream.length, len(stream.read()))
+        filename, stream = self.repo.restore(b"/", restore_date=1454448640, kind='zip')
+        self.assertIsNone(stream.length)
+        stream.close()
+
+    def test_restore_from_increments(self):
+        # Older versions of a file are restored without rdiff-backup.
+        with patch.object(RdiffRepo, 'execute') as execute:
+            for date, expected in [(1415221470, b'Version1\n'), (1415221495, b'Version2\n')]:
+                filename, stream = self.repo.restore(b"Revisions/Data", restore_date=date)
+                self.assertEqual(expected, stream.read())
+                stream.close()
+            # From a snapshot.
+            filename, stream = self.repo.restore(b"Char ;090 to quote/Data", restore_date=1414889478)
+            self.assertEqual(b'Bring me some Data !\n', stream.read())
+            stream.close()
+            self.assertFalse(execute.called)
+
+    def test_restore_from_cache(self):
+        # Second restore is served from the cache.
+        cache = RestoreCache(os.path.join(self.temp_dir, 'cache'), 1024 * 1024)
+        filename, stream = self.repo.restore(b"Revisions/Data", restore_date=1415221470, cache=cache)
+        self.assertEqual(b'Version1\n', stream.read())
+        stream.close()
+        with patch.object(RdiffRepo, 'execute') as execute, patch.object(librdiff, '_patch_files') as patch_files:
+            filename, stream = self.repo.restore(b"Revisions/Data", restore_date=1415221470, cache=cache)
+            self.assertEqual('Data', filename)
+            self.assertEqual(b'Version1\n', stream.read())
+            stream.close()
+            self.assertFalse(execute.called)
+            self.assertFalse(patch_files.called)
+
+    def test_restore_single_flight(self):
+        # Identical restores in progress are executed once.
+        release = threading.Event()
+        calls = []
+
+        def execute(*args, **kwargs):
+            calls.append(args)
+            release.wait(5)
+            with open(os.path.join(args[-1], b'Data'), 'wb') as f:
+                f.write(b'Version1\n')
+
+        flights = RestoreFlights()
+        with patch.object(RdiffRepo, 'execute', side_effect=execute):
+            streams = [
+                self.repo.restore(b"Revisions", restore_date=1415221470, kind='tar', flights=flights)[1]
+                for unused in range(3)]
+            release.set()
+            data = [s.read() for s in streams]
+            for s in streams:
+                s.close()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(data[0], data[1])
+        self.assertEqual(data[0], data[2])
+        with tarfile.open(fileobj=io.BytesIO(data[0])) as t:
+            self.assertEqual(b'Version1\n', t.extractfile('Data').read())
+
+    def test_restore_single_flight_no_file(self):
+        # The output of a single client is not written to a temporary file.
+        def execute(*args, **kwargs):
+            with open(os.path.join(args[-1], b'Data'), 'wb') as f:
+                f.write(b'Version1\n')
+
+        flights = RestoreFlights()
+        with patch.object(RdiffRepo, 'execute', side_effect=execute), \
+                patch('tempfile.NamedTemporaryFile', wraps=tempfile.NamedTemporaryFile) as tmp:
+            stream = self.repo.restore(b"Revisions", restore_date=1415221470, kind='tar', flights=flights)[1]
+            data = stream.read()
+            stream.close()
+        self.assertEqual([], [c for c in tmp.call_args_list if 'rdiffweb_flight_' in str(c)])
+        with tarfile.open(fileobj=io.BytesIO(data)) as t:
+            self.assertEqual(b'Version1\n', t.extractfile('Data').read())
+
+    def test_restore_chunks(self):
+        # Directory content is restored and archived one child at a time.
+        outputs = []
+
+        def execute(*args, **kwargs):
+            src, dest = args[-2], args[-1]
+            # Previous children are already archived and removed.
+            self.assertEqual([], os.listdir(os.path.dirname(dest)))
+            outputs.append(os.path.basename(src))
+            if not src.endswith(b'Fichier @ <root>'):
+                os.mkdir(dest)
+                with open(os.path.join(dest, b'file'), 'wb') as f:
+                    f.write(b'data')
+            else:
+                with open(dest, 'wb') as f:
+                    f.write(b'data')
+
+        with patch.object(RdiffRepo, 'execute', side_effect=execute):
+            filename, stream = self.repo.restore(b"", restore_date=1414871387, kind='tar')
+            data = stream.read()
+            stream.close()
+        self.assertEqual(
+            [b'Fichier @ <root>', b'R\xc3\xa9pertoire Existant', b'R\xc3\xa9pertoire Supprim\xc3\xa9'],
+            outputs)
+        with tarfile.open(fileobj=io.BytesIO(data)) as t:
+            self.assertEqual(
+                ['Fichier @ <root>', 'R\xe9pertoire Existant', 'R\xe9pertoire Existant/file', 'R\xe9pertoire Supprim\xe9', 'R\xe9pertoire Supprim\xe9/file'],
+                t.getnames())
+
+    def test_restore_chunks_from_mirror(self):
+        # Only the data changed since the restore date is restored with
+        # rdiff-backup.
+        outputs = []
+
+        def execute(*args, **kwargs):
+            outputs.append(os.path.basename(args[-2]))
+            os.mkdir(args[-1])
+
+        with patch.object(RdiffRepo, 'execute', side_effect=execute):
+            filename, stream = self.repo.restore(b"", restore_date=1453304541, kind='tar')
+            data = stream.read()
+            stream.close()
+        self.assertEqual([b'Char ;059090 to quote', b'Subdirectory'], outputs)
+        with tarfile.open(fileobj=io.BytesIO(data)) as t:
+            names = t.getnames()
+            self.assertIn('Subdirectory', names)
+            self.assertIn('Char ;059090 to quote', names)
+            self.assertIn('R\xe9pertoire Existant/Untitled Empty Text File', names)
+            self.assertEqual(b'Version3\n', t.extractfile('Revisions/Data').read())
+
+    def test_restore_progress(self):
+        progress = RestoreProgress('id', 'admin', 'testcases', '', 'tar')
+        with patch.object(RdiffRepo, 'execute', side_effect=lambda *args, **kwargs: os.mkdir(args[-1])):
+            filename, stream = self.repo.restore(b"", restore_date=1453304541, kind='tar', progress=progress)
+            data = stream.read()
+            stream.close()
+        data = progress.to_dict()
+        self.assertEqual(RestoreProgress.DONE, data['phase'])
+        self.assertLess(0, data['files'])
+        self.assertLess(0, data['written'])
+        self.assertLess(0, data['total_files'])
+
+    def test_get_changed_dirs(self):
+        self.assertEqual(
+            set([b'', b'Char ;059059090 to quote', b'Char ;059090 to quote', b'Subdirectory']),
+            self.repo._get_changed_dirs(b'', 1453304541))
+        self.assertEqual(set(), self.repo._get_changed_dirs(b'Revisions', 1453304541))
+
+    def test_exists_at(self):
+        entry = self.repo.get_path(b"Revisions/Data")
+        self.assertFalse(self.repo._exists_at(entry, 1414871387))
+        self.assertTrue(self.repo._exists_at(entry, 1415221470))
+        self.assertTrue(self.repo._exists_at(entry, 1454448640))
+
+    def test_get_restore_files(self):
+        entry = self.repo.get_path(b"Revisions/Data")
+        files = self.repo._get_restore_files(entry, 1415221470)
+        self.assertEqual(entry.full_path, files[0])
+        self.assertEqual(
+            [b'Data.2014-11-05T16:05:07-05:00.diff.gz', b'Data.2014-11-05T16:04:55-05:00.diff.gz', b'Data.2014-11-05T16:04:30-05:00.diff.gz'],
+            [os.path.basename(f) for f in files[1:]])
+        # File didn't exists.
+        self.assertIsNone(self.repo._get_restore_files(entry, 1415221262))
+        # Directory are restored by rdiff-backup.
+        self.assertIsNone(self.repo._get_restore_files(self.repo.get_path(b"Revisions"), 1415221470))
+
+    def test_restore_between_backups(self):
+        # The backup made before the requested date is restored.
+        entry = self.repo.get_path(b"Revisions/Data")
+        self.assertEqual(
+            [b'Data.2014-11-05T16:05:07-05:00.diff.gz', b'Data.2014-11-05T16:04:55-05:00.diff.gz'],
+            [os.path.basename(f) for f in self.repo._get_restore_files(entry, 1415221495)[1:]])
+        stream = self.repo.restore(b"Revisions/Data", restore_date=1415221500, kind='zip')[1]
+        self.assertEqual(b'Version2\n', stream.read())
+        stream.close()
+
+    def test_restore_cancel(self):
+        # Closing the stream kill rdiff-backup and clean up.
+        started = threading.Event()
+        outputs = []
+
+        def execute(*args, **kwargs):
+            outputs.append(args[-1])
+            started.set()
+            kwargs['cancel'].add_callback(lambda: None)
+            while not kwargs['cancel'].cancelled:
+                time.sleep(0.01)
+            kwargs['cancel'].check()
+
+        with patch.object(RdiffRepo, 'execute', side_effect=execute):
+            filename, stream = self.repo.restore(b"Revisions", restore_date=1415221470, kind='zip')
+            self.assertTrue(started.wait(5))
+            stream.close()
+            for unused in range(500):
+                if not os.path.exists(outputs[0]):
+                    break
+                time.sleep(0.01)
+        self.assertFalse(os.path.exists(outputs[0]))
+
+    def test_is_current(self):
+        entry = self.repo.get_path(b"Revisions/Data")
+        self.assertTrue(self.repo._is_current(entry, 1454448640))
+        self.assertFalse(self.repo._is_current(entry, entry.change_dates[-2].getSeconds()))
+        # Directory content may change without increments.
+        entry = self.repo.get_path(b"Revisions")
+        self.assertFalse(self.repo._is_current(entry, self.repo.backup_dates[-2].getSeconds()))
+
+    def test_is_current_between_backups(self):
+        # The mirror is not used when the file changed at the next backup.
+        entry = self.repo.get_path(b"Revisions/Data")
+        stream = self.repo.restore(b"Revisions/Data", restore_date=1454448640, kind='zip')[1]
+        self.assertEqual(entry.full_path, getattr(stream, 'name', None))
+        stream.close()
+        stream = self.repo.restore(b"Revisions/Data", restore_date=1415221600, kind='zip')[1]
+        self.assertNotEqual(entry.full_path, getattr(stream, 'name', None))
+        self.assertEqual(b'Version3\n', stream.read())
+        stream.close()
+        self.assertEqual(1415221507, self.repo._get_backup_date(1415221600))
+        self.assertEqual(1415221507, self.repo._get_backup_date(1415221507))
+        self.assertEqual(0, self.repo._get_backup_date(0))
+
+    def test_is_current_interrupted(self):
+        # Mirror is partially updated while a backup is running.
+        fn = os.path.join(self.testcases_dir, b'rdiff-backup-data', b'current_mirror.2016-02-03T16:30:40-05:00.data')
+        with open(fn, 'wb') as f:
+            f.write(b'PID 999999999\n')
+        self.repo = RdiffRepo(self.temp_dir, b'testcases')
+        self.assertNotEqual('ok', self.repo.status[0])
+        entry = self.repo.get_path(b"Revisions/Data")
+        self.assertFalse(self.repo._is_current(entry, 1454448640))
+
     def test_set_encoding(self):
         self.repo.set_encoding("cp1252")
         self.repo = RdiffRepo(self.temp_dir, 'testcases')
@@ -315,36 +644,59 @@ class RdiffRepoTest(unittest.TestCase):
     def test_unquote(self):
         self.assertEqual(b'Char ;090 to quote', self.repo.unquote(b'Char ;059090 to quote'))
 
-
-class SessionStatisticsEntryTest(unittest.TestCase):
-
-    def setUp(self):
-        self.repo = MockRdiffRepo()
-        self.root_path = self.repo.root_path
-
-    def test_getattr(self):
-        """
-        Check how a session statistic is read.
-        """
-        entry = SessionStatisticsEntry(self.root_path, b'session_statistics.2014-11-02T09:16:43-05:00.data')
-        self.assertEqual(1414937803.00, entry.starttime)
-        self.assertEqual(1414937764.82, entry.endtime)
-        self.assertAlmostEqual(-38.18, entry.elapsedtime, delta=-0.01)
-        self.assertEqual(14, entry.sourcefiles)
-        self.assertEqual(3666973, entry.sourcefilesize)
-        self.assertEqual(13, entry.mirrorfiles)
-        self.assertEqual(30242, entry.mirrorfilesize)
-        self.assertEqual(1, entry.newfiles)
-        self.assertEqual(3636731, entry.newfilesize)
-        self.assertEqual(0, entry.deletedfiles)
-        self.assertEqual(0, entry.deletedfilesize)
-        self.assertEqual(1, entry.changedfiles)
-        self.assertEqual(0, entry.changedsourcesize)
-        self.assertEqual(0, entry.changedmirrorsize)
-        self.assertEqual(2, entry.incrementfiles)
-        self.assertEqual(0, entry.incrementfilesize)
-        self.assertEqual(3636731, entry.totaldestinationsizechange)
-        self.assertEqual(0, entry.errors)
+    def test_session_statistics(self):
+        stats = self.repo.session_statistics
+        self.assertEqual(self.repo.backup_dates, stats.dates)
+        date = rdwTime(1414937803)
+        self.assertEqual(14, stats.get(date, 'sourcefiles'))
+        self.assertEqual(1414937803.0, stats.get(date, 'starttime'))
+        self.assertEqual(1414937764.82, stats.get(date, 'endtime'))
+        self.assertEqual(3636731, stats.get(date, 'totaldestinationsizechange'))
+        self.assertEqual(0, stats.get(date, 'errors'))
+        self.assertEqual(
+            stats.column('sourcefilesize'),
+            [row[0] for unused, row in stats.rows(['sourcefilesize'])])
+        with self.assertRaises(KeyError):
+            stats.get(rdwTime(0), 'sourcefiles')
+
+    def test_session_statistics_update(self):
+        stats = self.repo.session_statistics
+        count = len(stats)
+        # Simulate a new backup.
+        data_path = os.path.join(self.testcases_dir, b'rdiff-backup-data')
+        shutil.copy(
+            os.path.join(data_path, b'session_statistics.2016-01-20T10:42:21-05:00.data'),
+            os.path.join(data_path, b'session_statistics.2017-01-20T10:42:21-05:00.data'))
+        repo = RdiffRepo(self.temp_dir, b'testcases')
+        repo.reuse(self.repo)
+        with patch('rdiffweb.librdiff._read_session_statistics', wraps=librdiff._read_session_statistics) as read:
+            self.assertIs(stats, repo.session_statistics)
+            self.assertEqual(1, read.call_count)
+        self.assertEqual(count + 1, len(stats))
+        self.assertEqual(rdwTime(1484926941), stats.dates[-1])
+
+    def test_session_statistics_append(self):
+        stats = self.repo.session_statistics
+        count = len(stats)
+        # Simulate new backups with names not ordered by date.
+        data_path = os.path.join(self.testcases_dir, b'rdiff-backup-data')
+        with open(os.path.join(data_path, b'session_statistics.2017-01-20T10:42:21-05:00.data'), 'wb') as f:
+            f.write(b'StartTime 1484926941.00 (Fri Jan 20 10:42:21 2017)\n')
+            f.write(b'SourceFileSize 9007199254740993 (8.00 PB)\n')
+        with open(os.path.join(data_path, b'session_statistics.2017-01-20T12:00:00+05:00.data'), 'wb') as f:
+            f.write(b'SourceFileSize 1 (1 byte)\n')
+        repo = RdiffRepo(self.temp_dir, b'testcases')
+        repo.reuse(self.repo)
+        self.assertIs(stats, repo.session_statistics)
+        self.assertEqual(count + 2, len(stats))
+        self.assertEqual(sorted(stats.dates), stats.dates)
+        self.assertEqual(rdwTime(1484926941), stats.dates[-1])
+        # Integers are kept without loss of precision.
+        self.assertEqual(2 ** 53 + 1, stats.get(stats.dates[-1], 'sourcefilesize'))
+        self.assertEqual(1484926941.0, stats.get(stats.dates[-1], 'starttime'))
+        # Missing values.
+        self.assertIsNone(stats.get(stats.dates[-1], 'errors'))
+        self.assertIsNone(stats.get(stats.dates[-2], 'starttime'))
 
 
 if __name__ == "__main__":
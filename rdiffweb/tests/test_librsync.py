@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module used to test the librsync patch implementation.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import unittest
+
+from rdiffweb.librsync import patch, DeltaError
+
+
+MAGIC = b'\x72\x73\x02\x36'
+
+
+class PatchTest(unittest.TestCase):
+
+    def _patch(self, basis, delta):
+        out = io.BytesIO()
+        patch(io.BytesIO(basis), io.BytesIO(delta), out)
+        return out.getvalue()
+
+    def test_literal(self):
+        self.assertEqual(b'abc', self._patch(b'', MAGIC + b'\x03abc\x00'))
+        # Literal with 1 byte length.
+        self.assertEqual(b'abc', self._patch(b'', MAGIC + b'\x41\x03abc\x00'))
+        # Literal with 4 bytes length.
+        self.assertEqual(b'abc', self._patch(b'', MAGIC + b'\x43\x00\x00\x00\x03abc\x00'))
+
+    def test_copy(self):
+        # Copy with 1 byte offset and 1 byte length.
+        self.assertEqual(b'cde', self._patch(b'abcdef', MAGIC + b'\x45\x02\x03\x00'))
+        # Copy with 2 bytes offset and 4 bytes length.
+        self.assertEqual(b'cde', self._patch(b'abcdef', MAGIC + b'\x4b\x00\x02\x00\x00\x00\x03\x00'))
+        # Mixed copy and literal.
+        self.assertEqual(b'efXab', self._patch(b'abcdef', MAGIC + b'\x45\x04\x02\x01X\x45\x00\x02\x00'))
+
+    def test_invalid(self):
+        with self.assertRaises(DeltaError):
+            self._patch(b'', b'\x00\x00\x00\x00\x00')
+        with self.assertRaises(DeltaError):
+            self._patch(b'', MAGIC + b'\x55\x00')
+        with self.assertRaises(DeltaError):
+            self._patch(b'', MAGIC + b'\x03ab')
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -24,12 +24,22 @@ Created on Jan 1, 2016
 from __future__ import unicode_literals
 
 import io
+import json
 import logging
 import sys
 import tarfile
+import threading
+import time
 import unittest
 import zipfile
-
+from mock import patch
+try:
+    from http.client import IncompleteRead
+except ImportError:
+    from httplib import IncompleteRead  # @UnresolvedImport
+
+from rdiffweb.librdiff import RdiffRepo
+from rdiffweb.rdw_restore import RestoreExecutor
 from rdiffweb.test import WebCase, AppTestCase
 
 
@@ -87,6 +97,57 @@ class RestoreTest(WebCase):
         self.assertBody("My Data !\n")
         self.assertHeader('Content-Disposition', 'attachment; filename="Data"')
 
+    def test_latest_from_mirror(self):
+        self._restore(self.REPO, "Revisions/Data/", "1454448640", False)
+        self.assertStatus(200)
+        self.assertBody("Version3\n")
+        self.assertHeader('Content-Length', '9')
+
+    def test_latest_from_mirror_content_length(self):
+        # Size of uncompressed archives is known before streaming.
+        self._restore(self.REPO, "Revisions/", "1454448640", False, kind="tar")
+        self.assertStatus(200)
+        self.assertHeader('Content-Length', str(len(self.body)))
+        with tarfile.open(fileobj=io.BytesIO(self.body), mode='r') as t:
+            self.assertIn('Data', t.getnames())
+
+    def test_latest_from_mirror_range(self):
+        # Range requests are ignored when streaming an archive.
+        self.getPage("/restore/" + self.REPO + "/Revisions/?date=1454448640&kind=tar",
+                     headers=[('Range', 'bytes=10-19')])
+        self.assertStatus(200)
+        self.assertNoHeader('Accept-Ranges')
+        self.assertHeader('Content-Length', str(len(self.body)))
+        with tarfile.open(fileobj=io.BytesIO(self.body), mode='r') as t:
+            self.assertIn('Data', t.getnames())
+        # But supported for regular files.
+        self.getPage("/restore/" + self.REPO + "/Revisions/Data/?date=1454448640",
+                     headers=[('Range', 'bytes=0-6')])
+        self.assertStatus(206)
+        self.assertBody("Version")
+
+    def test_latest_from_mirror_length_mismatch(self):
+        # Response is aborted when the archive doesn't match the length.
+        with patch.object(RdiffRepo, '_archive_mirror_size', return_value=1024):
+            self.assertRaises(
+                IncompleteRead, self.getPage, "/restore/" + self.REPO + "/Revisions/?date=1454448640&kind=tar")
+
+    def test_queue_full(self):
+        executor = self.app.restore_executor
+        self.app.restore_executor = RestoreExecutor(max_workers=1, max_queue=1)
+        release = threading.Event()
+        self.app.restore_executor.submit(lambda: release.wait(10))
+        while not self.app.restore_executor.active:
+            time.sleep(0.01)
+        self.app.restore_executor.submit(lambda: None)
+        try:
+            self._restore(self.REPO, "Revisions/", "1415221470", False)
+            self.assertStatus(503)
+            self.assertHeader('Retry-After')
+        finally:
+            release.set()
+            self.app.restore_executor = executor
+
     def test_quoted(self):
         """
         Check names return for a quoted path.
@@ -310,6 +371,51 @@ class RestoreTest(WebCase):
         self._restore(self.REPO, "Revisions/Data/", "1415221507", True)
         self.assertBody("Version3\n")
 
+    def test_progress(self):
+        self._restore(self.REPO, "Revisions/Data/", "1454448640&restore_id=" + "a" * 32, False)
+        self.assertBody("Version3\n")
+        self.assertHeader('X-Restore-Id', 'a' * 32)
+        self.getPage("/restore_progress/?id=" + "a" * 32)
+        self.assertStatus(200)
+        self.assertHeader('Content-Type', 'application/json')
+        data = json.loads(self.body.decode('utf8'))
+        self.assertEqual('done', data['phase'])
+        self.assertEqual('Revisions/Data', data['path'])
+        self.assertEqual(1, data['total_files'])
+        # List restores of current user.
+        self.getPage("/restore_progress/")
+        self.assertIn('a' * 32, [d['id'] for d in json.loads(self.body.decode('utf8'))])
+        # Stream events until completed.
+        self.getPage("/restore_progress/events?id=" + "a" * 32)
+        self.assertHeader('Content-Type', 'text/event-stream;charset=utf-8')
+        self.assertInBody('retry: 1000\n')
+        self.assertInBody('"phase": "done"')
+        self.assertInBody('id: finished\n')
+        # Stop the client once completed.
+        self.getPage("/restore_progress/events?id=" + "a" * 32,
+                     headers=[('Last-Event-ID', 'finished')])
+        self.assertStatus(204)
+
+    def test_progress_events_timeout(self):
+        # The stream is closed after a timeout for the client to reconnect.
+        progress = self.app.restore_tracker.create(self.USERNAME, self.REPO, 'Revisions', 'tar.gz', 'c' * 32)
+        with patch('rdiffweb.page_restore.PROGRESS_EVENTS_TIMEOUT', 0):
+            self.getPage("/restore_progress/events?id=" + "c" * 32,
+                         headers=[('Last-Event-ID', 'finished')])
+        self.assertStatus(200)
+        self.assertInBody('retry: 1000\n')
+        self.assertInBody('"phase": "queued"')
+        self.assertNotInBody('id: finished')
+        progress.set_phase(progress.DONE)
+
+    def test_progress_not_found(self):
+        self.getPage("/restore_progress/?id=" + "b" * 32)
+        self.assertStatus(404)
+
+    def test_progress_invalid_id(self):
+        self._restore(self.REPO, "Revisions/Data/", "1415221470&restore_id=invalid", True)
+        self.assertStatus(400)
+
     def test_invalid_date(self):
         self._restore(self.REPO, "Revisions/Data/", "1415221a470", True)
         self.assertStatus(400)
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module used to test the repository catalog.
+"""
+
+from __future__ import unicode_literals
+
+from future.utils import native_str
+import os
+import pkg_resources
+import shutil
+import tarfile
+import tempfile
+import unittest
+from mock import patch
+
+from rdiffweb import rdw_catalog
+from rdiffweb.librdiff import RdiffRepo
+from rdiffweb.rdw_catalog import Catalog
+from rdiffweb.rdw_helpers import rdwTime
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        self.dir = os.path.join(self.temp_dir, 'data').encode('utf8')
+        os.mkdir(self.dir)
+        self.parsed = []
+
+        def parse(name):
+            self.parsed.append(name)
+            return (name.split(b'.')[0], rdwTime(int(name.split(b'.')[1])))
+
+        self.catalog = Catalog(os.path.join(self.temp_dir, 'catalog.db'), parse, rdwTime)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.temp_dir, True)
+
+    def _touch(self, name):
+        with open(os.path.join(self.dir, name), 'wb'):
+            pass
+        # Make sure the modification time changed.
+        mtime = os.stat(self.dir).st_mtime
+        os.utime(self.dir, (mtime + 1, mtime + 1))
+
+    def test_list(self):
+        self._touch(b'a.1414871387')
+        self._touch(b'b.1414871426')
+        entries = sorted(self.catalog.list(self.dir), key=lambda x: x.name)
+        self.assertEqual([b'a.1414871387', b'b.1414871426'], [x.name for x in entries])
+        self.assertEqual([b'a', b'b'], [x.filename for x in entries])
+        self.assertEqual([rdwTime(1414871387), rdwTime(1414871426)], [x.date for x in entries])
+
+    def test_list_with_filename(self):
+        self._touch(b'a.1414871387')
+        self._touch(b'b.1414871426')
+        entries = self.catalog.list(self.dir, b'b')
+        self.assertEqual([b'b.1414871426'], [x.name for x in entries])
+
+    def test_list_missing(self):
+        self.assertEqual([], self.catalog.list(os.path.join(self.dir, b'invalid')))
+
+    def test_list_only_parse_new_entries(self):
+        self._touch(b'a.1414871387')
+        self.catalog.list(self.dir)
+        self.catalog.list(self.dir)
+        self.assertEqual([b'a.1414871387'], self.parsed)
+        # Add a new entry
+        self._touch(b'b.1414871426')
+        self.assertEqual(2, len(self.catalog.list(self.dir)))
+        self.assertEqual([b'a.1414871387', b'b.1414871426'], self.parsed)
+
+    def test_list_persistent(self):
+        self._touch(b'a.1414871387')
+        self.catalog.list(self.dir)
+        self.catalog.close()
+        # Open the catalog again.
+        catalog = Catalog(os.path.join(self.temp_dir, 'catalog.db'), None, rdwTime)
+        try:
+            self.assertEqual([rdwTime(1414871387)], [x.date for x in catalog.list(self.dir)])
+        finally:
+            catalog.close()
+
+    def test_file_statistic(self):
+        fn = os.path.join(self.dir, b'file_statistics.data')
+        with open(fn, 'wb') as f:
+            f.write(b'a 0 286 143 NA\n')
+        calls = []
+
+        def read():
+            calls.append(1)
+            with open(fn, 'rb') as f:
+                return [line.rstrip(b'\n').rsplit(b' ', 4) for line in f]
+
+        self.assertEqual(
+            {'changed': 0, 'source_size': 286, 'mirror_size': 143, 'increment_size': None},
+            self.catalog.file_statistic(fn, b'a', read))
+        with self.assertRaises(KeyError):
+            self.catalog.file_statistic(fn, b'b', read)
+        self.assertEqual(1, len(calls))
+        # Index is re-built when the file change.
+        with open(fn, 'ab') as f:
+            f.write(b'b 1 12 12 NA\n')
+        self.assertEqual(12, self.catalog.file_statistic(fn, b'b', read)['source_size'])
+        self.assertEqual(2, len(calls))
+
+    def _write_statistics(self, fn, paths):
+        with open(fn, 'wb') as f:
+            for i, path in enumerate(paths):
+                f.write(path + b' 1 %d 0 NA\n' % i)
+
+        def read():
+            with open(fn, 'rb') as f:
+                return [line.rstrip(b'\n').rsplit(b' ', 4) for line in f]
+        return read
+
+    def test_file_statistic_blocks(self):
+        # Lookup every path of a file stored in many blocks.
+        fn = os.path.join(self.dir, b'file_statistics.data')
+        paths = [b'.'] + [b'dir%02d/file %03d' % (i // 100, i) for i in range(1000)]
+        paths.extend([b'dir01.txt', b'dir01-a'])
+        read = self._write_statistics(fn, paths)
+        with patch.object(rdw_catalog, 'BLOCK_SIZE', 512):
+            for i, path in enumerate(paths):
+                self.assertEqual(i, self.catalog.file_statistic(fn, path, read)['source_size'])
+        for path in [b'', b'dir', b'dir01', b'dir01/file 100 ', b'zzz']:
+            with self.assertRaises(KeyError):
+                self.catalog.file_statistic(fn, path, read)
+        count = self.catalog._conn.execute('SELECT COUNT(*) FROM statistics_blocks').fetchone()[0]
+        self.assertTrue(1 < count < len(paths) / 10)
+
+    def test_file_statistic_removed(self):
+        fn = os.path.join(self.dir, b'file_statistics.data')
+        read = self._write_statistics(fn, [b'a'])
+        self.assertEqual(0, self.catalog.file_statistic(fn, b'a', read)['source_size'])
+        os.remove(fn)
+        with self.assertRaises(KeyError):
+            self.catalog.file_statistic(fn, b'a', read)
+        self.assertEqual(0, self.catalog._conn.execute('SELECT COUNT(*) FROM statistics_blocks').fetchone()[0])
+
+    def test_prune(self):
+        # Rows of removed statistics and directories are deleted when a new
+        # statistics file is indexed.
+        fn1 = os.path.join(self.dir, b'file_statistics.1.data')
+        fn2 = os.path.join(self.dir, b'file_statistics.2.data')
+        subdir = os.path.join(self.dir, b'subdir')
+        os.mkdir(subdir)
+        self.catalog.list(subdir)
+        self.catalog.file_statistic(fn1, b'a', self._write_statistics(fn1, [b'a']))
+        os.remove(fn1)
+        os.rmdir(subdir)
+        self.catalog.file_statistic(fn2, b'a', self._write_statistics(fn2, [b'a']))
+        conn = self.catalog._conn
+        self.assertEqual([(fn2,)], [(bytes(r[0]),) for r in conn.execute('SELECT name FROM statistics_files')])
+        self.assertEqual([], conn.execute('SELECT dir FROM listings WHERE dir=?', (subdir,)).fetchall())
+
+
+class RdiffRepoCatalogTest(unittest.TestCase):
+    """
+    Check if a repository with a catalog return the same data as without.
+    """
+
+    def setUp(self):
+        # Extract 'testcases.tar.gz'
+        testcases = pkg_resources.resource_filename('rdiffweb.tests', 'testcases.tar.gz')  # @UndefinedVariable
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        tarfile.open(testcases).extractall(native_str(self.temp_dir))
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        os.mkdir(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.encode('utf8'), True)
+
+    def test_backup_dates(self):
+        expected = RdiffRepo(self.temp_dir, b'testcases').backup_dates
+        for unused in range(2):
+            repo = RdiffRepo(self.temp_dir, b'testcases', cache_dir=self.cache_dir)
+            self.assertEqual(expected, repo.backup_dates)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_dir_entries(self):
+        def entries(repo, path):
+            return sorted(
+                (e.path, e.exists, e.change_dates)
+                for e in repo.get_path(path).dir_entries)
+        repo = RdiffRepo(self.temp_dir, b'testcases')
+        cached = RdiffRepo(self.temp_dir, b'testcases', cache_dir=self.cache_dir)
+        for path in [b'', b'Revisions', 'Répertoire Supprimé'.encode('utf8')]:
+            self.assertEqual(entries(repo, path), entries(cached, path))
+            self.assertEqual(entries(repo, path), entries(cached, path))
+
+    def test_file_size(self):
+        repo = RdiffRepo(self.temp_dir, b'testcases')
+        cached = RdiffRepo(self.temp_dir, b'testcases', cache_dir=self.cache_dir)
+        path = 'Répertoire Supprimé'.encode('utf8')
+        self.assertEqual(
+            sorted((e.path, e.file_size) for e in repo.get_path(path).dir_entries),
+            sorted((e.path, e.file_size) for e in cached.get_path(path).dir_entries))
+
+    def test_get_path(self):
+        repo = RdiffRepo(self.temp_dir, b'testcases')
+        cached = RdiffRepo(self.temp_dir, b'testcases', cache_dir=self.cache_dir)
+        self.assertEqual(
+            repo.get_path(b'Revisions/Data').change_dates,
+            cached.get_path(b'Revisions/Data').change_dates)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
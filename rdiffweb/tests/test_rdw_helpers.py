@@ -28,7 +28,7 @@ import datetime
 import time
 import unittest
 
-from rdiffweb.rdw_helpers import quote_url, unquote_url, rdwTime
+from rdiffweb.rdw_helpers import quote_url, unquote_url, rdwTime, Timestamp
 
 
 class Test(unittest.TestCase):
@@ -101,6 +101,52 @@ class RdwTimeTest(unittest.TestCase):
         self.assertTrue((rdwTime() - rdwTime('2014-11-02T21:04:30Z')).days > 0)
 
 
+class TimestampTest(unittest.TestCase):
+
+    def test_parse(self):
+        t = Timestamp.parse('2014-11-05T21:04:30-04:00')
+        self.assertEqual(1415221470, t.timeInSeconds)
+        self.assertEqual(-14400, t.tzOffset)
+        self.assertEqual(rdwTime('2014-11-05T21:04:30-04:00').getSeconds(), t.getSeconds())
+        with self.assertRaises(ValueError):
+            Timestamp.parse('invalid')
+
+    def test_compare(self):
+        """Check comparison with Timestamp and rdwTime."""
+        t = Timestamp.parse('2014-11-07T21:04:30-04:00')
+        self.assertEqual(rdwTime('2014-11-07T21:04:30-04:00'), t)
+        self.assertEqual(t, rdwTime('2014-11-07T21:04:30-04:00'))
+        self.assertEqual(hash(rdwTime('2014-11-07T21:04:30-04:00')), hash(t))
+        self.assertTrue(t < rdwTime('2014-11-08T21:04:30Z'))
+        self.assertTrue(rdwTime('2014-11-08T21:04:30Z') > t)
+        self.assertTrue(t < Timestamp.parse('2014-11-08T21:04:30Z'))
+        self.assertFalse(t > Timestamp.parse('2014-11-08T21:04:30Z'))
+        # Same as rdwTime, not equal to an integer.
+        self.assertNotEqual(Timestamp(1415221470), 1415221470)
+        self.assertNotEqual(rdwTime(1415221470), 1415221470)
+        self.assertNotEqual(Timestamp(1415221470), Timestamp(1415221470, -14400))
+
+    def test_compact(self):
+        self.assertFalse(hasattr(Timestamp(1415221470), '__dict__'))
+        self.assertFalse(hasattr(rdwTime(1415221470), '__dict__'))
+
+    def test_add(self):
+        self.assertEqual(rdwTime('2014-11-08T21:04:30-04:00'),
+                         Timestamp.parse('2014-11-05T21:04:30-04:00') + datetime.timedelta(days=3))
+
+    def test_sub(self):
+        self.assertEqual(rdwTime('2014-11-02T21:04:30-04:00'),
+                         Timestamp.parse('2014-11-05T21:04:30-04:00') - datetime.timedelta(days=3))
+        self.assertEqual(datetime.timedelta(days=3),
+                         Timestamp.parse('2014-11-05T21:04:30Z') - rdwTime('2014-11-02T21:04:30Z'))
+
+    def test_int(self):
+        self.assertEqual(1415221470, int(Timestamp(1415221470, -14400)))
+
+    def test_str(self):
+        self.assertEqual('2014-11-05 21:04:30', str(Timestamp(1415221470)))
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module used to test the repository cache.
+"""
+
+from __future__ import unicode_literals
+
+from future.utils import native_str
+import os
+import pkg_resources
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from rdiffweb.librdiff import DoesNotExistError
+from rdiffweb.rdw_repo_cache import RepoCache
+
+
+class RepoCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Extract 'testcases.tar.gz'
+        testcases = pkg_resources.resource_filename('rdiffweb.tests', 'testcases.tar.gz')  # @UndefinedVariable
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        tarfile.open(testcases).extractall(native_str(self.temp_dir))
+        self.data_path = os.path.join(self.temp_dir, 'testcases', 'rdiff-backup-data')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.encode('utf8'), True)
+
+    def test_get(self):
+        cache = RepoCache(size=10)
+        repo = cache.get(self.temp_dir, 'testcases')
+        self.assertIs(repo, cache.get(self.temp_dir, b'/testcases/'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_with_modification(self):
+        cache = RepoCache(size=10)
+        repo = cache.get(self.temp_dir, 'testcases')
+        # Simulate a new backup.
+        mtime = os.stat(self.data_path).st_mtime
+        os.utime(self.data_path, (mtime + 1, mtime + 1))
+        self.assertIsNot(repo, cache.get(self.temp_dir, 'testcases'))
+        self.assertEqual(2, cache.misses)
+
+    def test_get_with_modification_reuse_statistics(self):
+        cache = RepoCache(size=10)
+        stats = cache.get(self.temp_dir, 'testcases').session_statistics
+        mtime = os.stat(self.data_path).st_mtime
+        os.utime(self.data_path, (mtime + 1, mtime + 1))
+        self.assertIs(stats, cache.get(self.temp_dir, 'testcases').session_statistics)
+
+    def test_get_with_encoding(self):
+        cache = RepoCache(size=10)
+        repo = cache.get(self.temp_dir, 'testcases')
+        repo.set_encoding('cp1252')
+        self.assertEqual('cp1252', cache.get(self.temp_dir, 'testcases').get_encoding())
+
+    def test_get_with_changed(self):
+        # Modified by rdiffweb within the same second.
+        cache = RepoCache(size=10)
+        repo = cache.get(self.temp_dir, 'testcases')
+        repo.changed()
+        self.assertIsNot(repo, cache.get(self.temp_dir, 'testcases'))
+
+    def test_get_concurrent(self):
+        # Data loaded lazily is shared by every thread.
+        cache = RepoCache(size=10)
+        repo = cache.get(self.temp_dir, 'testcases')
+        results = []
+
+        def load():
+            results.append((repo._file_statistics, repo._error_logs, repo.backup_dates))
+        threads = [threading.Thread(target=load) for unused in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8, len(results))
+        for r in results:
+            self.assertIs(results[0][0], r[0])
+            self.assertIs(results[0][1], r[1])
+            self.assertIs(results[0][2], r[2])
+        self.assertTrue(results[0][0])
+
+    def test_get_with_ttl(self):
+        cache = RepoCache(size=10, ttl=-1)
+        repo = cache.get(self.temp_dir, 'testcases')
+        self.assertIsNot(repo, cache.get(self.temp_dir, 'testcases'))
+
+    def test_get_deleted(self):
+        cache = RepoCache(size=10)
+        cache.get(self.temp_dir, 'testcases')
+        shutil.rmtree(os.path.join(self.temp_dir, 'testcases'))
+        with self.assertRaises(DoesNotExistError):
+            cache.get(self.temp_dir, 'testcases')
+
+    def test_get_disabled(self):
+        cache = RepoCache(size=0)
+        repo = cache.get(self.temp_dir, 'testcases')
+        self.assertIsNot(repo, cache.get(self.temp_dir, 'testcases'))
+        self.assertEqual(0, cache.hits)
+
+    def test_lru(self):
+        os.symlink(os.path.join(self.temp_dir, 'testcases'), os.path.join(self.temp_dir, 'other'))
+        cache = RepoCache(size=1)
+        repo = cache.get(self.temp_dir, 'testcases')
+        cache.get(self.temp_dir, 'other')
+        self.assertIsNot(repo, cache.get(self.temp_dir, 'testcases'))
+        self.assertEqual(3, cache.misses)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module used to test the restore executor.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+from rdiffweb.rdw_restore import RestoreExecutor, QueueFullError, CancelToken, \
+    CancelledError, CancellableReader, CancellableWriter, RestoreCache, \
+    RestoreFlights, RestoreProgress, RestoreTracker
+
+
+class RestoreExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = []
+
+    def tearDown(self):
+        self.release.set()
+
+    def _task(self, name):
+        def func():
+            self.started.append(name)
+            self.release.wait(10)
+        return func
+
+    def _wait(self, func, timeout=5):
+        deadline = time.time() + timeout
+        while not func() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(func())
+
+    def test_submit(self):
+        executor = RestoreExecutor(max_workers=2)
+        executor.submit(self._task('a'))
+        self.release.set()
+        self._wait(lambda: executor.stats()['completed'] == 1)
+        self.assertEqual(['a'], self.started)
+
+    def test_max_workers(self):
+        executor = RestoreExecutor(max_workers=2, max_per_user=0)
+        for name in ['a', 'b', 'c']:
+            executor.submit(self._task(name))
+        self._wait(lambda: executor.stats()['active'] == 2)
+        self.assertEqual(1, executor.stats()['queued'])
+        self.assertEqual(['a', 'b'], self.started)
+        self.release.set()
+        self._wait(lambda: executor.stats()['completed'] == 3)
+
+    def test_max_per_user(self):
+        executor = RestoreExecutor(max_workers=3, max_per_user=1)
+        executor.submit(self._task('a1'), 'a')
+        executor.submit(self._task('a2'), 'a')
+        executor.submit(self._task('b1'), 'b')
+        self._wait(lambda: executor.stats()['active'] == 2)
+        # Restores of other users are not blocked.
+        self.assertEqual(['a1', 'b1'], sorted(self.started))
+        self.assertEqual(1, executor.stats()['queued'])
+        self.release.set()
+        self._wait(lambda: executor.stats()['completed'] == 3)
+
+    def test_max_queue(self):
+        executor = RestoreExecutor(max_workers=1, max_queue=1)
+        executor.submit(self._task('a'))
+        self._wait(lambda: executor.stats()['active'] == 1)
+        executor.submit(self._task('b'))
+        with self.assertRaises(QueueFullError) as cm:
+            executor.submit(self._task('c'))
+        self.assertTrue(cm.exception.retry_after >= 1)
+        self.assertEqual(1, executor.stats()['rejected'])
+
+
+class CancelTokenTest(unittest.TestCase):
+
+    def test_cancel(self):
+        calls = []
+        token = CancelToken()
+        token.add_callback(lambda: calls.append(1))
+        token.check()
+        token.cancel()
+        token.cancel()
+        self.assertEqual([1], calls)
+        with self.assertRaises(CancelledError):
+            token.check()
+        # Callback added after cancel is called immediately.
+        token.add_callback(lambda: calls.append(2))
+        self.assertEqual([1, 2], calls)
+
+    def test_reader_close(self):
+        token = CancelToken()
+        reader = CancellableReader(io.BytesIO(b'data'), token)
+        self.assertEqual(b'data', reader.read())
+        self.assertFalse(token.cancelled)
+        reader.close()
+        self.assertTrue(token.cancelled)
+
+    def test_writer_broken_pipe(self):
+        token = CancelToken()
+        rfd, wfd = os.pipe()
+        os.close(rfd)
+        writer = CancellableWriter(io.open(wfd, 'wb', buffering=0), token)
+        with self.assertRaises(CancelledError):
+            writer.write(b'data')
+        self.assertTrue(token.cancelled)
+        writer.close()
+
+    def test_writer_cancelled(self):
+        token = CancelToken()
+        writer = CancellableWriter(io.BytesIO(), token)
+        writer.write(b'data')
+        token.cancel()
+        with self.assertRaises(CancelledError):
+            writer.write(b'data')
+
+
+class RestoreCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        self.cache = RestoreCache(self.temp_dir, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def _create(self, path, date, data=b'data', kind=''):
+        f = self.cache.create(b'/repo', path, date, kind)
+        f.write(data)
+        f.commit()
+
+    def _get(self, path, date, kind=''):
+        f = self.cache.open(b'/repo', path, date, kind)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_commit(self):
+        self.assertIsNone(self._get(b'file', 1))
+        self._create(b'file', 1)
+        self.assertEqual(b'data', self._get(b'file', 1))
+        # Kind and date are part of the key.
+        self.assertIsNone(self._get(b'file', 1, kind='zip'))
+        self.assertIsNone(self._get(b'file', 2))
+        # No temporary files left.
+        self.assertEqual(1, len(os.listdir(self.temp_dir)))
+
+    def test_discard(self):
+        f = self.cache.create(b'/repo', b'file', 1, '')
+        f.write(b'data')
+        f.discard()
+        self.assertIsNone(self._get(b'file', 1))
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_evict(self):
+        self._create(b'a', 1)
+        self._create(b'b', 1)
+        # Access `a` to make `b` the least recently used.
+        old = time.time() - 10
+        for name in os.listdir(self.temp_dir):
+            os.utime(os.path.join(self.temp_dir, name), (old, old))
+        self._get(b'a', 1)
+        self._create(b'c', 1)
+        self.assertEqual(b'data', self._get(b'a', 1))
+        self.assertIsNone(self._get(b'b', 1))
+        self.assertEqual(b'data', self._get(b'c', 1))
+
+    def test_invalidate(self):
+        self._create(b'a', 1)
+        self._create(b'a', 2)
+        other = self.cache.create(b'/other', b'a', 1, '')
+        other.write(b'data')
+        other.commit()
+        self.cache.invalidate(b'/repo', before=2)
+        self.assertIsNone(self._get(b'a', 1))
+        self.assertEqual(b'data', self._get(b'a', 2))
+        self.cache.invalidate(b'/repo')
+        self.assertIsNone(self._get(b'a', 2))
+        self.assertIsNotNone(self.cache.open(b'/other', b'a', 1, ''))
+
+
+class RestoreFlightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = RestoreFlights()
+
+    def test_acquire(self):
+        flight, reader1 = self.flights.acquire('key')
+        self.assertIsNotNone(flight)
+        # Identical restore follow the first one.
+        unused, reader2 = self.flights.acquire('key')
+        self.assertIsNone(unused)
+        # Other restore are not shared.
+        other, reader3 = self.flights.acquire('other')
+        self.assertIsNotNone(other)
+        flight.write(b'data')
+        self.assertEqual(b'da', reader1.read(2))
+        flight.write(b'more')
+        flight.close()
+        self.assertEqual(b'tamore', reader1.read())
+        self.assertEqual(b'datamore', reader2.read())
+        # Completed restore are not shared anymore.
+        new, reader4 = self.flights.acquire('key')
+        self.assertIsNotNone(new)
+        self.assertIsNot(flight, new)
+        for r in [reader1, reader2, reader3, reader4]:
+            r.close()
+
+    def test_read_wait(self):
+        flight, reader = self.flights.acquire('key')
+
+        def _write():
+            time.sleep(0.1)
+            flight.write(b'data')
+            flight.close()
+        thread = threading.Thread(target=_write)
+        thread.start()
+        self.assertEqual(b'data', reader.read())
+        thread.join()
+        reader.close()
+
+    def test_cancel(self):
+        # Restore is cancelled when every reader is closed.
+        flight, reader1 = self.flights.acquire('key')
+        unused, reader2 = self.flights.acquire('key')
+        reader1.close()
+        self.assertFalse(flight.token.cancelled)
+        reader2.close()
+        self.assertTrue(flight.token.cancelled)
+        with self.assertRaises(CancelledError):
+            flight.write(b'data')
+        flight.close()
+        self.assertEqual({}, self.flights._flights)
+
+    def test_single_reader(self):
+        # The output of a restore with a single client is not written to disk.
+        with patch('tempfile.NamedTemporaryFile') as tmp, patch('rdiffweb.rdw_restore.FLIGHT_BUFFER_SIZE', 8):
+            flight, reader = self.flights.acquire('key')
+            flight.write(b'0123456789')
+            # Too big to be shared.
+            new, unused = self.flights.acquire('key')
+            self.assertIsNot(flight, new)
+            unused.close()
+            new.close()
+
+            def _write():
+                for unused in range(9):
+                    flight.write(b'0123456789')
+                flight.close()
+            thread = threading.Thread(target=_write)
+            thread.start()
+            self.assertEqual(b'0123456789' * 10, reader.read())
+            thread.join()
+            reader.close()
+            self.assertFalse(tmp.called)
+            # Memory is released as the data is read.
+            self.assertEqual(0, len(flight._chunks))
+
+    def test_join(self):
+        # Followers get the whole output even if the first client read it.
+        flight, reader1 = self.flights.acquire('key')
+        flight.write(b'data')
+        self.assertEqual(b'da', reader1.read(2))
+        unused, reader2 = self.flights.acquire('key')
+        self.assertIsNotNone(flight._fp)
+        flight.write(b'more')
+        flight.close()
+        self.assertEqual(b'tamore', reader1.read())
+        self.assertEqual(b'datamore', reader2.read())
+        reader1.close()
+        reader2.close()
+
+    def test_fileno(self):
+        unused, reader = self.flights.acquire('key')
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.fileno()
+        reader.close()
+
+
+
+class RestoreTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = RestoreTracker(ttl=60)
+
+    def test_create(self):
+        progress = self.tracker.create('bob', 'repo', 'path', 'zip')
+        self.assertEqual(32, len(progress.id))
+        self.assertEqual(progress, self.tracker.get(progress.id))
+        # Use identifier provided by client unless already used.
+        progress = self.tracker.create('bob', 'repo', 'path', 'zip', '0' * 32)
+        self.assertEqual('0' * 32, progress.id)
+        progress = self.tracker.create('bob', 'repo', 'path', 'zip', '0' * 32)
+        self.assertNotEqual('0' * 32, progress.id)
+
+    def test_list(self):
+        self.tracker.create('bob', 'repo', 'path', 'zip')
+        self.tracker.create('alice', 'repo', 'path', 'zip')
+        self.assertEqual(2, len(self.tracker.list()))
+        self.assertEqual(['bob'], [p.user for p in self.tracker.list('bob')])
+
+    def test_cleanup(self):
+        progress = self.tracker.create('bob', 'repo', 'path', 'zip')
+        progress.set_phase(RestoreProgress.DONE)
+        progress.completed -= 61
+        self.assertEqual([], self.tracker.list())
+        self.assertIsNone(self.tracker.get(progress.id))
+
+
+class RestoreProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_progress(self):
+        progress = RestoreProgress('id', 'bob', 'repo', 'path', 'zip')
+        progress.estimate = lambda: (2, 10)
+        self.assertEqual(RestoreProgress.QUEUED, progress.to_dict()['phase'])
+        progress.set_phase(RestoreProgress.RESTORING)
+        fn = os.path.join(self.temp_dir, 'file')
+        with open(fn, 'wb') as f:
+            f.write(b'data')
+        progress.add_file(fn)
+        progress.add_file(self.temp_dir)
+        progress.add_written(3)
+        data = progress.to_dict()
+        self.assertEqual(RestoreProgress.ARCHIVING, data['phase'])
+        self.assertEqual(2, data['files'])
+        self.assertEqual(4, data['bytes'])
+        self.assertEqual(3, data['written'])
+        self.assertEqual(2, data['total_files'])
+        self.assertEqual(10, data['total_bytes'])
+        self.assertFalse(progress.finished)
+        # Final phase is kept.
+        progress.set_phase(RestoreProgress.DONE)
+        progress.set_phase(RestoreProgress.FAILED)
+        self.assertEqual(RestoreProgress.DONE, progress.phase)
+        self.assertTrue(progress.finished)
+        self.assertIsNotNone(progress.completed)
+
+    def test_follow(self):
+        progress = RestoreProgress('id', 'bob', 'repo', 'path', 'zip')
+        other = RestoreProgress('other', 'alice', 'repo', 'path', 'zip')
+        progress.follow(other)
+        other.set_phase(RestoreProgress.RESTORING)
+        data = progress.to_dict()
+        self.assertEqual('id', data['id'])
+        self.assertEqual('bob', data['user'])
+        self.assertEqual(RestoreProgress.RESTORING, data['phase'])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
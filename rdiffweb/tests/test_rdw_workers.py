@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# rdiffweb, A web interface to rdiff-backup repositories
+# Copyright (C) 2017 rdiffweb contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Module used to test the pool of rdiff-backup workers. The workers execute
+`fake_main` instead of rdiff-backup.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+
+import rdiffweb
+from rdiffweb import rdw_worker_server
+from rdiffweb.librdiff import ExecuteError, RdiffRepo
+from rdiffweb.rdw_restore import CancelToken
+from rdiffweb.rdw_workers import RdiffBackupPool, find_command
+
+
+def fake_main(args):
+    """Entry point executed by the workers during the tests."""
+    if args[0] == 'echo':
+        sys.stdout.write(' '.join(args[1:]))
+    elif args[0] == 'exit':
+        sys.stderr.write('error')
+        sys.exit(int(args[1]))
+    elif args[0] == 'pid':
+        sys.stdout.write('%s' % os.getppid())
+    elif args[0] == 'sleep':
+        time.sleep(int(args[1]))
+    elif args[0] == 'return':
+        sys.stderr.write('error')
+        return int(args[1])
+
+
+class RdiffBackupPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        server = os.path.splitext(rdw_worker_server.__file__)[0] + '.py'
+        self.command = [sys.executable, server, 'rdiffweb.tests.test_rdw_workers:fake_main']
+        root = os.path.dirname(os.path.dirname(rdiffweb.__file__))
+        self.env = {'PYTHONPATH': root}
+        self.pool = RdiffBackupPool(size=2, max_jobs=3, command=self.command)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_execute(self):
+        self.assertEqual((0, b'a b', b''), self.pool.execute([b'echo', b'a', b'b'], env=self.env))
+        self.assertEqual((2, b'', b'error'), self.pool.execute([b'exit', b'2'], env=self.env))
+        # Exit code returned by the entry point.
+        self.assertEqual((3, b'', b'error'), self.pool.execute([b'return', b'3'], env=self.env))
+
+    def test_execute_error(self):
+        # A failure reported by the worker is raised to the caller.
+        # Start the worker with the environment of the tests.
+        self.pool.execute([b'echo'], env=self.env)
+        repo = MagicMock(_pool=self.pool)
+        with self.assertRaises(ExecuteError):
+            RdiffRepo.execute(repo, b'return', b'3')
+        self.assertEqual((b'', b'error'), RdiffRepo.execute(repo, b'return', b'0'))
+
+    def test_execute_reuse_worker(self):
+        pid1 = self.pool.execute([b'pid'], env=self.env)[1]
+        pid2 = self.pool.execute([b'pid'], env=self.env)[1]
+        self.assertEqual(pid1, pid2)
+        # Recycled after max jobs.
+        pid3 = self.pool.execute([b'pid'], env=self.env)[1]
+        self.assertEqual(pid1, pid3)
+        pid4 = self.pool.execute([b'pid'], env=self.env)[1]
+        self.assertNotEqual(pid1, pid4)
+
+    def test_execute_busy(self):
+        # Return None when every worker is busy.
+        pool = RdiffBackupPool(size=1, command=self.command)
+        thread = threading.Thread(target=pool.execute, args=([b'sleep', b'1'], self.env))
+        thread.start()
+        time.sleep(0.5)
+        self.assertIsNone(pool.execute([b'echo'], env=self.env))
+        thread.join()
+        self.assertEqual((0, b'', b''), pool.execute([b'echo'], env=self.env))
+        pool.close()
+
+    def test_execute_cancel(self):
+        token = CancelToken()
+        threading.Timer(0.5, token.cancel).start()
+        code, unused, unused = self.pool.execute([b'sleep', b'30'], env=self.env, cancel=token)
+        self.assertEqual(-9, code)
+        # Worker is still usable.
+        self.assertEqual((0, b'ok', b''), self.pool.execute([b'echo', b'ok'], env=self.env))
+
+    def test_execute_cancel_completed(self):
+        # A cancel received once the job is completed is ignored.
+        self.pool.execute([b'echo'], env=self.env)
+        self.pool._idle[0]._send(rdw_worker_server.CANCEL)
+        self.assertEqual((0, b'ok', b''), self.pool.execute([b'echo', b'ok'], env=self.env))
+
+    def test_execute_dead_worker(self):
+        self.pool.execute([b'echo'], env=self.env)
+        worker = self.pool._idle[0]
+        worker._proc.kill()
+        worker._proc.wait()
+        self.assertEqual((0, b'ok', b''), self.pool.execute([b'echo', b'ok'], env=self.env))
+
+    def test_execute_unavailable(self):
+        pool = RdiffBackupPool(command=[sys.executable, '-c', 'pass'])
+        self.assertIsNone(pool.execute([b'echo'], env=self.env))
+        self.assertTrue(pool._disabled)
+
+
+class FindCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='rdiffweb_tests_')
+        self.path = os.environ.get('PATH')
+        os.environ['PATH'] = self.temp_dir
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.temp_dir, True)
+
+    def _script(self, content):
+        fn = os.path.join(self.temp_dir, 'rdiff-backup')
+        with open(fn, 'wb') as f:
+            f.write(content)
+        os.chmod(fn, 0o755)
+
+    def test_find_command(self):
+        self.assertIsNone(find_command())
+        self._script(b'#!/usr/bin/env python2\nimport rdiff_backup\n')
+        command = find_command()
+        self.assertEqual(['/usr/bin/env', 'python2'], command[:2])
+        self.assertTrue(command[2].endswith('rdw_worker_server.py'))
+
+    def test_find_command_binary(self):
+        self._script(b'\x7fELF')
+        self.assertIsNone(find_command())
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
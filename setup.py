@@ -239,6 +239,8 @@ install_requires = [
 ]
 if PY2:
     install_requires.extend(["pysqlite>=2.6.3"])
+if sys.version_info < (3, 5):
+    install_requires.extend(["scandir>=1.5"])
 
 setup(
     name='rdiffweb',